@@ -0,0 +1,77 @@
+"""
+Benchmark of the DLRM dot interaction, the "triu" kernel against the
+default "bmm" one, at several batch sizes with and without backward.
+
+    python -m benchmarks.interaction_bench --batch-sizes 128 1024 8192
+"""
+from argparse import ArgumentParser
+from types import SimpleNamespace
+import time
+
+import numpy as np
+import torch
+from experiments.dlrm.net import DLRM_Net
+
+
+def make_dlrm(num_tables, m_spa, kernel):
+    preproc = SimpleNamespace(ln_emb=np.full(num_tables, 10), m_den=4)
+    return DLRM_Net(
+        preproc,
+        arch_feature_emb_size=m_spa,
+        arch_mlp_bot=[4, m_spa],
+        arch_mlp_top=[1],
+        arch_interaction_op="dot",
+        arch_interaction_kernel=kernel,
+        embedding_types={"base": {"name": "torch_bag"}})
+
+
+def time_interaction(net, x, ly, num_iters, backward):
+    def step():
+        if backward:
+            net.interact_features(x, ly).sum().backward()
+        else:
+            with torch.no_grad():
+                net.interact_features(x, ly)
+
+    for _ in range(3):
+        step()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        step()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--num-tables", type=int, default=26)
+    parser.add_argument("--embedding-dim", type=int, default=16)
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[128, 512, 2048, 8192])
+    parser.add_argument("--num-iters", type=int, default=50)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    nets = [make_dlrm(args.num_tables, args.embedding_dim, kernel).to(device)
+            for kernel in ("bmm", "triu")]
+    print("batch  backward  bmm(ms)  triu(ms)  speedup")
+    for batch_size in args.batch_sizes:
+        x = torch.rand(batch_size, args.embedding_dim, device=device,
+                       requires_grad=True)
+        ly = [torch.rand(batch_size, args.embedding_dim, device=device,
+                         requires_grad=True)
+              for _ in range(args.num_tables)]
+        for backward in (False, True):
+            times = [time_interaction(net, x, ly, args.num_iters, backward)
+                     for net in nets]
+            print("{:>5}  {:>8}  {:>7.3f}  {:>8.3f}  {:>6.2f}x".format(
+                batch_size, str(backward), times[0] * 1e3, times[1] * 1e3,
+                times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of the `QREmbeddingBag` forward, the vectorized
+quotient/remainder path against the original one, for every operation.
+
+    python -m benchmarks.qr_embedding_bench --num-embeddings 10000000 \
+        --num-collisions 4 --batch-size 2048
+"""
+from argparse import ArgumentParser
+import time
+
+import torch
+from fedrec.modules.embeddings import QREmbeddingBag
+
+
+def time_forward(emb, input, offsets, num_iters, backward):
+    def step():
+        if backward:
+            emb.zero_grad(set_to_none=True)
+            emb(input, offsets).sum().backward()
+        else:
+            with torch.no_grad():
+                emb(input, offsets)
+
+    # warm up the allocator and the buffers
+    for _ in range(3):
+        step()
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        step()
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iters
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--num-embeddings", type=int, default=1000000)
+    parser.add_argument("--num-collisions", type=int, default=4)
+    parser.add_argument("--embedding-dim", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=2048)
+    parser.add_argument("--bag-size", type=int, default=1)
+    parser.add_argument("--num-iters", type=int, default=100)
+    parser.add_argument("--backward", action="store_true")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    num_indices = args.batch_size * args.bag_size
+    input = torch.randint(
+        0, args.num_embeddings, (num_indices,), device=device)
+    offsets = torch.arange(
+        0, num_indices, args.bag_size, device=device)
+
+    print("operation  original(ms)  vectorized(ms)  speedup")
+    for operation in ["concat", "add", "mult"]:
+        times = []
+        for vectorized in [False, True]:
+            torch.manual_seed(0)
+            emb = QREmbeddingBag(
+                args.num_embeddings, args.embedding_dim,
+                args.num_collisions, operation=operation, mode="sum",
+                vectorized=vectorized).to(device)
+            times.append(time_forward(
+                emb, input, offsets, args.num_iters, args.backward))
+        print("{:<9}  {:>12.3f}  {:>14.3f}  {:>6.2f}x".format(
+            operation, times[0] * 1e3, times[1] * 1e3, times[0] / times[1]))
+
+
+if __name__ == "__main__":
+    main()
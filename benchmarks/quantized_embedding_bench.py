@@ -0,0 +1,104 @@
+"""
+Size and AUC impact of evaluating DLRM with quantized embedding tables.
+A small DLRM is trained on synthetic clicks drawn from a random teacher
+DLRM and evaluated with fp32, fp16 and row-wise int8 tables.
+
+    python -m benchmarks.quantized_embedding_bench --num-rows 100000
+"""
+from argparse import ArgumentParser
+from types import SimpleNamespace
+import io
+
+import numpy as np
+import torch
+from experiments.dlrm.net import DLRM_Net
+from fedrec.modules.embeddings import quantized_embeddings
+from sklearn import metrics
+
+NUM_DENSE = 13
+
+
+def make_dlrm(ln_emb, m_spa, init=False):
+    preproc = SimpleNamespace(ln_emb=np.array(ln_emb), m_den=NUM_DENSE)
+    return DLRM_Net(
+        preproc,
+        arch_feature_emb_size=m_spa,
+        arch_mlp_bot=[NUM_DENSE, 64, m_spa],
+        arch_mlp_top=[64, 1],
+        arch_interaction_op="dot",
+        embedding_types={
+            "base": {"name": "torch_bag", "mode": "sum", "init": init}})
+
+
+def make_batch(teacher, ln_emb, batch_size):
+    dense_x = torch.rand(batch_size, NUM_DENSE)
+    lS_o = torch.arange(batch_size).repeat(len(ln_emb), 1)
+    # skewed accesses, as in the Criteo tables
+    lS_i = torch.stack([
+        torch.from_numpy(np.random.zipf(1.2, batch_size) % n)
+        for n in ln_emb])
+    with torch.no_grad():
+        logits = teacher(dense_x, lS_o, lS_i)
+        # sharpen the standardized teacher logits into learnable clicks
+        p = torch.sigmoid(3 * (logits - logits.mean()) / logits.std())
+    return (dense_x, lS_o, lS_i), torch.bernoulli(p)
+
+
+def embedding_bytes(model):
+    buffer = io.BytesIO()
+    torch.save(model.emb_l.state_dict(), buffer)
+    return buffer.tell()
+
+
+def evaluate(model, batches):
+    scores, targets = [], []
+    model.eval()
+    with torch.no_grad():
+        for inputs, labels in batches:
+            scores.append(model.get_scores(model(*inputs)).numpy())
+            targets.append(labels.numpy())
+    model.train()
+    return metrics.roc_auc_score(
+        np.concatenate(targets), np.concatenate(scores))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--num-rows", type=int, default=10000)
+    parser.add_argument("--num-tables", type=int, default=8)
+    parser.add_argument("--embedding-dim", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--num-batches", type=int, default=500)
+    parser.add_argument("--num-eval-batches", type=int, default=50)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    ln_emb = [args.num_rows] * args.num_tables
+    teacher = make_dlrm(ln_emb, args.embedding_dim)
+    model = make_dlrm(ln_emb, args.embedding_dim, init=True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    for _ in range(args.num_batches):
+        inputs, labels = make_batch(teacher, ln_emb, args.batch_size)
+        loss = model.loss(model(*inputs), labels)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    batches = [make_batch(teacher, ln_emb, args.batch_size)
+               for _ in range(args.num_eval_batches)]
+    base_bytes = embedding_bytes(model)
+    base_auc = evaluate(model, batches)
+    print("tables  size(MB)  ratio  auc     delta")
+    print("fp32    {:>8.2f}  {:>5.2f}  {:.4f}".format(
+        base_bytes / 2 ** 20, 1.0, base_auc))
+    for dtype in ["fp16", "int8"]:
+        with quantized_embeddings(model, dtype):
+            size = embedding_bytes(model)
+            auc = evaluate(model, batches)
+        print("{:<6}  {:>8.2f}  {:>5.2f}  {:.4f}  {:+.4f}".format(
+            dtype, size / 2 ** 20, base_bytes / size, auc, auc - base_auc))
+
+
+if __name__ == "__main__":
+    main()
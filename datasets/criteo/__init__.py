@@ -1 +1,2 @@
-from . import criteo_processor
\ No newline at end of file
+from . import criteo_processor
+from . import criteo_terabyte_processor
@@ -1,21 +1,91 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import copy
+import os
+
 import numpy as np
 # pytorch
 import torch
-from torch.utils.data import Dataset
+from datasets.criteo.criteo_manifest import atomic_path
+from torch.utils.data import Dataset, IterableDataset
+
+# number of rows read at once from a shard when streaming
+STREAM_BLOCK_SIZE = 1 << 16
+
+# columns of a pre-collated batch cache
+BATCH_CACHE_COLUMNS = ("X_int", "lS_i", "T")
+
+
+class ConcatColumns:
+    """
+    Read-only row-wise concatenation of arrays (e.g. the memory mapped
+    columns of every day) which is resolved on indexing, so the parts
+    are never copied into one array.
+
+    Arguments
+    ----------
+    parts: list
+        Arrays with the same trailing shape and dtype.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+        self.shape = (int(self.offsets[-1]),) + parts[0].shape[1:]
+        self.dtype = parts[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                # contiguous rows are sliced from every part they span
+                return np.concatenate([
+                    part[max(start - offset, 0):max(stop - offset, 0)]
+                    for part, offset in zip(self.parts, self.offsets)])
+            index = np.arange(start, stop, step)
+        if np.ndim(index) == 0:
+            part = np.searchsorted(self.offsets, index, side="right") - 1
+            return self.parts[part][index - self.offsets[part]]
+
+        index = np.asarray(index)
+        out = np.empty(index.shape + self.shape[1:], dtype=self.dtype)
+        parts = np.searchsorted(self.offsets, index, side="right") - 1
+        for part in np.unique(parts):
+            mask = parts == part
+            out[mask] = self.parts[part][index[mask] - self.offsets[part]]
+        return out
 
 
 class CriteoDataset(Dataset):
+    """
+    Criteo split backed by the shared processed arrays.
+
+    Arguments
+    ----------
+    X_int, X_cat, y: np.ndarray
+        Dense features, categorical features and targets of the whole
+        processed dataset (possibly memory mapped).
+    max_ind_range: int
+        If positive, categorical indices are taken modulo this value.
+    indices: np.ndarray, optional
+        Rows of the backing arrays that belong to this split. If `None`
+        all rows are used.
+    """
+
     def __init__(
             self,
             X_int, X_cat, y,
-            max_ind_range):
+            max_ind_range,
+            indices=None):
         self.max_ind_range = max_ind_range
         self.X_int = X_int
         self.X_cat = X_cat
         self.y = y
+        self.indices = indices
 
     def __getitem__(self, index):
 
@@ -26,6 +96,11 @@ class CriteoDataset(Dataset):
                 )
             ]
 
+        # resolve the split position(s) to rows of the backing arrays,
+        # a sequence of positions is fetched with one fancy index
+        if self.indices is not None:
+            index = self.indices[index]
+
         if self.max_ind_range > 0:
             return (
                 self.X_int[index],
@@ -46,56 +121,349 @@ class CriteoDataset(Dataset):
         return X_int, X_cat, y
 
     def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
         return len(self.y)
 
 
-def collate_wrapper_criteo_offset(list_of_tuples):
-    # where each tuple is (X_int, X_cat, y)
-    transposed_data = list(zip(*list_of_tuples))
-    X_int = torch.log(torch.tensor(transposed_data[0], dtype=torch.float) + 1)
-    X_cat = torch.tensor(transposed_data[1], dtype=torch.long)
-    T = torch.tensor(transposed_data[2], dtype=torch.float32).view(-1, 1)
+class CriteoStreamingDataset(IterableDataset):
+    """
+    Criteo split streamed from contiguous row ranges (shards, e.g. the
+    days) of the processed arrays. Rows are read block by block and
+    shuffled through a bounded buffer, so memory stays O(buffer_size)
+    however large the split is. Every DataLoader worker streams its own
+    subset of the shards.
+
+    The stream yields whole batches of `(X_int, X_cat, y)` arrays, use
+    `batched` to set the batch size and whether to shuffle.
+
+    Arguments
+    ----------
+    X_int, X_cat, y: np.ndarray
+        Dense features, categorical features and targets of the whole
+        processed dataset (possibly memory mapped).
+    max_ind_range: int
+        If positive, categorical indices are taken modulo this value.
+    shards: list
+        `(start, stop)` row ranges that make up this split.
+    buffer_size: int
+        Number of rows held by the shuffle buffer, 0 disables shuffling.
+    """
+
+    def __init__(
+            self,
+            X_int, X_cat, y,
+            max_ind_range,
+            shards,
+            buffer_size=1 << 20,
+            block_size=STREAM_BLOCK_SIZE):
+        self.max_ind_range = max_ind_range
+        self.X_int = X_int
+        self.X_cat = X_cat
+        self.y = y
+        self.shards = [(int(start), int(stop)) for start, stop in shards]
+        self.buffer_size = buffer_size
+        self.block_size = block_size
+        self.batch_size = 1
+        self.shuffle = False
+        self.drop_last = False
+
+    def batched(self, batch_size, shuffle=False, drop_last=False):
+        """
+        Returns a copy of the stream (sharing the backing arrays) which
+        yields batches of `batch_size` rows.
+        """
+        data = copy.copy(self)
+        data.batch_size = batch_size
+        data.shuffle = shuffle and self.buffer_size > 0
+        data.drop_last = drop_last
+        return data
+
+    def __len__(self):
+        # number of batches, only exact for a single worker
+        num_rows = sum(stop - start for start, stop in self.shards)
+        if self.drop_last:
+            return num_rows // self.batch_size
+        return -(-num_rows // self.batch_size)
+
+    def worker_shards(self):
+        # shards read by the current worker, the shards are cut further
+        # if there are less of them than workers
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return list(self.shards)
+        num_workers = worker_info.num_workers
+        shards = self.shards
+        if len(shards) < num_workers:
+            pieces = -(-num_workers // len(shards))
+            shards = [
+                (int(bounds[i]), int(bounds[i + 1]))
+                for start, stop in shards
+                for bounds in [np.linspace(start, stop, pieces + 1)]
+                for i in range(pieces)]
+        return shards[worker_info.id::num_workers]
+
+    def _read(self, start, stop):
+        X_cat = np.asarray(self.X_cat[start:stop])
+        if self.max_ind_range > 0:
+            X_cat = X_cat % self.max_ind_range
+        return [np.asarray(self.X_int[start:stop]), X_cat,
+                np.asarray(self.y[start:stop])]
+
+    def __iter__(self):
+        # a new seed per epoch from torch's generator, which is seeded
+        # per worker (and follows the data seed in the main process)
+        seed = int(torch.randint(1 << 32, (), dtype=torch.int64))
+        rng = np.random.RandomState(seed)
+        shards = self.worker_shards()
+        if self.shuffle:
+            shards = [shards[i] for i in rng.permutation(len(shards))]
+
+        # blocks are only concatenated once the buffer is full
+        blocks, num_buffered = [], 0
+        for start, stop in shards:
+            for block in range(start, stop, self.block_size):
+                blocks.append(
+                    self._read(block, min(block + self.block_size, stop)))
+                num_buffered += len(blocks[-1][2])
+                if num_buffered < max(self.buffer_size, self.batch_size):
+                    continue
+                # emit about half of a full buffer, the rest stays mixed
+                # in with the next blocks
+                buffer = self._merge(blocks, rng)
+                num_out = max(num_buffered - self.buffer_size // 2,
+                              self.batch_size)
+                num_out -= num_out % self.batch_size
+                yield from self._batches(buffer, num_out)
+                blocks = [[column[num_out:] for column in buffer]]
+                num_buffered -= num_out
+
+        if num_buffered == 0:
+            return
+        buffer = self._merge(blocks, rng)
+        if self.drop_last:
+            num_buffered -= num_buffered % self.batch_size
+        yield from self._batches(buffer, num_buffered)
+
+    def _merge(self, blocks, rng):
+        buffer = [np.concatenate(column) for column in zip(*blocks)]
+        if self.shuffle:
+            perm = rng.permutation(len(buffer[2]))
+            buffer = [column[perm] for column in buffer]
+        return buffer
+
+    def _batches(self, buffer, num_rows):
+        for start in range(0, num_rows, self.batch_size):
+            stop = min(start + self.batch_size, num_rows)
+            yield tuple(column[start:stop] for column in buffer)
+
+
+def _collate_arrays(batch):
+    # `batch` is either a list of (X_int, X_cat, y) tuples or a single
+    # (X_int, X_cat, y) tuple of batched arrays from indexing the dataset
+    # with the positions of a whole batch
+    if isinstance(batch, list):
+        batch = [np.stack(column) for column in zip(*batch)]
+    X_int, X_cat, y = batch
+    X_int = torch.log(torch.as_tensor(X_int, dtype=torch.float) + 1)
+    X_cat = torch.as_tensor(X_cat, dtype=torch.long)
+    T = torch.as_tensor(y, dtype=torch.float32).view(-1, 1)
+    return X_int, X_cat, T
+
+
+def collate_wrapper_criteo_offset(batch):
+    X_int, X_cat, T = _collate_arrays(batch)
 
     batchSize = X_cat.shape[0]
     featureCnt = X_cat.shape[1]
 
-    lS_i = [X_cat[:, i] for i in range(featureCnt)]
-    lS_o = [torch.tensor(range(batchSize)) for _ in range(featureCnt)]
+    lS_i = X_cat.t().contiguous()
+    lS_o = torch.arange(batchSize).repeat(featureCnt, 1)
 
-    return (X_int, torch.stack(lS_o), torch.stack(lS_i)), T
+    return (X_int, lS_o, lS_i), T
 
 # Conversion from offset to length
 
 
 def offset_to_length_converter(lS_o, lS_i):
-    def diff(tensor):
-        return tensor[1:] - tensor[:-1]
-
-    return torch.stack(
-        [
-            diff(torch.cat((S_o, torch.tensor(lS_i[ind].shape))).int())
-            for ind, S_o in enumerate(lS_o)
-        ]
-    )
+    if not isinstance(lS_o, torch.Tensor):
+        lS_o = torch.stack(list(lS_o))
+    num_indices = lS_i.shape[-1] if isinstance(lS_i, torch.Tensor) \
+        else lS_i[0].shape[0]
+    ends = torch.full((lS_o.shape[0], 1), num_indices, dtype=lS_o.dtype)
+    return torch.diff(torch.cat((lS_o, ends), dim=1), dim=1).int()
 
 
-def collate_wrapper_criteo_length(list_of_tuples):
-    # where each tuple is (X_int, X_cat, y)
-    transposed_data = list(zip(*list_of_tuples))
-    X_int = torch.log(torch.tensor(transposed_data[0], dtype=torch.float) + 1)
-    X_cat = torch.tensor(transposed_data[1], dtype=torch.long)
-    T = torch.tensor(transposed_data[2], dtype=torch.float32).view(-1, 1)
+def collate_wrapper_criteo_length(batch):
+    X_int, X_cat, T = _collate_arrays(batch)
 
     batchSize = X_cat.shape[0]
     featureCnt = X_cat.shape[1]
 
-    lS_i = torch.stack([X_cat[:, i] for i in range(featureCnt)])
-    lS_o = torch.stack(
-        [torch.tensor(range(batchSize)) for _ in range(featureCnt)]
+    lS_i = X_cat.t().contiguous()
+    # every sample holds exactly one index per feature
+    lS_l = torch.ones((featureCnt, batchSize), dtype=torch.int32)
+    return (X_int, lS_l, lS_i), T
+
+
+class _BatchOrderSampler(torch.utils.data.Sampler):
+    # order of the batches of a batch cache, sized on every epoch
+    def __init__(self, data, shuffle=False, drop_last=False):
+        self.data = data
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        cache = getattr(self.data, "dataset", self.data)
+        return cache.num_full_batches if self.drop_last else len(cache)
+
+    def __iter__(self):
+        if self.shuffle:
+            return iter(torch.randperm(len(self)).tolist())
+        return iter(range(len(self)))
+
+
+def batched_data_loader(
+        data,
+        batch_size=1,
+        shuffle=False,
+        drop_last=False,
+        collate_fn=None,
+        **kwargs):
+    """
+    Builds a DataLoader which fetches whole batches from `data` with
+    a single fancy index instead of one `__getitem__` call per sample.
+    A `BatchSampler` yields the batch positions and `collate_fn` receives
+    the batched `(X_int, X_cat, y)` arrays. A streaming dataset yields
+    its batches itself and the batches of a `CriteoBatchCache` are
+    already collated, so `batch_size` has to be the batch size the
+    cache was written with.
+    """
+    # a dataset wrapped by a loader manager is dispatched on the
+    # dataset it currently holds
+    cache = getattr(data, "dataset", data)
+    if isinstance(cache, CriteoBatchCache):
+        if batch_size != cache.batch_size:
+            raise ValueError(
+                "batch size %d does not match the batch size %d of the "
+                "batch cache %s, set batch_cache_size to the loader's "
+                "batch size" % (batch_size, cache.batch_size, cache.prefix))
+        return torch.utils.data.DataLoader(
+            data,
+            sampler=_BatchOrderSampler(data, shuffle, drop_last),
+            batch_size=None,
+            **kwargs
+        )
+    if isinstance(data, IterableDataset):
+        return torch.utils.data.DataLoader(
+            data.batched(batch_size, shuffle=shuffle, drop_last=drop_last),
+            batch_size=None,
+            collate_fn=collate_fn,
+            **kwargs
+        )
+    if shuffle:
+        sampler = torch.utils.data.RandomSampler(data)
+    else:
+        sampler = torch.utils.data.SequentialSampler(data)
+    batch_sampler = torch.utils.data.BatchSampler(
+        sampler, batch_size=batch_size, drop_last=drop_last)
+    return torch.utils.data.DataLoader(
+        data,
+        sampler=batch_sampler,
+        batch_size=None,
+        collate_fn=collate_fn,
+        **kwargs
     )
 
-    lS_l = offset_to_length_converter(lS_o, lS_i)
-    return (X_int, lS_l, lS_i), T
+
+class CriteoBatchCache(Dataset):
+    """
+    Fixed-size batches of a split which were collated once by
+    `write_batch_cache` and are memory mapped from disk. Indexing returns
+    the `collate_wrapper_criteo_length` output of a batch as tensors
+    sharing memory with the cache, so an epoch is sequential reads only.
+
+    Arguments
+    ----------
+    prefix: str
+        Path prefix of the cache files.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # copy-on-write maps are writable views for `torch.from_numpy`
+        self.X_int, self.lS_i, self.T = (
+            np.load(batch_cache_file(prefix, name), mmap_mode="c")
+            for name in BATCH_CACHE_COLUMNS)
+        self.batch_size = self.lS_i.shape[2]
+        self.num_rows = len(self.T)
+        self.lS_l = torch.ones(
+            (self.lS_i.shape[1], self.batch_size), dtype=torch.int32)
+
+    @property
+    def num_full_batches(self):
+        return self.num_rows // self.batch_size
+
+    def __len__(self):
+        return len(self.lS_i)
+
+    def __getitem__(self, index):
+        start = index * self.batch_size
+        stop = min(start + self.batch_size, self.num_rows)
+        X_int = torch.from_numpy(self.X_int[start:stop])
+        T = torch.from_numpy(self.T[start:stop])
+        lS_i = torch.from_numpy(self.lS_i[index])
+        lS_l = self.lS_l
+        if stop - start < self.batch_size:
+            # the last batch is padded in the cache
+            lS_i = lS_i[:, :stop - start].contiguous()
+            lS_l = lS_l[:, :stop - start]
+        return (X_int, lS_l, lS_i), T
+
+
+def batch_cache_file(prefix, name):
+    return prefix + "_{0}.npy".format(name)
+
+
+def write_batch_cache(data, prefix, batch_size, index_dtype=np.int64):
+    """
+    Collates `data` in order into batches of `batch_size` rows and
+    writes them to `.npy` files under `prefix`: the log transformed dense
+    features (float32), the transposed categorical indices of every
+    batch (`index_dtype`, the last batch padded) and the targets.
+
+    Returns
+    ----------
+    paths: list
+        The written cache files.
+    """
+    num_rows = len(data)
+    num_batches = -(-num_rows // batch_size)
+    num_cat = data.X_cat.shape[1]
+    paths = [batch_cache_file(prefix, name) for name in BATCH_CACHE_COLUMNS]
+    tmp_paths = [atomic_path(path) for path in paths]
+    X_int, lS_i, T = (
+        np.lib.format.open_memmap(
+            path, mode="w+", dtype=dtype, shape=shape)
+        for path, dtype, shape in zip(tmp_paths, [
+            np.float32, index_dtype, np.float32], [
+            (num_rows, data.X_int.shape[1]),
+            (num_batches, num_cat, batch_size),
+            (num_rows, 1)]))
+
+    loader = batched_data_loader(
+        data, batch_size=batch_size,
+        collate_fn=collate_wrapper_criteo_length)
+    for b, ((dense, _, sparse), target) in enumerate(loader):
+        start = b * batch_size
+        X_int[start:start + len(target)] = dense.numpy()
+        lS_i[b, :, :len(target)] = sparse.numpy()
+        T[start:start + len(target)] = target.numpy()
+    del X_int, lS_i, T
+
+    for tmp, path in zip(tmp_paths, paths):
+        os.replace(tmp, path)
+    return paths
 
 
 def make_criteo_data_and_loaders(args, offset_to_length_converter=False):
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import zlib
+from contextlib import contextmanager
+
+# Manifest of a resumable preprocessing run.
+#
+# Every stage is recorded under a key which hashes everything the stage
+# depends on (parameters, input file signature and the checksums of the
+# upstream outputs). A stage is only skipped if its key is unchanged and
+# all its outputs are still the files that were recorded, so stale or
+# half written outputs are never reused.
+
+# number of bytes read at once when computing checksums
+CHECKSUM_BLOCK_SIZE = 1 << 24
+
+
+def atomic_path(path):
+    """
+    Temporary path next to `path` which keeps its extension (numpy
+    appends `.npy`/`.npz` to file names without one).
+    """
+    base, ext = os.path.splitext(path)
+    return base + ".tmp" + ext
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Yields a temporary path to write `path` to. The file is moved into
+    place only once the block finished without an exception.
+    """
+    tmp = atomic_path(path)
+    try:
+        yield tmp
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def file_checksum(path):
+    checksum = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(CHECKSUM_BLOCK_SIZE)
+            if not block:
+                break
+            checksum = zlib.crc32(block, checksum)
+    return "%08x" % checksum
+
+
+def hash_dict(values):
+    return hashlib.sha1(
+        json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PreprocessManifest:
+    """
+    JSON manifest stored at `path` which tracks the completed stages of
+    a preprocessing run.
+
+    Arguments
+    ----------
+    path: str
+        Location of the manifest file.
+    config: dict
+        Parameters of the run, recorded with their hash.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.config_hash = hash_dict(config)
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stages = json.load(f).get("stages", {})
+
+    def stage_key(self, **inputs):
+        return hash_dict(inputs)
+
+    def is_done(self, name, key):
+        """
+        Returns `True` if stage `name` completed with the same `key` and
+        its outputs are unchanged since.
+        """
+        stage = self.stages.get(name)
+        if stage is None or stage["key"] != key:
+            return False
+        for path, output in stage["outputs"].items():
+            if not os.path.exists(path) or \
+                    file_signature(path) != output["signature"]:
+                return False
+        return True
+
+    def checksums(self, name):
+        stage = self.stages[name]
+        return {os.path.basename(path): output["checksum"]
+                for path, output in stage["outputs"].items()}
+
+    def complete(self, name, key, outputs):
+        """
+        Records stage `name` as completed with `key` and checksums the
+        output files.
+        """
+        self.stages[name] = {
+            "key": key,
+            "outputs": {
+                path: {"signature": file_signature(path),
+                       "checksum": file_checksum(path)}
+                for path in outputs
+            }
+        }
+        self.save()
+
+    def save(self):
+        with atomic_write(self.path) as tmp:
+            with open(tmp, "w") as f:
+                json.dump({"config": self.config,
+                           "config_hash": self.config_hash,
+                           "stages": self.stages}, f, indent=2)
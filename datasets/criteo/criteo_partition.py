@@ -0,0 +1,79 @@
+import numpy as np
+
+# Partitioning of the Criteo splits across federated clients.
+#
+# Every scheme takes the row indices of one split and returns one sorted
+# index array per client, so the client shards are gathered from the
+# processed columns in storage order.
+
+PARTITIONS = ("iid", "dirichlet", "day")
+
+
+def partition_iid(indices, num_clients, rng):
+    """
+    Splits `indices` uniformly at random into `num_clients` parts of
+    (almost) equal size.
+    """
+    parts = np.array_split(rng.permutation(indices), num_clients)
+    return [np.sort(part) for part in parts]
+
+
+def partition_dirichlet(indices, labels, num_clients, alpha, rng):
+    """
+    Label skewed non-IID split: the rows of every label are divided
+    between the clients in proportions drawn from `Dir(alpha)`, smaller
+    `alpha` giving more skewed clients.
+    """
+    parts = [[] for _ in range(num_clients)]
+    for label in np.unique(labels):
+        label_indices = rng.permutation(indices[labels == label])
+        proportions = rng.dirichlet(np.full(num_clients, alpha))
+        cuts = (np.cumsum(proportions)[:-1] * len(label_indices)).astype(int)
+        for part, chunk in zip(parts, np.split(label_indices, cuts)):
+            part.append(chunk)
+    return [np.sort(np.concatenate(part)) for part in parts]
+
+
+def partition_by_day(indices, num_clients):
+    """
+    Splits `indices` into `num_clients` contiguous ranges of rows, so
+    every client holds a consecutive stretch of days.
+    """
+    return np.array_split(np.sort(indices), num_clients)
+
+
+def partition_indices(
+        partition, indices, labels, num_clients, alpha=0.5, rng=None):
+    """
+    Partitions the row `indices` of a split (with the targets `labels`
+    of those rows) into one index array per client.
+
+    Arguments
+    ----------
+    partition: str
+        One of `PARTITIONS`.
+    indices: np.ndarray
+        Row indices of the split.
+    labels: np.ndarray
+        Targets of the rows, used by the `dirichlet` scheme.
+    num_clients: int
+        Number of clients.
+    alpha: float
+        Concentration of the `dirichlet` scheme.
+    rng: np.random.RandomState, optional
+        Source of randomness.
+
+    Returns
+    ----------
+    parts: list
+        Sorted row indices of every client.
+    """
+    rng = rng if rng is not None else np.random.RandomState(0)
+    if partition == "iid":
+        return partition_iid(indices, num_clients, rng)
+    if partition == "dirichlet":
+        return partition_dirichlet(indices, labels, num_clients, alpha, rng)
+    if partition == "day":
+        return partition_by_day(indices, num_clients)
+    raise ValueError("unknown partition {0}, expected one of {1}".format(
+        partition, PARTITIONS))
@@ -1,12 +1,20 @@
-
+import csv
 import os
+import time
 from collections import defaultdict
 
 import numpy as np
-from datasets.criteo.criteo_dataset import (CriteoDataset,
-                                            collate_wrapper_criteo_length)
+import pandas as pd
+from datasets.criteo import criteo_partition, criteo_sharding
+from datasets.criteo.criteo_manifest import (PreprocessManifest, atomic_path,
+                                             atomic_write, file_signature)
+from datasets.criteo.criteo_dataset import (CriteoBatchCache, CriteoDataset,
+                                            CriteoStreamingDataset,
+                                            batched_data_loader,
+                                            collate_wrapper_criteo_length,
+                                            write_batch_cache)
 from fedrec.utilities import registry
-from torch.multiprocessing import Manager, Process
+from torch.multiprocessing import Process
 
 # Kaggle Display Advertising Challenge Dataset
 # dataset (str): name of dataset (Terabyte)
@@ -15,6 +23,30 @@ from torch.multiprocessing import Manager, Process
 #            "day": randomizes each day"s data (only works if split = True)
 #            "total": randomizes total dataset
 # split (bool) : to split into train, test, validation data-sets
+# num_clients (int): if positive, the processed data is partitioned into
+#            one shard per client and `load(client_id)` only reads the
+#            shard of that client
+# partition (str): how rows are assigned to clients
+#            "iid": uniformly at random
+#            "dirichlet": label skewed with proportions ~ Dir(alpha)
+#            "day": contiguous ranges of days
+# hash_ids (bool): skip the feature dictionaries and keep the raw 32-bit
+#            categorical ids, which are hashed by the embedding (e.g.
+#            "hash_emb") or folded with `max_ind_range`
+
+# number of raw lines parsed per block
+CHUNK_SIZE = 1 << 18
+
+SPLITS = ("train", "val", "test")
+
+# number of distinct raw categorical ids
+RAW_ID_RANGE = 1 << 32
+
+# lookup table from ascii code to hexadecimal digit value
+_HEX_LUT = np.zeros(256, dtype=np.uint8)
+_HEX_LUT[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+_HEX_LUT[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+_HEX_LUT[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
 
 
 @registry.load('dataset', 'kaggle')
@@ -27,15 +59,28 @@ class CriteoDataProcessor:
             sub_sample_rate=0.0,
             randomize="day",
             dataset_multiprocessing=False,
+            memory_map=False,
+            num_clients=0,
+            partition="iid",
+            partition_alpha=0.5,
+            partition_seed=0,
+            streaming=False,
+            shuffle_buffer_size=1 << 20,
+            batch_cache_size=0,
+            hash_ids=False,
     ):
         self.datafile = datafile
         self.output_file = output_file
+        # store the processed columns as raw .npy files which are
+        # memory mapped on load instead of a single compressed .npz
+        self.memory_map = memory_map
         lstr = datafile.split("/")
         self.d_path = "/".join(lstr[0:-1]) + "/"
         self.d_file = lstr[-1].split(".")[0]
         self.npzfile = self.d_path + (self.d_file + "_day")
         self.trafile = self.d_path + (self.d_file + "_fea")
         self.total_file = self.d_path + self.d_file + "_day_count.npz"
+        self.range_file = self.d_path + self.d_file + "_day_ranges.npz"
 
         self.dataset_multiprocessing = dataset_multiprocessing
         self.sub_sample_rate = sub_sample_rate
@@ -48,6 +93,21 @@ class CriteoDataProcessor:
         # tot_fea = tad_fea + spa_fea
         self.randomize = randomize
         self.max_ind_range = max_ind_range
+        # split the processed data into one shard per client, so a
+        # federated trainer only loads the rows of its own client
+        self.num_clients = num_clients
+        self.partition = partition
+        self.partition_alpha = partition_alpha
+        self.partition_seed = partition_seed
+        # stream the splits by day and shuffle them in a bounded buffer
+        # instead of permuting index arrays over all rows
+        self.streaming = streaming
+        self.shuffle_buffer_size = shuffle_buffer_size
+        # if positive, every split is collated once into batches of this
+        # size which are then read from a memory mapped cache
+        self.batch_cache_size = batch_cache_size
+        self.hash_ids = hash_ids
+        self._manifest = None
         self.clear_items()
 
     @staticmethod
@@ -59,259 +119,467 @@ class CriteoDataProcessor:
             dataset_multiprocessing,
             days,
             sub_sample_rate=0.0,
-            convertDictsDay=None,
-            resultDay=None
+            byte_range=None,
+            count_uniques=True,
+            chunk_size=CHUNK_SIZE
     ):
-        if dataset_multiprocessing:
-            convertDicts_day = [{} for _ in range(26)]
+        y = np.zeros(num_data_in_split, dtype="i4")  # 4 byte int
+        X_int = np.zeros((num_data_in_split, 13), dtype="i4")  # 4 byte int
+        X_cat = np.zeros((num_data_in_split, 26), dtype="i4")  # 4 byte int
+        if sub_sample_rate == 0.0:
+            rand_u = None
         else:
-            convertDicts = {}
-
-        with open(str(datfile)) as f:
-            y = np.zeros(num_data_in_split, dtype="i4")  # 4 byte int
-            X_int = np.zeros((num_data_in_split, 13), dtype="i4")  # 4 byte int
-            X_cat = np.zeros((num_data_in_split, 26), dtype="i4")  # 4 byte int
-            if sub_sample_rate == 0.0:
-                rand_u = 1.0
-            else:
-                rand_u = np.random.uniform(
-                    low=0.0, high=1.0, size=num_data_in_split)
-
-            i = 0
-            percent = 0
-            for k, line in enumerate(f):
-                # process a line (data point)
-                out = CriteoDataProcessor._transform_line(
-                    line,
-                    rand_u if sub_sample_rate == 0.0 else rand_u[k],
-                    sub_sample_rate)
-                if out is None:
-                    continue
-                y[i], X_int[i], X_cat[i] = out
-                # count uniques
-                if dataset_multiprocessing:
-                    for j in range(26):
-                        convertDicts_day[j][X_cat[i][j]] = 1
-                    # debug prints
-                    if float(i)/num_data_in_split*100 > percent+1:
-                        percent = int(float(i)/num_data_in_split*100)
-                        print(
-                            "Load %d/%d (%d%%) Split: %d  Label True: %d"
-                            % (i, num_data_in_split, percent, split, y[i],),
-                            end="\n",
-                        )
-                else:
-                    for j in range(26):
-                        convertDicts[j][X_cat[i][j]] = 1
-                    print(
-                        "Load %d/%d  Split: %d  Label True: %d"
-                        % (i, num_data_in_split, split, y[i],), end="\r",
-                    )
-                i += 1
-
-            filename_s = npzfile + "_{0}.npz".format(split)
-            if os.path.exists(filename_s):
-                print("\nSkip existing " + filename_s)
-            else:
-                np.savez_compressed(
-                    filename_s,
-                    X_int=X_int[0:i, :],
-                    X_cat_t=np.transpose(X_cat[0:i, :]),
-                    y=y[0:i],
-                )
-                print("\nSaved " + npzfile + "_{0}.npz!".format(split))
+            rand_u = np.random.uniform(
+                low=0.0, high=1.0, size=num_data_in_split)
+
+        i = 0
+        k = 0
+        start = time.time()
+        for y_c, X_int_c, X_cat_c in CriteoDataProcessor._read_chunks(
+                datfile, chunk_size, byte_range):
+            n = len(y_c)
+            # sub-sample data by dropping zero targets, if needed
+            if rand_u is not None:
+                keep = (y_c != 0) | (rand_u[k:k + n] >= sub_sample_rate)
+                y_c, X_int_c, X_cat_c = y_c[keep], X_int_c[keep], X_cat_c[keep]
+            k += n
+            m = len(y_c)
+            y[i:i + m] = y_c
+            X_int[i:i + m] = X_int_c
+            X_cat[i:i + m] = X_cat_c
+            i += m
+            elapsed = time.time() - start
+            print(
+                "Load %d/%d  Split: %d  (%.0f rows/s)"
+                % (k, num_data_in_split, split, k / max(elapsed, 1e-9)),
+                end="\n" if dataset_multiprocessing else "\r",
+            )
 
-        if dataset_multiprocessing:
-            resultDay[split] = i
-            convertDictsDay[split] = convertDicts_day
-            return
-        else:
+        elapsed = time.time() - start
+        print("\nParsed %d rows of split %d in %.2fs (%.0f rows/s)"
+              % (k, split, elapsed, k / max(elapsed, 1e-9)))
+
+        filename_s = npzfile + "_{0}.npz".format(split)
+        with atomic_write(filename_s) as tmp:
+            np.savez_compressed(
+                tmp,
+                X_int=X_int[0:i, :],
+                X_cat_t=np.transpose(X_cat[0:i, :]),
+                y=y[0:i],
+            )
+        print("\nSaved " + filename_s + "!")
+
+        if not count_uniques:
             return i
+        # count uniques, the sorted unique values of every categorical
+        # feature are handed back to the parent process through a file
+        with atomic_write(npzfile + "_{0}_unique.npz".format(split)) as tmp:
+            np.savez(
+                tmp,
+                num_rows=i,
+                **{"unique_{0}".format(j): np.unique(X_cat[0:i, j])
+                   for j in range(26)}
+            )
+        return i
 
     @staticmethod
-    def _transform_line(line, rand_u, sub_sample_rate):
-        line = line.split('\t')
-        # set missing values to zero
-        for j in range(len(line)):
-            if (line[j] == '') or (line[j] == '\n'):
-                line[j] = '0'
-        # sub-sample data by dropping zero targets, if needed
-        target = np.int32(line[0])
-        if target == 0 and rand_u < sub_sample_rate:
-            return None
-
-        return (target,
-                np.array(line[1:14], dtype=np.int32),
-                np.array(
-                    list(map(lambda x: int(x, 16), line[14:])),
-                    dtype=np.int32)
-                )
+    def _read_chunks(datfile, chunk_size=CHUNK_SIZE, byte_range=None):
+        """
+        Parses a raw Criteo TSV file in blocks of `chunk_size` lines
+        using the pandas C reader and yields `(y, X_int, X_cat)` arrays
+        per block. Missing values are set to zero and the hexadecimal
+        categorical hashes are decoded into (wrapped) int32 values, which
+        matches parsing every line with `int(x, 16)`.
+
+        If `byte_range` is given as `(start, end)` only the lines in
+        that (newline aligned) range of the file are parsed, straight
+        from a memory map of the raw file.
+        """
+        if byte_range is None:
+            yield from CriteoDataProcessor._parse_chunks(datfile, chunk_size)
+            return
+        start, end = byte_range
+        with criteo_sharding.open_range(datfile, start, end) as f:
+            yield from CriteoDataProcessor._parse_chunks(f, chunk_size)
+
+    @staticmethod
+    def _parse_chunks(f, chunk_size):
+        reader = pd.read_csv(
+            f,
+            sep="\t",
+            header=None,
+            names=list(range(40)),
+            dtype={**{j: np.float64 for j in range(14)},
+                   **{j: object for j in range(14, 40)}},
+            keep_default_na=False,
+            na_values=[""],
+            quoting=csv.QUOTE_NONE,
+            engine="c",
+            chunksize=chunk_size,
+        )
+        for chunk in reader:
+            dense = chunk.iloc[:, 0:14].fillna(0).to_numpy(np.int64)
+            X_cat = np.empty((len(chunk), 26), dtype=np.int32)
+            for j in range(26):
+                X_cat[:, j] = CriteoDataProcessor._decode_hex(
+                    chunk.iloc[:, 14 + j].fillna("").to_numpy())
+            yield (dense[:, 0].astype(np.int32),
+                   dense[:, 1:14].astype(np.int32),
+                   X_cat)
+
+    @staticmethod
+    def _decode_hex(values):
+        """
+        Decodes an array of hexadecimal strings into int32 values
+        (wrapping on overflow like `np.int32(int(x, 16))`). Empty
+        strings decode to zero.
+        """
+        chars = np.asarray(values, dtype=np.bytes_)
+        width = chars.dtype.itemsize
+        chars = chars.view(np.uint8).reshape(len(chars), width)
+        out = np.zeros(len(chars), dtype=np.uint64)
+        for c in range(width):
+            col = chars[:, c]
+            valid = col != 0
+            out[valid] = (out[valid] << np.uint64(4)) \
+                | _HEX_LUT[col[valid]].astype(np.uint64)
+        return out.astype(np.uint32).view(np.int32)
 
     def clear_items(self):
         self.data_items = defaultdict(dict)
+        self.loaded_client = None
         self.ln_emb = None
         self.m_den = None
         self.n_emb = None
 
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = PreprocessManifest(
+                self.d_path + self.d_file + "_manifest.json",
+                config={
+                    "datafile": self.datafile,
+                    "output_file": self.output_file,
+                    "days": self.days,
+                    "sub_sample_rate": self.sub_sample_rate,
+                    "max_ind_range": self.max_ind_range,
+                    "memory_map": self.memory_map,
+                    "hash_ids": self.hash_ids,
+                })
+        return self._manifest
+
     def process_data(self):
-        _, total_per_file = self.get_counts()
-        self.split_dataset(total_per_file)
+        output = self.process_days()
+        if self.num_clients > 0:
+            self.partition_data()
+        return output
 
-        convertDicts = self.process_files(
-            self.datafile,
-            self.total_file,
-            total_per_file, self.dataset_multiprocessing
-        )
+    def process_days(self):
+        # every stage is recorded in the manifest and only rerun if its
+        # inputs changed, so an interrupted run resumes where it stopped.
+        # The raw file is only scanned once for the day boundaries, every
+        # day is then parsed in place from its byte range.
+        _, total_per_file, day_offsets = self.get_counts()
 
-        # dictionary files
-        counts = np.zeros(26, dtype=np.int32)
-        # create dictionaries
-        for j in range(26):
-            for i, x in enumerate(convertDicts[j]):
-                convertDicts[j][x] = i
-            dict_file_j = self.d_path + self.d_file + \
-                "_fea_dict_{0}.npz".format(j)
-            if not os.path.exists(dict_file_j):
-                np.savez_compressed(
-                    dict_file_j,
-                    unique=np.array(list(convertDicts[j]), dtype=np.int32)
-                )
-            counts[j] = len(convertDicts[j])
-        # store (uniques and) counts
-        count_file = self.d_path + self.d_file + "_fea_count.npz"
-        if not os.path.exists(count_file):
-            np.savez_compressed(count_file, counts=counts)
+        uniques, counts, total_per_file = self.process_files(
+            total_per_file, day_offsets)
 
         # process all splits
+        if self.memory_map:
+            return self.process_columns(uniques, counts, total_per_file)
+
+        dicts = self.dictionaries_key()
+        keys = {
+            i: self.manifest.stage_key(
+                dictionaries=dicts,
+                parsed=self.manifest.checksums("parse_%d" % i))
+            for i in range(self.days)
+        }
+        todo = [i for i in range(self.days)
+                if not self.manifest.is_done("process_%d" % i, keys[i])]
+        self._map_days(
+            CriteoDataProcessor.processCriteoAdData,
+            "processCriteoAdData",
+            {i: (self.npzfile, i, uniques) for i in todo})
+        for i in todo:
+            self.manifest.complete(
+                "process_%d" % i, keys[i],
+                [self.npzfile + "_{0}_processed.npz".format(i)])
+
+        key = self.manifest.stage_key(
+            processed=[self.manifest.checksums("process_%d" % i)
+                       for i in range(self.days)],
+            max_ind_range=self.max_ind_range)
+        stage = "concat:" + self.output_file
+        if self.manifest.is_done(stage, key):
+            print("Using existing " + self.processed_file)
+            self.set_data_description(self.den_fea, counts)
+            return self.processed_file
+        output = self.concat_data(self.output_file)
+        self.manifest.complete(stage, key, [
+            output, self.description_file(self.output_file)])
+        return output
+
+    def process_columns(self, uniques, counts, total_per_file):
+        """
+        Remaps all days straight into the final memory mapped columns,
+        every day is written at its row offset by its own worker.
+        """
+        key = self.manifest.stage_key(
+            dictionaries=self.dictionaries_key(),
+            parsed=[self.manifest.checksums("parse_%d" % i)
+                    for i in range(self.days)],
+            max_ind_range=self.max_ind_range)
+        stage = "columns:" + self.output_file
+        names = ("X_int", "X_cat", "y", "counts")
+        outputs = [self.column_file(self.output_file, name) for name in names]
+        outputs.append(self.description_file(self.output_file))
+        if self.manifest.is_done(stage, key):
+            print("Using existing " + self.d_path + self.output_file)
+            self.set_data_description(self.den_fea, counts)
+            return self.d_path + self.output_file
+
+        # the columns are filled under temporary names and only moved
+        # into place once every day was written
+        columns = {name: atomic_path(self.column_file(self.output_file, name))
+                   for name in names}
+        row_offsets = np.cumsum([0] + list(total_per_file))
+        self.allocate_columns(columns, int(row_offsets[-1]))
+        self._map_days(
+            CriteoDataProcessor.processCriteoAdData,
+            "processCriteoAdData",
+            {i: (self.npzfile, i, uniques, columns, int(row_offsets[i]))
+             for i in range(self.days)})
+        np.save(columns["counts"], counts)
+        for name in names:
+            os.replace(columns[name], self.column_file(self.output_file, name))
+        self.save_data_description(self.output_file, self.den_fea, counts)
+        self.manifest.complete(stage, key, outputs)
+        return self.d_path + self.output_file
+
+    def _map_days(self, target, name, args):
+        # run `target(*args[day])` for the given days, in parallel if
+        # multiprocessing is on
         if self.dataset_multiprocessing:
             processes = [
                 Process(
-                    target=CriteoDataProcessor.processCriteoAdData,
-                    name="processCriteoAdData:%i" % i,
-                    args=(self.npzfile, i, self.days, convertDicts)
-                ) for i in range(0, self.days)
+                    target=target,
+                    name="%s:%i" % (name, i),
+                    args=day_args
+                ) for i, day_args in args.items()
             ]
             for process in processes:
                 process.start()
             for process in processes:
                 process.join()
+            failed = [p.name for p in processes if p.exitcode != 0]
+            if failed:
+                raise RuntimeError("processes failed: %s" % failed)
         else:
-            for i in range(self.days):
-                CriteoDataProcessor.processCriteoAdData(
-                    self.npzfile, i, self.days, convertDicts)
-
-        return self.concat_data(self.output_file)
-
-    def split_dataset(self, total_per_file):
-        # split into days (simplifies code later on)
-        file_id = 0
-        boundary = total_per_file[file_id]
-        nf = open(self.npzfile + "_" + str(file_id), "w")
-        with open(str(self.datafile)) as f:
-            for j, line in enumerate(f):
-                if j == boundary:
-                    nf.close()
-                    file_id += 1
-                    nf = open(self.npzfile + "_" + str(file_id), "w")
-                    boundary += total_per_file[file_id]
-                nf.write(line)
-        nf.close()
+            for day_args in args.values():
+                target(*day_args)
 
     def get_counts(self):
-        if os.path.exists(self.total_file):
-            with np.load(self.total_file) as data:
+        """
+        Counts the lines of the raw file and splits them into `days`
+        consecutive days of (nearly) equal size. Every day is described
+        by the byte offsets of its first and last line in the raw file,
+        so the days never have to be rewritten into separate files.
+        """
+        key = self.manifest.stage_key(
+            input=file_signature(self.datafile), days=self.days)
+        if self.manifest.is_done("day_ranges", key):
+            with np.load(self.range_file) as data:
                 total_per_file = list(data["total_per_file"])
+                day_offsets = data["day_offsets"]
             total_count = np.sum(total_per_file)
             print("Skipping counts per file (already exist)")
-        else:
-            total_count = 0
-            total_per_file = []
-            print("Reading data from path=%s" % (self.datafile))
-            with open(str(self.datafile)) as f:
-                for _ in f:
-                    total_count += 1
-            total_per_file.append(total_count)
-            # reset total per file due to split
-            num_data_per_split, extras = divmod(total_count, self.days)
-            total_per_file = [num_data_per_split] * self.days
-            for j in range(extras):
-                total_per_file[j] += 1
-        return total_count, total_per_file
-
-    def process_files(
-        self, total_count,
-        total_file, total_per_file, dataset_multiprocessing
-    ):
-        convertDicts = [{} for _ in range(26)]
-        if dataset_multiprocessing:
-            resultDay = Manager().dict()
-            convertDictsDay = Manager().dict()
-            processes = [Process(target=CriteoDataProcessor._process_one_file,
-                                 name="process_one_file:%i" % i,
-                                 args=(self.npzfile + "_{0}".format(i),
-                                       self.npzfile,
-                                       i,
-                                       total_per_file[i],
-                                       dataset_multiprocessing,
-                                       self.days
-                                       ),
-                                 kwargs={
-                                     "sub_sample_rate": self.sub_sample_rate,
-                                     "convertDictsDay": convertDictsDay,
-                                     "resultDay": resultDay
-                                 }) for i in range(0, self.days)]
-            for process in processes:
-                process.start()
-            for process in processes:
-                process.join()
+            return total_count, total_per_file, day_offsets
+
+        print("Reading data from path=%s" % (self.datafile))
+        # count the newlines of byte shards of the file in parallel
+        num_shards = os.cpu_count() if self.dataset_multiprocessing else 1
+        bounds, shard_counts, total_count = criteo_sharding.shard_file(
+            self.datafile, num_shards)
+
+        # reset total per file due to split
+        num_data_per_split, extras = divmod(total_count, self.days)
+        total_per_file = [num_data_per_split] * self.days
+        for j in range(extras):
+            total_per_file[j] += 1
+
+        # byte offsets of the first line of every day
+        day_offsets = criteo_sharding.line_offsets(
+            self.datafile, bounds, shard_counts,
+            [0] + list(np.cumsum(total_per_file)[:-1]))
+        day_offsets = np.array(day_offsets + [bounds[-1]], dtype=np.int64)
+        with atomic_write(self.range_file) as tmp:
+            np.savez(tmp,
+                     total_per_file=total_per_file, day_offsets=day_offsets)
+        self.manifest.complete("day_ranges", key, [self.range_file])
+        return total_count, total_per_file, day_offsets
+
+    def dictionaries_key(self):
+        # the remapped days depend on the dictionaries, or on none
+        if self.hash_ids:
+            return "hash_ids"
+        return self.manifest.checksums("dictionaries")
+
+    def process_files(self, total_per_file, day_offsets):
+        """
+        Parses every day from its byte range and builds the feature
+        dictionaries from the sorted uniques of all days. With
+        `hash_ids` the dictionaries are skipped.
+
+        Returns
+        ----------
+        uniques: list
+            Sorted unique values of every categorical feature, `None`
+            with `hash_ids`.
+        counts: np.ndarray
+            Number of unique values of every categorical feature.
+        total_per_file: list
+            Number of (sub-sampled) samples per day.
+        """
+        total_per_file = list(total_per_file)
+        ranges = self.manifest.checksums("day_ranges")
+        keys = {
+            i: self.manifest.stage_key(
+                day_ranges=ranges, sub_sample_rate=self.sub_sample_rate,
+                hash_ids=self.hash_ids)
+            for i in range(self.days)
+        }
+        todo = [i for i in range(self.days)
+                if not self.manifest.is_done("parse_%d" % i, keys[i])]
+        self._map_days(
+            CriteoDataProcessor._process_one_file,
+            "process_one_file",
+            {i: (self.datafile,
+                 self.npzfile,
+                 i,
+                 total_per_file[i],
+                 self.dataset_multiprocessing,
+                 self.days,
+                 self.sub_sample_rate,
+                 (day_offsets[i], day_offsets[i + 1]),
+                 # the uniques are only needed for the dictionaries
+                 not self.hash_ids)
+             for i in todo})
+        for i in todo:
+            outputs = [self.npzfile + "_{0}.npz".format(i)]
+            if not self.hash_ids:
+                outputs.append(self.npzfile + "_{0}_unique.npz".format(i))
+            self.manifest.complete("parse_%d" % i, keys[i], outputs)
+
+        if self.hash_ids:
+            # no dictionaries, only the number of (sub-sampled) rows of
+            # every day is recorded for `load`
+            key = self.manifest.stage_key(
+                parsed=[self.manifest.checksums("parse_%d" % i)
+                        for i in range(self.days)])
+            if self.manifest.is_done("day_counts", key):
+                with np.load(self.total_file) as data:
+                    total_per_file = list(data["total_per_file"])
+                return None, self.load_counts(), total_per_file
             for day in range(self.days):
-                total_per_file[day] = resultDay[day]
-                print("Constructing convertDicts Split: {}".format(day))
-                convertDicts_tmp = convertDictsDay[day]
-                for i in range(26):
-                    for j in convertDicts_tmp[i]:
-                        convertDicts[i][j] = 1
-        else:
-            for i in range(self.days):
-                total_per_file[i] = CriteoDataProcessor._process_one_file(
-                    self.npzfile + "_{0}".format(i),
-                    self.npzfile,
-                    i,
-                    total_per_file[i],
-                    dataset_multiprocessing,
-                )
-                # report and save total into a file
+                with np.load(self.npzfile + "_{0}.npz".format(day)) as data:
+                    total_per_file[day] = len(data["y"])
+            with atomic_write(self.total_file) as tmp:
+                np.savez_compressed(tmp, total_per_file=total_per_file)
+            self.manifest.complete("day_counts", key, [self.total_file])
+            return None, self.load_counts(), total_per_file
+
+        dict_files = [
+            self.d_path + self.d_file + "_fea_dict_{0}.npz".format(j)
+            for j in range(26)]
+        count_file = self.d_path + self.d_file + "_fea_count.npz"
+        key = self.manifest.stage_key(
+            parsed=[self.manifest.checksums("parse_%d" % i)
+                    for i in range(self.days)])
+        if self.manifest.is_done("dictionaries", key):
+            print("Using existing feature dictionaries")
+            uniques = []
+            for dict_file_j in dict_files:
+                with np.load(dict_file_j) as data:
+                    uniques.append(data["unique"])
+            with np.load(self.total_file) as data:
+                total_per_file = list(data["total_per_file"])
+            return uniques, self.load_counts(), total_per_file
+
+        # merge the sorted per day uniques of every feature
+        day_uniques = [[] for _ in range(26)]
+        for day in range(self.days):
+            print("Constructing convertDicts Split: {}".format(day))
+            with np.load(self.npzfile + "_{0}_unique.npz".format(day)) as data:
+                total_per_file[day] = int(data["num_rows"])
+                for j in range(26):
+                    day_uniques[j].append(data["unique_{0}".format(j)])
+        uniques = [np.unique(np.concatenate(u)) for u in day_uniques]
         total_count = np.sum(total_per_file)
-        if not os.path.exists(total_file):
-            np.savez_compressed(total_file, total_per_file=total_per_file)
         print("Total number of samples:", total_count)
         print("Divided into days/splits:\n", total_per_file)
-        return convertDicts
 
-    def processCriteoAdData(npzfile, i, days, convertDicts):
-        filename_i = npzfile + "_{0}_processed.npz".format(i)
+        # dictionary files
+        counts = np.zeros(26, dtype=np.int32)
+        # create dictionaries
+        for j in range(26):
+            with atomic_write(dict_files[j]) as tmp:
+                np.savez_compressed(tmp, unique=uniques[j])
+            counts[j] = len(uniques[j])
+        # store (uniques and) counts
+        with atomic_write(count_file) as tmp:
+            np.savez_compressed(tmp, counts=counts)
+        with atomic_write(self.total_file) as tmp:
+            np.savez_compressed(tmp, total_per_file=total_per_file)
+        self.manifest.complete(
+            "dictionaries", key, dict_files + [count_file, self.total_file])
+        return uniques, counts, total_per_file
 
-        if os.path.exists(filename_i):
-            print("Using existing " + filename_i, end="\n")
-            return
-        print("Not existing " + filename_i)
+    @staticmethod
+    def processCriteoAdData(npzfile, i, uniques, columns=None, offset=0):
+        """
+        Remaps the categorical values of day `i`. The day is saved to its
+        own `_processed.npz` file, or written into the memory mapped
+        `.npy` files `columns` starting at row `offset`. Without `uniques`
+        the raw values are kept.
+        """
+        filename_i = npzfile + "_{0}_processed.npz".format(i)
         with np.load(npzfile + "_{0}.npz".format(i)) as data:
             # categorical features
-            # Approach 2a: using pre-computed dictionaries
-            X_cat_t = np.zeros(data["X_cat_t"].shape)
-            for j in range(days):
-                for k, x in enumerate(data["X_cat_t"][j, :]):
-                    X_cat_t[j, k] = convertDicts[j][x]
+            # Approach 2a: using pre-computed dictionaries, the raw
+            # values are mapped to their position in the sorted uniques
+            X_cat_raw = data["X_cat_t"]
+            if uniques is None:
+                X_cat_t = X_cat_raw
+            else:
+                X_cat_t = np.empty(X_cat_raw.shape, dtype=np.int32)
+                for j in range(X_cat_raw.shape[0]):
+                    X_cat_t[j] = np.searchsorted(uniques[j], X_cat_raw[j])
             # continuous features
             X_int = data["X_int"]
             X_int[X_int < 0] = 0
 
-            np.savez_compressed(
-                filename_i,
-                X_cat=np.transpose(X_cat_t),  # transpose of the data
-                X_int=X_int,
-                y=data["y"],
-            )
+            if columns is not None:
+                day_columns = {
+                    "X_cat": np.transpose(X_cat_t),
+                    "X_int": X_int,
+                    "y": data["y"],
+                }
+                for name, column in day_columns.items():
+                    out = np.load(columns[name], mmap_mode="r+")
+                    out[offset:offset + len(column)] = column
+                    out.flush()
+                    del out
+                print("Processed day %d into the columns" % i)
+                return
+
+            with atomic_write(filename_i) as tmp:
+                np.savez_compressed(
+                    tmp,
+                    X_cat=np.transpose(X_cat_t),  # transpose of the data
+                    X_int=X_int,
+                    y=data["y"],
+                )
         print("Processed " + filename_i, end="\n")
 
     def concat_data(self, o_filename):
@@ -333,18 +601,48 @@ class CriteoDataProcessor:
             print("Loaded day:", i, "y = 1:", len(
                 y[y == 1]), "y = 0:", len(y[y == 0]))
 
+        counts = self.load_counts()
+        with atomic_write(self.d_path + o_filename + ".npz") as tmp:
+            np.savez_compressed(
+                tmp,
+                X_cat=X_cat,
+                X_int=X_int,
+                y=y,
+                counts=counts,
+            )
+        self.save_data_description(o_filename, X_int.shape[1], counts)
+        return self.d_path + o_filename + ".npz"
+
+    def allocate_columns(self, columns, total):
+        """
+        Creates the raw `.npy` files `columns` of the memory mapped
+        format, the processed days are written into them in place.
+        """
+        print("Allocating %d rows in %s" % (total, self.d_path))
+        shapes = {
+            "X_int": (total, self.den_fea),
+            "X_cat": (total, 26),
+            "y": (total,),
+        }
+        for name, shape in shapes.items():
+            column = np.lib.format.open_memmap(
+                columns[name], mode="w+", dtype=np.int32, shape=shape)
+            del column
+
+    def column_file(self, o_filename, name):
+        return self.d_path + o_filename + "_{0}.npy".format(name)
+
+    def load_counts(self):
+        if self.hash_ids:
+            # every raw id is a possible value
+            return np.full(26, RAW_ID_RANGE, dtype=np.int64)
         with np.load(self.d_path + self.d_file + "_fea_count.npz") as data:
             counts = data["counts"]
         print("Loaded counts!")
+        return counts
 
-        np.savez_compressed(
-            self.d_path + o_filename + ".npz",
-            X_cat=X_cat,
-            X_int=X_int,
-            y=y,
-            counts=counts,
-        )
-        self.m_den = X_int.shape[1]  # den_fea
+    def set_data_description(self, m_den, counts):
+        self.m_den = m_den  # den_fea
         self.n_emb = len(counts)
         # enforce maximum limit on number of vectors per embedding
         if self.max_ind_range > 0:
@@ -355,31 +653,61 @@ class CriteoDataProcessor:
         else:
             self.ln_emb = np.array(counts)
 
-        np.savez_compressed(self.d_path + o_filename + "_data_description.npz",
-                            m_den=self.m_den,
-                            n_emb=self.n_emb,
-                            ln_emb=self.ln_emb)
-        return self.d_path + o_filename + ".npz"
+    def description_file(self, o_filename):
+        return self.d_path + o_filename + "_data_description.npz"
+
+    def save_data_description(self, o_filename, m_den, counts):
+        self.set_data_description(m_den, counts)
+        with atomic_write(self.description_file(o_filename)) as tmp:
+            np.savez_compressed(tmp,
+                                m_den=self.m_den,
+                                n_emb=self.n_emb,
+                                ln_emb=self.ln_emb)
+
+    @property
+    def processed_file(self):
+        if self.memory_map:
+            return self.column_file(self.output_file, "counts")
+        return str(self.d_path + self.output_file + ".npz")
 
     def load_data_description(self):
-        if not os.path.exists(str(self.d_path + self.output_file + ".npz")):
+        if not os.path.exists(self.processed_file):
             assert False, "data not processed"
 
-        with np.load(self.d_path + self.output_file
-                     + "_data_description.npz") as data:
+        with np.load(self.description_file(self.output_file)) as data:
             self.m_den = data["m_den"]
             self.n_emb = data["n_emb"]
             self.ln_emb = data["ln_emb"]
 
-    def load(self):
-        if not os.path.exists(str(self.d_path + self.output_file + ".npz")):
+    def load_arrays(self):
+        """
+        Returns the processed `(X_int, X_cat, y, counts)` arrays. With
+        `memory_map` the columns are opened read-only with `np.memmap`,
+        so pages are only read from disk once they are accessed.
+        """
+        if self.memory_map:
+            X_int, X_cat, y, counts = (
+                np.load(self.column_file(self.output_file, name),
+                        mmap_mode="r")
+                for name in ("X_int", "X_cat", "y", "counts"))
+            return X_int, X_cat, y, np.array(counts)
+
+        with np.load(self.processed_file) as data:
+            X_int = data["X_int"]  # continuous  feature
+            X_cat = data["X_cat"]  # categorical feature
+            y = data["y"]          # target
+            counts = data["counts"]
+        return X_int, X_cat, y, counts
+
+    def load(self, client_id=None):
+        if client_id is not None and self.num_clients > 0:
+            return self.load_client(client_id)
+        self.loaded_client = None
+        if not os.path.exists(self.processed_file):
             assert False, "data not processed"
 
-        # pre-process data if needed
-        # WARNNING: when memory mapping is used we get a collection of files
         print("Reading pre-processed data=%s" %
-              (str(self.d_path + self.output_file + ".npz")))
-        file = str(self.d_path + self.output_file + ".npz")
+              (str(self.d_path + self.output_file)))
 
         # get a number of samples per day
         total_file = self.d_path + self.d_file + "_day_count.npz"
@@ -391,30 +719,136 @@ class CriteoDataProcessor:
             offset_per_file[i + 1] += offset_per_file[i]
 
         # load and preprocess data
-        with np.load(file) as data:
-            X_int = data["X_int"]  # continuous  feature
-            X_cat = data["X_cat"]  # categorical feature
-            y = data["y"]          # target
-            counts = data["counts"]
+        X_int, X_cat, y, counts = self.load_arrays()
+        self.set_data_description(X_int.shape[1], counts)
+        print("Sparse fea = %d, Dense fea = %d" % (self.n_emb, self.m_den))
 
-        self.m_den = X_int.shape[1]  # den_fea
-        self.n_emb = len(counts)
-        # enforce maximum limit on number of vectors per embedding
-        if self.max_ind_range > 0:
-            self.ln_emb = np.array(list(map(
-                lambda x: x if x < self.max_ind_range else self.max_ind_range,
-                self.counts))
-            )
-        else:
-            self.ln_emb = np.array(counts)
+        if self.streaming:
+            for split, shards in self.split_shards(offset_per_file).items():
+                self.data_items[split] = {
+                    "X_int": X_int, "X_cat": X_cat, "y": y,
+                    "shards": shards}
+            return
 
         indices = self.permute_data(len(y), offset_per_file)
-        print("Sparse fea = %d, Dense fea = %d" % (self.n_emb, self.m_den))
 
+        # every split shares the backing arrays and only keeps its indices
         for split, indxs in indices.items():
-            self.data_items[split]["X_int"] = [X_int[i] for i in indxs]
-            self.data_items[split]["X_cat"] = [X_cat[i] for i in indxs]
-            self.data_items[split]["y"] = [y[i] for i in indxs]
+            self.data_items[split]["X_int"] = X_int
+            self.data_items[split]["X_cat"] = X_cat
+            self.data_items[split]["y"] = y
+            self.data_items[split]["indices"] = indxs
+
+    def processed_files(self):
+        # the files holding the processed rows
+        if self.memory_map:
+            return [self.column_file(self.output_file, name)
+                    for name in ("X_int", "X_cat", "y")]
+        return [self.processed_file]
+
+    @property
+    def partition_file(self):
+        return self.d_path + self.output_file + "_clients.npz"
+
+    def client_file(self, client_id):
+        return self.d_path + self.output_file + \
+            "_client_{0}.npz".format(client_id)
+
+    def partition_data(self):
+        """
+        Partitions every split between `num_clients` clients and writes
+        the rows of each client into its own shard, along with an index
+        file holding the split sizes of all clients. Only one shard is
+        gathered in memory at a time.
+        """
+        key = self.manifest.stage_key(
+            processed=[file_signature(f) for f in self.processed_files()],
+            num_clients=self.num_clients,
+            partition=self.partition,
+            partition_alpha=self.partition_alpha,
+            partition_seed=self.partition_seed)
+        stage = "partition:" + self.output_file
+        if self.manifest.is_done(stage, key):
+            print("Using existing " + self.partition_file)
+            return self.partition_file
+
+        # the clients are partitioned from the index splits, also when
+        # the whole dataset is streamed
+        streaming, self.streaming = self.streaming, False
+        try:
+            self.load()
+        finally:
+            self.streaming = streaming
+        rng = np.random.RandomState(self.partition_seed)
+        parts = {}
+        for split in SPLITS:
+            indices = self.data_items[split]["indices"][:]
+            parts[split] = criteo_partition.partition_indices(
+                self.partition, indices,
+                self.data_items[split]["y"][indices],
+                self.num_clients, self.partition_alpha, rng)
+
+        X_int, X_cat, y = (self.data_items["train"][name]
+                           for name in ("X_int", "X_cat", "y"))
+        split_counts = np.array(
+            [[len(parts[split][k]) for split in SPLITS]
+             for k in range(self.num_clients)], dtype=np.int64)
+        for k in range(self.num_clients):
+            rows = np.concatenate([parts[split][k] for split in SPLITS])
+            with atomic_write(self.client_file(k)) as tmp:
+                np.savez(tmp, X_int=X_int[rows], X_cat=X_cat[rows],
+                         y=y[rows], split_counts=split_counts[k])
+        with atomic_write(self.partition_file) as tmp:
+            np.savez(tmp, split_counts=split_counts)
+        self.clear_items()
+
+        self.manifest.complete(stage, key, [self.partition_file] + [
+            self.client_file(k) for k in range(self.num_clients)])
+        return self.partition_file
+
+    def load_client(self, client_id):
+        """
+        Loads the shard of `client_id` written by `partition_data`, the
+        rows of the other clients are never read.
+        """
+        if not os.path.exists(self.partition_file):
+            assert False, "data not partitioned"
+        with np.load(self.partition_file) as data:
+            num_clients = len(data["split_counts"])
+        if not 0 <= client_id < num_clients:
+            raise ValueError("client_id {0} out of range for {1} clients"
+                             .format(client_id, num_clients))
+
+        print("Reading client %d data=%s" %
+              (client_id, self.client_file(client_id)))
+        self.loaded_client = client_id
+        with np.load(self.client_file(client_id)) as data:
+            X_int, X_cat, y = data["X_int"], data["X_cat"], data["y"]
+            offsets = np.cumsum(np.concatenate([[0], data["split_counts"]]))
+        self.load_data_description()
+
+        for i, split in enumerate(SPLITS):
+            indices = np.arange(offsets[i], offsets[i + 1])
+            if split == "train" and self.randomize != "none":
+                indices = np.random.permutation(indices)
+            self.data_items[split] = {
+                "X_int": X_int, "X_cat": X_cat, "y": y, "indices": indices}
+
+    def split_shards(self, offset_per_file):
+        """
+        Returns the contiguous row ranges of every split: all days but
+        the last are used for training, the last day is halved into
+        test and val (as in `permute_data`).
+        """
+        last = len(offset_per_file) - 2
+        middle = offset_per_file[last] + \
+            (offset_per_file[-1] - offset_per_file[last] + 1) // 2
+        return {
+            "train": [(int(offset_per_file[i]), int(offset_per_file[i + 1]))
+                      for i in range(last)],
+            "val": [(int(middle), int(offset_per_file[-1]))],
+            "test": [(int(offset_per_file[last]), int(middle))],
+        }
 
     def permute_data(self, length, offset_per_file):
         indices = np.arange(length)
@@ -440,11 +874,54 @@ class CriteoDataProcessor:
                 'test': test_indices}
 
     def dataset(self, split):
-        return CriteoDataset(
+        if "shards" in self.data_items[split]:
+            buffer_size = self.shuffle_buffer_size \
+                if self.randomize != "none" else 0
+            return CriteoStreamingDataset(
+                max_ind_range=self.max_ind_range,
+                buffer_size=buffer_size,
+                **self.data_items[split]
+            )
+        data = CriteoDataset(
             max_ind_range=self.max_ind_range,
             **self.data_items[split]
         )
+        if self.batch_cache_size > 0:
+            return self.batch_cache(split, data)
+        return data
+
+    def batch_cache(self, split, data):
+        """
+        Returns the pre-collated batches of `split`, which are written on
+        first use (and whenever the processed data changed). A randomized
+        split is cached in the order of its first load, the loader then
+        shuffles the order of the batches.
+        """
+        inputs = [file_signature(f) for f in self.processed_files()]
+        name = self.output_file
+        if self.loaded_client is not None:
+            inputs.append(file_signature(
+                self.client_file(self.loaded_client)))
+            name += "_client_{0}".format(self.loaded_client)
+        name += "_{0}_batches".format(split)
+        key = self.manifest.stage_key(
+            processed=inputs,
+            batch_size=self.batch_cache_size,
+            randomize=self.randomize,
+            max_ind_range=self.max_ind_range)
+        stage = "batches:" + name
+        if not self.manifest.is_done(stage, key):
+            print("Collating %s into batches of %d" %
+                  (split, self.batch_cache_size))
+            paths = write_batch_cache(
+                data, self.d_path + name, self.batch_cache_size)
+            self.manifest.complete(stage, key, paths)
+        return CriteoBatchCache(self.d_path + name)
 
     @property
     def collate_fn(self):
         return collate_wrapper_criteo_length
+
+    def data_loader(self, data, **kwargs):
+        return batched_data_loader(
+            data, collate_fn=self.collate_fn, **kwargs)
@@ -0,0 +1,153 @@
+import io
+import mmap
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from torch.multiprocessing import Pool
+
+# Byte-offset sharding of raw (newline separated) text files.
+#
+# The file is memory mapped and cut into `num_shards` byte ranges whose
+# newlines are counted in parallel. Any line number can then be turned
+# into the byte offset at which it starts, which lets the processing
+# workers read their own range of the original file directly.
+
+# number of bytes scanned at once inside a shard
+BLOCK_SIZE = 1 << 26
+NEWLINE = ord("\n")
+
+
+@contextmanager
+def _mapped(datafile):
+    with open(str(datafile), "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def _blocks(mm, start, end):
+    # zero copy uint8 views of [start, end) in blocks of BLOCK_SIZE
+    for pos in range(start, end, BLOCK_SIZE):
+        size = min(BLOCK_SIZE, end - pos)
+        yield pos, np.frombuffer(mm, dtype=np.uint8, count=size, offset=pos)
+
+
+def _count_newlines(args):
+    datafile, start, end = args
+    with _mapped(datafile) as mm:
+        return sum(int(np.count_nonzero(block == NEWLINE))
+                   for _, block in _blocks(mm, start, end))
+
+
+def shard_file(datafile, num_shards=1):
+    """
+    Cuts `datafile` into `num_shards` byte ranges and counts the
+    newlines of every range, in parallel if `num_shards > 1`.
+
+    Returns
+    ----------
+    bounds: np.ndarray
+        The `num_shards + 1` byte offsets delimiting the shards.
+    counts: np.ndarray
+        Number of newlines in each shard.
+    num_lines: int
+        Number of lines in the file (including an unterminated last one).
+    """
+    file_size = os.path.getsize(str(datafile))
+    num_shards = max(1, min(num_shards, file_size))
+    bounds = np.linspace(0, file_size, num_shards + 1).astype(np.int64)
+    tasks = [(datafile, int(bounds[i]), int(bounds[i + 1]))
+             for i in range(num_shards)]
+    if num_shards > 1:
+        with Pool(num_shards) as pool:
+            counts = pool.map(_count_newlines, tasks)
+    else:
+        counts = [_count_newlines(task) for task in tasks]
+    counts = np.array(counts, dtype=np.int64)
+
+    num_lines = int(counts.sum())
+    if file_size > 0:
+        with _mapped(datafile) as mm:
+            if mm[file_size - 1] != NEWLINE:
+                num_lines += 1
+    return bounds, counts, num_lines
+
+
+def line_offsets(datafile, bounds, counts, line_numbers):
+    """
+    Returns the byte offset at which each of `line_numbers` (0-based)
+    starts. Only the shards holding a requested line are scanned.
+    """
+    ends = np.cumsum(counts)
+    offsets = []
+    with _mapped(datafile) as mm:
+        for line in line_numbers:
+            if line == 0:
+                offsets.append(0)
+                continue
+            # the line starts right after newline number `line`
+            s = int(np.searchsorted(ends, line))
+            if s == len(ends):
+                offsets.append(int(bounds[-1]))
+                continue
+            nth = line - (ends[s - 1] if s > 0 else 0)
+            offsets.append(
+                _find_newline(mm, bounds[s], bounds[s + 1], nth) + 1)
+    return offsets
+
+
+def _find_newline(mm, start, end, nth):
+    # byte offset of the `nth` (1-based) newline in [start, end)
+    for pos, block in _blocks(mm, start, end):
+        newlines = np.flatnonzero(block == NEWLINE)
+        if nth <= len(newlines):
+            return pos + int(newlines[nth - 1])
+        nth -= len(newlines)
+    raise ValueError("less than %d newlines in the range" % nth)
+
+
+class _MappedRangeReader(io.RawIOBase):
+    """
+    Read-only file object over the bytes `[start, end)` of a memory
+    mapped file.
+    """
+
+    def __init__(self, mm, start, end):
+        super().__init__()
+        self.view = memoryview(mm)[start:end]
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.view) - self.pos)
+        if size <= 0:
+            return 0
+        buffer[:size] = self.view[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def close(self):
+        self.view.release()
+        super().close()
+
+
+@contextmanager
+def open_range(datafile, start, end):
+    """
+    Opens the byte range `[start, end)` of `datafile` as a buffered
+    binary file backed by a read-only memory map of the original file.
+    """
+    with _mapped(datafile) as mm:
+        reader = _MappedRangeReader(mm, start, end)
+        try:
+            yield io.BufferedReader(reader, buffer_size=BLOCK_SIZE)
+        finally:
+            reader.close()
@@ -0,0 +1,392 @@
+import os
+import time
+
+import numpy as np
+from datasets.criteo.criteo_dataset import ConcatColumns
+from datasets.criteo.criteo_manifest import (atomic_path, atomic_write,
+                                             file_signature)
+from datasets.criteo.criteo_processor import CHUNK_SIZE, CriteoDataProcessor
+from fedrec.utilities import registry
+
+# Criteo Terabyte Click Logs
+# datafile (str): common prefix of the raw day files, i.e. the days are
+#                 read from "<datafile>_0" ... "<datafile>_<days - 1>"
+# max_ind_range (int): if positive, the raw categorical hashes are hashed
+#                 into [0, max_ind_range) while parsing and no feature
+#                 dictionaries are built
+#
+# Every day is parsed chunk by chunk and appended to its own raw `.npy`
+# columns, so memory is bounded by `chunk_size` (and the vocabularies when
+# dictionaries are built) instead of the size of the dataset.
+
+COLUMN_NAMES = ("X_int", "X_cat", "y")
+
+# number of chunks whose uniques are collected before they are merged into
+# the uniques of the day
+UNIQUE_MERGE_CHUNKS = 64
+
+
+class _ColumnWriter:
+    """
+    Appends row blocks to a `.npy` file of unknown final length. A fixed
+    size header is reserved up front and rewritten with the final shape
+    once the writer is closed. The file is written under a temporary name
+    and moved into place on close.
+    """
+
+    HEADER_SIZE = 128
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.num_rows = 0
+        self.f = open(atomic_path(path), "wb")
+        self.f.write(b"\x00" * self.HEADER_SIZE)
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        assert rows.shape[1:] == self.row_shape
+        self.f.write(rows.tobytes())
+        self.num_rows += len(rows)
+
+    def close(self):
+        header = {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.num_rows,) + self.row_shape,
+        }
+        header = repr(header).encode("latin1")
+        # magic string, version 1.0 and the header length (little endian)
+        preamble = b"\x93NUMPY\x01\x00"
+        size = self.HEADER_SIZE - len(preamble) - 2
+        assert len(header) < size, "header too long"
+        self.f.seek(0)
+        self.f.write(preamble + np.uint16(size).tobytes()
+                     + header.ljust(size - 1) + b"\n")
+        self.f.close()
+        os.replace(atomic_path(self.path), self.path)
+
+    def abort(self):
+        self.f.close()
+        os.remove(atomic_path(self.path))
+
+
+class _RowRange:
+    """
+    Contiguous range of rows which can be fancy indexed like an index
+    array without materializing it.
+    """
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return np.arange(self.start, self.stop)[index]
+        return self.start + np.asarray(index)
+
+
+def generate_synthetic_day_files(
+        datafile, days, rows_per_day, num_categories=1000, seed=0):
+    """
+    Writes `days` raw day files in the Criteo Terabyte layout with
+    random labels, dense values and categorical hashes (including
+    missing values). They stand in for the real click logs in tests and
+    benchmarks.
+    """
+    rng = np.random.RandomState(seed)
+    for day in range(days):
+        y = rng.randint(0, 2, size=(rows_per_day, 1))
+        X_int = rng.randint(-1, 1000, size=(rows_per_day, 13))
+        X_cat = rng.randint(0, num_categories, size=(rows_per_day, 26))
+        # spread the categories over the whole 32 bit hash space
+        X_cat = (X_cat * 2654435761) % (1 << 32)
+        lines = []
+        for i in range(rows_per_day):
+            fields = [str(y[i, 0])]
+            fields += ["" if v < 0 else str(v) for v in X_int[i]]
+            fields += ["" if v == 0 else "%08x" % v for v in X_cat[i]]
+            lines.append("\t".join(fields))
+        with open("{0}_{1}".format(datafile, day), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+@registry.load('dataset', 'terabyte')
+class CriteoTerabyteProcessor(CriteoDataProcessor):
+    def __init__(
+            self,
+            datafile,
+            output_file,
+            days=24,
+            max_ind_range=0,
+            sub_sample_rate=0.0,
+            randomize="none",
+            dataset_multiprocessing=False,
+            chunk_size=CHUNK_SIZE,
+            **kwargs
+    ):
+        super().__init__(
+            datafile,
+            output_file,
+            max_ind_range=max_ind_range,
+            sub_sample_rate=sub_sample_rate,
+            randomize=randomize,
+            dataset_multiprocessing=dataset_multiprocessing,
+            memory_map=True,
+            **kwargs)
+        self.days = days
+        self.chunk_size = chunk_size
+
+    def day_file(self, day):
+        return "{0}_{1}".format(self.datafile, day)
+
+    def day_column_file(self, day, name):
+        return self.column_file(
+            self.output_file, "day_{0}_{1}".format(day, name))
+
+    @property
+    def processed_file(self):
+        return self.description_file(self.output_file)
+
+    @staticmethod
+    def _process_day(
+            datfile,
+            prefix,
+            day,
+            sub_sample_rate=0.0,
+            max_ind_range=0,
+            chunk_size=CHUNK_SIZE
+    ):
+        """
+        Parses one raw day file chunk by chunk into the `.npy` columns
+        `<prefix>_X_int`, `<prefix>_X_cat` (or `<prefix>_X_cat_raw` when
+        dictionaries are built) and `<prefix>_y`.
+        """
+        hashed = max_ind_range > 0
+        cat_name = "X_cat" if hashed else "X_cat_raw"
+        writers = {
+            "X_int": _ColumnWriter(prefix + "_X_int.npy", np.int32, (13,)),
+            cat_name: _ColumnWriter(
+                prefix + "_{0}.npy".format(cat_name), np.int32, (26,)),
+            "y": _ColumnWriter(prefix + "_y.npy", np.int32),
+        }
+        uniques = [np.empty(0, dtype=np.int32) for _ in range(26)]
+        # sorting the day's uniques again for every chunk would be
+        # quadratic in the number of chunks, so the uniques of the chunks
+        # are merged in batches
+        chunk_uniques = [[] for _ in range(26)]
+
+        def merge_uniques():
+            for j in range(26):
+                if chunk_uniques[j]:
+                    uniques[j] = np.unique(
+                        np.concatenate([uniques[j]] + chunk_uniques[j]))
+                    chunk_uniques[j] = []
+
+        k = 0
+        start = time.time()
+        try:
+            for y, X_int, X_cat in CriteoDataProcessor._read_chunks(
+                    datfile, chunk_size):
+                k += len(y)
+                # sub-sample data by dropping zero targets, if needed
+                if sub_sample_rate > 0.0:
+                    rand_u = np.random.uniform(
+                        low=0.0, high=1.0, size=len(y))
+                    keep = (y != 0) | (rand_u >= sub_sample_rate)
+                    y, X_int, X_cat = y[keep], X_int[keep], X_cat[keep]
+                X_int[X_int < 0] = 0
+                if hashed:
+                    X_cat = (X_cat.view(np.uint32) % max_ind_range)
+                else:
+                    for j in range(26):
+                        chunk_uniques[j].append(np.unique(X_cat[:, j]))
+                    if len(chunk_uniques[0]) >= UNIQUE_MERGE_CHUNKS:
+                        merge_uniques()
+                writers["X_int"].append(X_int)
+                writers[cat_name].append(X_cat)
+                writers["y"].append(y)
+        except BaseException:
+            for writer in writers.values():
+                writer.abort()
+            raise
+        for writer in writers.values():
+            writer.close()
+
+        if not hashed:
+            merge_uniques()
+            with atomic_write(prefix + "_unique.npz") as tmp:
+                np.savez(tmp, **{"unique_{0}".format(j): uniques[j]
+                                 for j in range(26)})
+        elapsed = time.time() - start
+        print("Parsed %d rows of day %d in %.2fs (%.0f rows/s)"
+              % (k, day, elapsed, k / max(elapsed, 1e-9)))
+
+    @staticmethod
+    def _remap_day(prefix, uniques, chunk_size=CHUNK_SIZE):
+        # remap the raw hashes of one day into dictionary indices
+        X_cat_raw = np.load(prefix + "_X_cat_raw.npy", mmap_mode="r")
+        writer = _ColumnWriter(prefix + "_X_cat.npy", np.int32, (26,))
+        for start in range(0, len(X_cat_raw), chunk_size):
+            chunk = np.array(X_cat_raw[start:start + chunk_size])
+            for j in range(26):
+                chunk[:, j] = np.searchsorted(uniques[j], chunk[:, j])
+            writer.append(chunk)
+        writer.close()
+
+    def process_days(self):
+        prefixes = {
+            day: self.d_path + self.output_file + "_day_{0}".format(day)
+            for day in range(self.days)}
+        hashed = self.max_ind_range > 0
+
+        # parse every raw day file
+        keys = {
+            day: self.manifest.stage_key(
+                input=file_signature(self.day_file(day)),
+                sub_sample_rate=self.sub_sample_rate,
+                max_ind_range=self.max_ind_range)
+            for day in range(self.days)}
+        todo = [day for day in range(self.days)
+                if not self.manifest.is_done("parse_%d" % day, keys[day])]
+        self._map_days(
+            CriteoTerabyteProcessor._process_day,
+            "process_day",
+            {day: (self.day_file(day), prefixes[day], day,
+                   self.sub_sample_rate, self.max_ind_range,
+                   self.chunk_size)
+             for day in todo})
+        for day in todo:
+            outputs = [self.day_column_file(day, name)
+                       for name in ("X_int", "y")]
+            if hashed:
+                outputs.append(self.day_column_file(day, "X_cat"))
+            else:
+                outputs += [self.day_column_file(day, "X_cat_raw"),
+                            prefixes[day] + "_unique.npz"]
+            self.manifest.complete("parse_%d" % day, keys[day], outputs)
+
+        parsed = [self.manifest.checksums("parse_%d" % day)
+                  for day in range(self.days)]
+        if hashed:
+            counts = np.full(26, self.max_ind_range, dtype=np.int64)
+        else:
+            counts = self.build_dictionaries(prefixes, parsed)
+
+        total_per_file = [
+            len(np.load(self.day_column_file(day, "y"), mmap_mode="r"))
+            for day in range(self.days)]
+        with atomic_write(self.total_file) as tmp:
+            np.savez_compressed(tmp, total_per_file=total_per_file)
+        print("Total number of samples:", np.sum(total_per_file))
+        print("Divided into days/splits:\n", total_per_file)
+
+        np.save(self.column_file(self.output_file, "counts"), counts)
+        self.save_data_description(self.output_file, self.den_fea, counts)
+        return self.d_path + self.output_file
+
+    def build_dictionaries(self, prefixes, parsed):
+        """
+        Merges the sorted per day uniques into the feature dictionaries
+        and remaps every day with them. Returns the dictionary sizes.
+        """
+        dict_files = [
+            self.d_path + self.d_file + "_fea_dict_{0}.npz".format(j)
+            for j in range(26)]
+        key = self.manifest.stage_key(parsed=parsed)
+        if self.manifest.is_done("dictionaries", key):
+            uniques = []
+            for dict_file_j in dict_files:
+                with np.load(dict_file_j) as data:
+                    uniques.append(data["unique"])
+        else:
+            day_uniques = [[] for _ in range(26)]
+            for day in range(self.days):
+                with np.load(prefixes[day] + "_unique.npz") as data:
+                    for j in range(26):
+                        day_uniques[j].append(data["unique_{0}".format(j)])
+            uniques = [np.unique(np.concatenate(u)) for u in day_uniques]
+            for j in range(26):
+                with atomic_write(dict_files[j]) as tmp:
+                    np.savez_compressed(tmp, unique=uniques[j])
+            self.manifest.complete("dictionaries", key, dict_files)
+
+        dicts = self.manifest.checksums("dictionaries")
+        keys = {
+            day: self.manifest.stage_key(dictionaries=dicts,
+                                         parsed=parsed[day])
+            for day in range(self.days)}
+        todo = [day for day in range(self.days)
+                if not self.manifest.is_done("remap_%d" % day, keys[day])]
+        self._map_days(
+            CriteoTerabyteProcessor._remap_day,
+            "remap_day",
+            {day: (prefixes[day], uniques, self.chunk_size)
+             for day in todo})
+        for day in todo:
+            self.manifest.complete("remap_%d" % day, keys[day],
+                                   [self.day_column_file(day, "X_cat")])
+        return np.array([len(u) for u in uniques], dtype=np.int64)
+
+    def load_arrays(self):
+        """
+        Returns the `(X_int, X_cat, y, counts)` columns of all days. Every
+        day stays a separate memory map which is only read when indexed.
+        """
+        columns = [
+            ConcatColumns([
+                np.load(self.day_column_file(day, name), mmap_mode="r")
+                for day in range(self.days)])
+            for name in COLUMN_NAMES]
+        counts = np.load(self.column_file(self.output_file, "counts"))
+        return columns[0], columns[1], columns[2], counts
+
+    def processed_files(self):
+        return [self.day_column_file(day, name)
+                for day in range(self.days) for name in COLUMN_NAMES]
+
+    def load(self, client_id=None):
+        if client_id is not None and self.num_clients > 0:
+            return self.load_client(client_id)
+        self.loaded_client = None
+        if not os.path.exists(self.processed_file):
+            assert False, "data not processed"
+
+        print("Reading pre-processed data=%s" %
+              (str(self.d_path + self.output_file)))
+        with np.load(self.total_file) as data:
+            total_per_file = data["total_per_file"]
+        offset_per_file = np.cumsum(np.concatenate([[0], total_per_file]))
+
+        X_int, X_cat, y, counts = self.load_arrays()
+        self.set_data_description(X_int.shape[1], counts)
+        print("Sparse fea = %d, Dense fea = %d" % (self.n_emb, self.m_den))
+
+        shards = self.split_shards(offset_per_file)
+        if self.streaming:
+            for split in shards:
+                self.data_items[split] = {
+                    "X_int": X_int, "X_cat": X_cat, "y": y,
+                    "shards": shards[split]}
+            return
+
+        if self.randomize != "none":
+            # shuffled splits need an index over all their rows
+            indices = self.permute_data(len(y), offset_per_file)
+            for split, indxs in indices.items():
+                self.data_items[split] = {
+                    "X_int": X_int, "X_cat": X_cat, "y": y,
+                    "indices": indxs}
+            return
+
+        # without randomization every split is a view of its days
+        for split in shards:
+            start, stop = shards[split][0][0], shards[split][-1][1]
+            self.data_items[split] = {
+                "X_int": X_int, "X_cat": X_cat, "y": y,
+                "indices": _RowRange(start, stop)}
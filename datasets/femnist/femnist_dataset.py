@@ -2,6 +2,7 @@ import os
 import os.path
 from torchvision import transforms
 
+import numpy as np
 import torch
 from PIL import Image
 
@@ -22,6 +23,9 @@ class FemnistDataset(torch.utils.data.Dataset):
             E.g, ``transforms.RandomCrop``
         target_transform (callable, optional): A function/transform that
         takes in the target and transforms it.
+        images (np.ndarray, optional): Decoded uint8 ``(N, H, W, 3)``
+        images of the samples. If given, images are read from this
+        array instead of being opened and decoded on every access.
     """
 
     def __init__(
@@ -29,6 +33,7 @@ class FemnistDataset(torch.utils.data.Dataset):
             data_dir,
             img_urls,
             targets,
+            images=None,
             normalize=((0.1307,), (0.3081,))
     ):
 
@@ -39,6 +44,25 @@ class FemnistDataset(torch.utils.data.Dataset):
         self.data_dir = data_dir
         self.img_urls = img_urls
         self.targets = targets
+        self.images = images
+        self.mean = torch.tensor(
+            np.ravel(normalize[0]), dtype=torch.float32).view(-1, 1, 1)
+        self.std = torch.tensor(
+            np.ravel(normalize[1]), dtype=torch.float32).view(-1, 1, 1)
+
+    def _normalize_batch(self, images):
+        # batched ToTensor and Normalize of uint8 NHWC images
+        images = torch.from_numpy(np.ascontiguousarray(images))
+        images = images.permute(0, 3, 1, 2).float().div_(255)
+        return images.sub_(self.mean).div_(self.std)
+
+    def __getitems__(self, indices):
+        if self.images is None:
+            return [self[index] for index in indices]
+        indices = np.asarray(indices)
+        images = self._normalize_batch(self.images[indices])
+        return [(img, int(self.targets[index]))
+                for img, index in zip(images, indices)]
 
     def __getitem__(self, index):
         """
@@ -47,6 +71,9 @@ class FemnistDataset(torch.utils.data.Dataset):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
+        if self.images is not None:
+            img = self._normalize_batch(self.images[index:index + 1])[0]
+            return img, int(self.targets[index])
         imgName, target = self.img_urls[index], int(self.targets[index])
         # doing this so that it is consistent with all other datasets
         # to return a PIL Image
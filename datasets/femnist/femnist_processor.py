@@ -2,8 +2,10 @@ import os
 import os.path
 from typing import Tuple
 
+import numpy as np
 import pandas as pd
 from datasets.femnist.femnist_dataset import FemnistDataset
+from PIL import Image
 from fedrec.utilities import registry
 
 
@@ -20,13 +22,18 @@ class FemnistProcessor:
         self.splits = splits
         self.img_urls = {split: None for split in splits}
         self.labels = {split: None for split in splits}
+        self.images = {split: None for split in splits}
         self.normalize = normalize
+        # memory mapped tables of every split, opened on first load
+        self._tables = {}
 
     def process_data(self):
         for split in self.splits:
             print(f"preprocessing data_{split}...")
             _, df = self.process_file(split)
             self.create_index_file(split, df)
+            self.create_sample_file(split, df)
+            self.create_image_file(split, df)
 
     def process_file(self, split) -> Tuple[str, pd.DataFrame]:
         print("preprocessing datasset...")
@@ -44,53 +51,134 @@ class FemnistProcessor:
         df.reset_index(inplace=True)
         df.drop(columns=["index"], inplace=True)
 
+    def index_file(self, split):
+        return self.meta_data_dir + f"/{split}_index.npy"
+
     def create_index_file(self, split, df: pd.DataFrame = None):
+        """
+        Writes the `(client_id, startindex, lastindex)` rows of every
+        client to a structured `.npy` array. The processed file is sorted
+        by client, so the clients are found in one run-length pass.
+        """
         print("Creating index file...")
-        data = []
         file_path = self.meta_data_dir + f"/{split}_processed.csv"
         if df is None:
-            df = df.read_csv(file_path)
-
-        for id in df.client_id.unique():
-            tmp = df[df["client_id"] == id]
-            startindex = tmp.first_valid_index()
-            lastindex = tmp.last_valid_index()
-            data.append([id, startindex, lastindex])
-        df_index = pd.DataFrame(data,
-                                columns=['client_id',
-                                         'startindex', 'lastindex']
-                                )
-        df_index.to_csv(self.meta_data_dir+f"/{split}_index.csv", index=True)
+            df = pd.read_csv(file_path, index_col=0)
+
+        client_ids = df.client_id.to_numpy()
+        if client_ids.dtype == object:
+            client_ids = client_ids.astype(str)
+        # a client starts wherever the id differs from the previous row
+        starts = np.flatnonzero(np.concatenate(
+            [[len(client_ids) > 0], client_ids[1:] != client_ids[:-1]]))
+        index = np.empty(len(starts), dtype=[
+            ("client_id", client_ids.dtype),
+            ("startindex", np.int64),
+            ("lastindex", np.int64)])
+        index["client_id"] = client_ids[starts]
+        index["startindex"] = starts
+        index["lastindex"] = np.append(starts[1:], len(client_ids)) - 1
+        np.save(self.index_file(split), index)
+
+    def images_file(self, split):
+        return self.meta_data_dir + f"/{split}_images.npy"
+
+    def decode_image(self, sample_path):
+        img = Image.open(os.path.join(self.data_dir, sample_path))
+        # avoid channel error
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return np.asarray(img, dtype=np.uint8)
+
+    def create_image_file(self, split, df: pd.DataFrame = None):
+        """
+        Decodes every image of `split` once into a uint8 `(N, H, W, 3)`
+        array in the order of the processed file, so the images of a
+        client are the rows from its `startindex` to its `lastindex`.
+        """
+        print("Creating image file...")
+        output_path = self.images_file(split)
+        if os.path.exists(output_path):
+            return output_path
+        if df is None:
+            df = pd.read_csv(
+                self.meta_data_dir + f"/{split}_processed.csv", index_col=0)
+
+        sample_paths = df.sample_path.to_list()
+        first = self.decode_image(sample_paths[0])
+        # filled under a temporary name, so a partial file is never used
+        tmp_path = output_path[:-len(".npy")] + ".tmp.npy"
+        images = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.uint8,
+            shape=(len(sample_paths),) + first.shape)
+        for i, sample_path in enumerate(sample_paths):
+            img = self.decode_image(sample_path)
+            if img.shape != first.shape:
+                raise ValueError(
+                    f"image {sample_path} of shape {img.shape} differs "
+                    f"from {first.shape}")
+            images[i] = img
+        del images
+        os.replace(tmp_path, output_path)
+        return output_path
+
+    def sample_file(self, split, column):
+        return self.meta_data_dir + f"/{split}_{column}.npy"
+
+    def create_sample_file(self, split, df: pd.DataFrame = None):
+        """
+        Stores the `sample_path` and `label_id` columns of the processed
+        file as `.npy` arrays, so the samples of a client are read as a
+        slice of a memory map.
+        """
+        print("Creating sample files...")
+        if df is None:
+            df = pd.read_csv(
+                self.meta_data_dir + f"/{split}_processed.csv", index_col=0)
+        np.save(self.sample_file(split, "sample_path"),
+                df.sample_path.to_numpy().astype(str))
+        np.save(self.sample_file(split, "label_id"),
+                df.label_id.to_numpy().astype(np.int64))
+
+    def tables(self, split):
+        """
+        Returns the index, sample paths, labels and images of `split` as
+        memory maps, which are opened once and shared by all clients.
+        """
+        if split not in self._tables:
+            self._tables[split] = (
+                np.load(self.index_file(split), mmap_mode="r"),
+                np.load(self.sample_file(split, "sample_path"),
+                        mmap_mode="r"),
+                np.load(self.sample_file(split, "label_id"), mmap_mode="r"),
+                np.load(self.images_file(split), mmap_mode="r"))
+        return self._tables[split]
 
     def load_meta_data(self, split, start_offset, num_samples):
-        df_values = pd.read_csv(
-            self.meta_data_dir + f"/{split}_processed.csv",
-            names=["index", "client_id", "sample_path",
-                   "label_name", "label_id"],
-            skiprows=start_offset,
-            nrows=num_samples,
-            delimiter=",",
-        )
-        df_values = df_values.drop(labels=0, axis=0)
+        _, sample_paths, labels, _ = self.tables(split)
+        end_offset = start_offset + num_samples
         return (
-            df_values.sample_path.to_list(),
-            df_values.label_id.to_list()
+            sample_paths[start_offset:end_offset],
+            labels[start_offset:end_offset]
         )
 
     def load(self, client_id=None):
         if client_id is None:
             raise NotImplementedError
         for split in self.splits:
-            df_index = pd.read_csv(self.meta_data_dir + f"/{split}_index.csv")
-            start_idx = df_index.iloc[client_id]["startindex"]
-            end_idx = df_index.iloc[client_id]["lastindex"]
-            # load meta file to get labels
+            index, _, _, images = self.tables(split)
+            start_idx = int(index[client_id]["startindex"])
+            end_idx = int(index[client_id]["lastindex"]) + 1
+            # the client's samples are slices of the shared tables
             self.img_urls[split], self.labels[split] = self.load_meta_data(
-                split, start_idx, end_idx)
+                split, start_idx, end_idx - start_idx)
+            # the decoded images of the client, read on access
+            self.images[split] = images[start_idx:end_idx]
 
     def dataset(self, split):
         return FemnistDataset(
             data_dir=self.data_dir,
             img_urls=self.img_urls[split],
             targets=self.labels[split],
+            images=self.images[split],
             normalize=((self.normalize[0],), (self.normalize[1],)))
@@ -1,4 +1,3 @@
-import torch
 from fedrec.user_modules.envis_preprocessor import EnvisPreProcessor
 from fedrec.utilities import registry
 
@@ -28,6 +27,4 @@ class DLRMPreprocessor(EnvisPreProcessor):
         self.ln_emb = self.dataset_processor.ln_emb
 
     def data_loader(self, data, **kwargs):
-        return torch.utils.data.DataLoader(
-            data, collate_fn=self.dataset_processor.collate_fn, **kwargs
-        )
+        return self.dataset_processor.data_loader(data, **kwargs)
@@ -3,10 +3,15 @@ import sys
 import numpy as np
 import torch
 from experiments.dlrm.data_processor import DLRMPreprocessor
+from fedrec.modules.embeddings import md_solver
 from fedrec.utilities import registry
 from torch import nn, sigmoid
 from torch.nn.parameter import Parameter
 
+# tables of this many rows index the raw 32-bit ids (`hash_ids` of the
+# preprocessing without `max_ind_range`), only hashed embeddings hold them
+RAW_ID_RANGE = 1 << 32
+
 
 def xavier_init(layer: nn.Linear):
     # initialize the weights
@@ -38,18 +43,91 @@ class DLRM_Net(nn.Module):
                        xavier_init(nn.Linear(in_f, out_f, True))]
         return torch.nn.Sequential(*layers)
 
+    @staticmethod
+    def md_dims(m, ln, md_dict):
+        """
+        Assigns every table a dimension of at most `m` with the alpha
+        power rule of `md_solver`, so rarely accessed rows get shorter
+        embeddings.
+
+        Arguments
+        ----------
+        m: int
+            The interaction dimension, every table is projected to it.
+        ln: np.ndarray
+            Number of rows of every table.
+        md_dict: dict
+            `alpha` (the skew of the dimensions), the parameter `budget`
+            of all tables (the smallest table gets `m` dimensions if not
+            given), `round_dims` to powers of two and the optional
+            `frequencies`, the average number of accesses of every table
+            per sample.
+
+        Returns
+        ----------
+        list: The dimension of every table.
+        """
+        frequencies = md_dict.get("frequencies", None)
+        if frequencies is not None:
+            frequencies = torch.tensor(frequencies, dtype=torch.float)
+        budget = md_dict.get("budget", None)
+        dims = md_solver(
+            torch.tensor(np.asarray(ln, dtype=np.int64)),
+            md_dict.get("alpha", 0.3),
+            d0=m if budget is None else None,
+            B=budget,
+            round_dim=md_dict.get("round_dims", True),
+            k=frequencies)
+        return [int(d) for d in dims.clamp(1, m)]
+
+    @staticmethod
+    def check_num_embeddings(config, num_embeddings):
+        if num_embeddings >= RAW_ID_RANGE and \
+                config.get("name") != "hash_emb":
+            raise ValueError(
+                "a table of {0} rows indexes raw ids (hash_ids), use the "
+                "hash_emb embedding or set max_ind_range in the "
+                "preprocessing instead of {1}".format(
+                    num_embeddings, config.get("name")))
+
     def create_emb(self, m, ln, emb_dict, weighted_pooling=None):
         emb_l = nn.ModuleList()
         v_W_l = []
+        md_dims = None
+        if emb_dict.get("md", None) is not None:
+            # mixed dimensions, projected back to m
+            md_dims = self.md_dims(m, ln, emb_dict["md"])
+        if emb_dict.get("fused", None) is not None:
+            # a single module holds the tables of all features
+            self.check_num_embeddings(emb_dict["fused"], max(ln))
+            emb_l = registry.construct("embedding", emb_dict["fused"],
+                                       num_embeddings=list(ln),
+                                       embedding_dim=m)
+            for i in range(0, ln.size):
+                if weighted_pooling is None:
+                    v_W_l.append(None)
+                else:
+                    v_W_l.append(torch.ones(ln[i], dtype=torch.float32))
+            return emb_l, v_W_l
         for i in range(0, ln.size):
             # construct embedding operator
 
-            if ((emb_dict.get("custom", None) is not None)
+            if md_dims is not None:
+                self.check_num_embeddings({"name": "pr_emb"}, ln[i])
+                EE = registry.construct("embedding", {"name": "pr_emb"},
+                                        num_embeddings=ln[i],
+                                        embedding_dim=md_dims[i],
+                                        base_dim=m,
+                                        init=emb_dict["md"].get(
+                                            "init", False))
+            elif ((emb_dict.get("custom", None) is not None)
                     and (ln[i] > emb_dict["threshold"])):
+                self.check_num_embeddings(emb_dict["custom"], ln[i])
                 EE = registry.construct("embedding", emb_dict["custom"],
                                         num_embeddings=ln[i],
                                         embedding_dim=m)
             else:
+                self.check_num_embeddings(emb_dict["base"], ln[i])
                 EE = registry.construct("embedding", emb_dict["base"],
                                         num_embeddings=ln[i],
                                         embedding_dim=m)
@@ -68,6 +146,7 @@ class DLRM_Net(nn.Module):
         arch_mlp_top=None,
         arch_interaction_op=None,
         arch_interaction_itself=False,
+        arch_interaction_kernel="bmm",
         sigmoid_bot="relu",
         sigmoid_top="relu",
         loss_weights=None,
@@ -98,6 +177,7 @@ class DLRM_Net(nn.Module):
             self.parallel_model_is_not_prepared = True
             self.arch_interaction_op = arch_interaction_op
             self.arch_interaction_itself = arch_interaction_itself
+            self.arch_interaction_kernel = arch_interaction_kernel
             self.loss_threshold = loss_threshold
             self.loss_function = loss_function
 
@@ -123,6 +203,19 @@ class DLRM_Net(nn.Module):
                     [j for i in range(num_fea)
                      for j in range(i + offset)]
                 )
+                if arch_interaction_kernel not in ("bmm", "triu"):
+                    sys.exit(
+                        "ERROR: --arch-interaction-kernel="
+                        + arch_interaction_kernel
+                        + " is not supported"
+                    )
+                # flat positions of the same pairs in the row-major
+                # (num_fea, num_fea) interaction matrix
+                rows, cols = torch.tril_indices(num_fea, num_fea, offset - 1)
+                self.register_buffer(
+                    "interaction_index", rows * num_fea + cols,
+                    persistent=False)
+                self._interaction_buffers = None
             elif arch_interaction_op == "cat":
                 num_int = num_fea * self.ln_bot[-1]
             else:
@@ -210,6 +303,13 @@ class DLRM_Net(nn.Module):
         return layers(x)
 
     def apply_emb(self, lS_o, lS_i, emb_l, v_W_l):
+        if not isinstance(emb_l, nn.ModuleList):
+            # fused tables: one lookup for all features
+            per_sample_weights = None
+            if v_W_l[0] is not None:
+                per_sample_weights = [
+                    vwl.gather(0, lsi) for vwl, lsi in zip(v_W_l, lS_i)]
+            return emb_l(lS_i, lS_o, per_sample_weights=per_sample_weights)
         ly = [None]*len(lS_i)
         merged_embeddings = zip(emb_l, lS_i, lS_o, v_W_l)
         for i, (emb, lsi, lso, vwl) in enumerate(merged_embeddings):
@@ -222,9 +322,53 @@ class DLRM_Net(nn.Module):
             )
         return ly
 
+    def interaction_buffers(self, x, num_fea):
+        # buffers of the largest batch so far, smaller batches use their
+        # leading rows
+        (batch_size, d) = x.shape
+        buffers = self._interaction_buffers
+        if buffers is None or buffers[0].shape[0] < batch_size \
+                or buffers[0].shape[1:] != (num_fea, d) \
+                or buffers[0].dtype != x.dtype \
+                or buffers[0].device != x.device:
+            buffers = (
+                x.new_empty((batch_size, num_fea, d)),
+                x.new_empty((batch_size, num_fea, num_fea)),
+                x.new_empty((batch_size, d + len(self.interaction_index))))
+            self._interaction_buffers = buffers
+        return [buffer[:batch_size] for buffer in buffers]
+
+    def interact_dot_triu(self, x, ly):
+        """
+        Dot interaction which stacks the features into a (B, F, d) tensor
+        and picks the pairs below the diagonal with one flat
+        `index_select` instead of a two dimensional gather.
+
+        Without autograd the features, interactions and output are
+        written into buffers reused across calls, so the returned
+        tensor is only valid until the next call.
+        """
+        (batch_size, d) = x.shape
+        num_fea = len(ly) + 1
+        if torch.is_grad_enabled():
+            T = torch.stack([x] + ly, dim=1)
+            Z = torch.bmm(T, torch.transpose(T, 1, 2))
+            Zflat = Z.view(batch_size, -1).index_select(
+                1, self.interaction_index)
+            return torch.cat([x, Zflat], dim=1)
+
+        T, Z, R = self.interaction_buffers(x, num_fea)
+        torch.stack([x] + ly, dim=1, out=T)
+        torch.bmm(T, torch.transpose(T, 1, 2), out=Z)
+        Zflat = Z.view(batch_size, -1).index_select(1, self.interaction_index)
+        return torch.cat([x, Zflat], dim=1, out=R)
+
     def interact_features(self, x, ly):
 
-        if self.arch_interaction_op == "dot":
+        if self.arch_interaction_op == "dot" and \
+                self.arch_interaction_kernel == "triu":
+            R = self.interact_dot_triu(x, ly)
+        elif self.arch_interaction_op == "dot":
             # concatenate dense and sparse features
             (batch_size, d) = x.shape
             T = torch.cat([x] + ly, dim=1).view((batch_size, -1, d))
@@ -31,6 +31,8 @@ class DLRMTrainConfig:
 
     num_workers = attr.ib(default=0)
     pin_memory = attr.ib(default=True)
+    num_prefetch = attr.ib(default=2)
+    eval_quantization = attr.ib(default=None)
 
 
 @registry.load('trainer', 'dlrm')
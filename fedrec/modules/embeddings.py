@@ -9,6 +9,10 @@
 # Recommendation Systems", CoRR, arXiv:1909.11810, 2019
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import os
+import tempfile
+import weakref
+from contextlib import contextmanager
 from typing import Optional
 
 import numpy as np
@@ -19,6 +23,9 @@ from torch import Tensor
 from fedrec.utilities import registry
 from torch.nn.parameter import Parameter
 
+# rows of a backing file initialized at once
+INIT_CHUNK_ROWS = 1 << 20
+
 
 def md_solver(n, alpha, d0=None, B=None, round_dim=True, k=None):
     """
@@ -316,7 +323,7 @@ class QREmbeddingBag(nn.Module):
     def __init__(self, num_embeddings, embedding_dim, num_collisions,
                  operation='mult', max_norm=None, norm_type=2.,
                  scale_grad_by_freq=False, mode='mean', sparse=False,
-                 _weight=None):
+                 _weight=None, vectorized=True):
         super(QREmbeddingBag, self).__init__()
 
         assert operation in ['concat', 'mult', 'add'], 'Not valid operation!'
@@ -326,7 +333,7 @@ class QREmbeddingBag(nn.Module):
             self.embedding_dim = [embedding_dim, embedding_dim]
         else:
             self.embedding_dim = embedding_dim
-        self.num_collisions = num_collisions
+        self.num_collisions = int(num_collisions)
         self.operation = operation
         self.max_norm = max_norm
         self.norm_type = norm_type
@@ -358,11 +365,48 @@ class QREmbeddingBag(nn.Module):
             self.weight_r = Parameter(_weight[1])
         self.mode = mode
         self.sparse = sparse
+        self.vectorized = vectorized
+        # quotient and remainder indices of the last call without a graph
+        self._index_buffer = None
 
     def reset_parameters(self):
         nn.init.uniform_(self.weight_q, np.sqrt(1 / self.num_categories))
         nn.init.uniform_(self.weight_r, np.sqrt(1 / self.num_categories))
 
+    def split_indices(self, input):
+        '''
+        Computes the quotient and remainder indices of `input` into one
+        `(2,) + input.shape` long tensor.
+
+        `embedding_bag` keeps its indices for the backward pass, so the
+        buffer is only reused by calls that record no graph (eval,
+        inference); training calls allocate a single buffer per call.
+        '''
+        size = 2 * input.numel()
+        record_graph = torch.is_grad_enabled() and (
+            self.weight_q.requires_grad or self.weight_r.requires_grad)
+        buffer = self._index_buffer
+        if record_graph or buffer is None or buffer.numel() < size \
+                or buffer.device != input.device:
+            buffer = torch.empty(size, dtype=torch.long, device=input.device)
+            if not record_graph:
+                self._index_buffer = buffer
+        indices = buffer[:size].view((2,) + input.shape)
+        num_collisions = self.num_collisions
+        if num_collisions & (num_collisions - 1) == 0:
+            # a power of two, shift and mask
+            shift = num_collisions.bit_length() - 1
+            torch.bitwise_right_shift(input, shift, out=indices[0])
+            torch.bitwise_and(input, num_collisions - 1, out=indices[1])
+        else:
+            torch.div(input, num_collisions, rounding_mode='floor',
+                      out=indices[0])
+            # the remainder from the quotient, cheaper than a second
+            # integer division
+            torch.sub(input, indices[0], alpha=num_collisions,
+                      out=indices[1])
+        return indices
+
     def forward(self, input, offsets=None, per_sample_weights=None):
         '''
         Defines the forward computation performed by EmbeddingBag
@@ -387,8 +431,11 @@ class QREmbeddingBag(nn.Module):
         -------
         (int)The output tensor of shape (B, embedding_dim)
         '''
-        input_q = (input / self.num_collisions).long()
-        input_r = torch.remainder(input, self.num_collisions).long()
+        if self.vectorized:
+            input_q, input_r = self.split_indices(input)
+        else:
+            input_q = (input / self.num_collisions).long()
+            input_r = torch.remainder(input, self.num_collisions).long()
 
         embed_q = F.embedding_bag(
             input_q, self.weight_q, offsets, self.max_norm,
@@ -403,6 +450,9 @@ class QREmbeddingBag(nn.Module):
 
         if self.operation == 'concat':
             embed = torch.cat((embed_q, embed_r), dim=1)
+        elif self.operation == 'add' and self.vectorized:
+            # the bags are not needed by the backward of a sum
+            embed = embed_q.add_(embed_r)
         elif self.operation == 'add':
             embed = embed_q + embed_r
         elif self.operation == 'mult':
@@ -428,3 +478,833 @@ class QREmbeddingBag(nn.Module):
             s += ', scale_grad_by_freq={scale_grad_by_freq}'
         s += ', mode={mode}'
         return s.format(**self.__dict__)
+
+
+@registry.load("embedding", "fused_bag")
+class FusedEmbeddingBag(nn.Module):
+    '''
+    Packs the embedding tables of all sparse features into one weight
+    tensor, each table starting at its row offset. The lookups of all
+    tables are done by a single `embedding_bag` call over the shifted
+    and concatenated indices, whose output is split back per table.
+
+    Parameters
+    ----------
+    num_embeddings : list
+        number of rows of every table.
+    embedding_dim : int
+        the size of each embedding vector (the same for all tables).
+    mode : str
+        "sum", "mean" or "max", the reduction of every bag.
+    sparse : bool
+        if True, the gradient of the packed weight is a sparse tensor.
+    init : bool
+        initialize every table uniformly in +-sqrt(1 / rows) as in
+        `EmbeddingBag`.
+    '''
+
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 mode="sum",
+                 sparse=False,
+                 init=False):
+        super(FusedEmbeddingBag, self).__init__()
+        rows = [int(n) for n in num_embeddings]
+        self.num_embeddings = rows
+        self.embedding_dim = embedding_dim
+        self.mode = mode
+        self.sparse = sparse
+        self.register_buffer(
+            "table_offsets", torch.tensor(np.cumsum([0] + rows[:-1])))
+        self.weight = Parameter(torch.empty(sum(rows), embedding_dim))
+        with torch.no_grad():
+            if init:
+                for offset, n in zip(self.table_offsets.tolist(), rows):
+                    self.weight[offset:offset + n].uniform_(
+                        -np.sqrt(1 / n), np.sqrt(1 / n))
+            else:
+                nn.init.normal_(self.weight)
+
+    def forward(self, input, offsets, per_sample_weights=None):
+        '''
+        Arguments
+        ---------
+        input: Tensor or list
+           indices of every table, a `(T, N)` tensor or a list of
+           `T` 1D tensors.
+        offsets: Tensor or list
+           starting position of every bag in the indices of its table,
+           `(T, B)` or a list of `T` tensors of `B` offsets.
+        per_sample_weights: Tensor or list, optional
+           weights of the indices, shaped like `input`. Only supported
+           for mode='sum'.
+
+        Returns
+        -------
+        (list) The `(B, embedding_dim)` output of every table.
+        '''
+        num_tables = len(self.num_embeddings)
+        if isinstance(input, Tensor):
+            # every table holds the same number of indices
+            lengths = torch.full(
+                (num_tables,), input.shape[1], dtype=torch.long,
+                device=input.device)
+            indices = (input + self.table_offsets[:, None]).view(-1)
+        else:
+            lengths = torch.tensor([len(x) for x in input],
+                                   device=self.table_offsets.device)
+            indices = torch.cat([
+                x + offset for x, offset in zip(input, self.table_offsets)])
+        if not isinstance(offsets, Tensor):
+            offsets = torch.stack(list(offsets))
+        # the bags of table t start after the indices of the tables < t
+        starts = torch.cumsum(lengths, 0) - lengths
+        offsets = (offsets.long() + starts[:, None]).view(-1)
+        if per_sample_weights is not None and \
+                not isinstance(per_sample_weights, Tensor):
+            per_sample_weights = torch.cat(list(per_sample_weights))
+        elif per_sample_weights is not None:
+            per_sample_weights = per_sample_weights.reshape(-1)
+
+        out = self.lookup(indices, offsets, per_sample_weights)
+        return list(out.view(num_tables, -1, self.embedding_dim).unbind(0))
+
+    def lookup(self, indices, offsets, per_sample_weights):
+        return F.embedding_bag(
+            indices, self.weight, offsets, mode=self.mode,
+            sparse=self.sparse, per_sample_weights=per_sample_weights)
+
+    def extra_repr(self):
+        return '{num_embeddings}, {embedding_dim}, mode={mode}'.format(
+            **self.__dict__)
+
+
+@registry.load("embedding", "cached_emb")
+class CachedEmbeddingBag(nn.Module):
+    '''
+    Embedding bag whose full table lives in a memory mapped `.npy` file,
+    while `cache_size` hot rows are kept in a compact in-memory weight.
+    A lookup first brings the missing rows of the batch into the cache,
+    evicting the least recently ("lru") or least frequently ("lfu") used
+    rows and writing the trained ones back to the file, then gathers
+    from the cache only. Tables larger than the memory can be trained
+    this way as long as the accesses are skewed.
+
+    The optimizer only sees the cache, so its per-parameter state (e.g.
+    momentum) belongs to the cache slots, not to the rows.
+
+    The state dict holds the whole `table` (flushed, and sharing memory
+    with the backing file) instead of the cache, so checkpoints and the
+    averaged states of federated clients refer to the same rows. Loading
+    a state writes the table to the backing file and empties the cache.
+
+    Parameters
+    ----------
+    num_embeddings : int
+        number of rows of the table.
+    embedding_dim : int
+        the size of each embedding vector.
+    cache_size : int
+        number of rows kept in memory, at least the number of distinct
+        indices of a batch.
+    policy : str
+        "lru" or "lfu", which rows are evicted first.
+    mode : str
+        "sum", "mean" or "max", the reduction of every bag.
+    sparse : bool
+        if True, the gradient of the cache is a sparse tensor.
+    backing_file : str, optional
+        `.npy` file holding the table, reused if it exists with the same
+        shape. By default a temporary file in `cache_dir`, removed with
+        the module.
+    cache_dir : str, optional
+        directory of the temporary backing file.
+    init : bool
+        initialize the table uniformly in +-sqrt(1 / rows) as in
+        `EmbeddingBag`, otherwise from a standard normal.
+    '''
+
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 cache_size,
+                 policy="lru",
+                 mode="sum",
+                 sparse=False,
+                 backing_file=None,
+                 cache_dir=None,
+                 init=False):
+        super(CachedEmbeddingBag, self).__init__()
+        if policy not in ("lru", "lfu"):
+            raise ValueError("unknown cache policy " + str(policy))
+        self.num_embeddings = int(num_embeddings)
+        self.embedding_dim = int(embedding_dim)
+        self.cache_size = min(int(cache_size), self.num_embeddings)
+        self.policy = policy
+        self.mode = mode
+        self.sparse = sparse
+        self.table = self._open_table(backing_file, cache_dir, init)
+
+        self.weight = Parameter(
+            torch.zeros(self.cache_size, self.embedding_dim))
+        # row held by every slot, -1 if the slot is empty
+        self.register_buffer(
+            "row_of_slot", torch.full((self.cache_size,), -1,
+                                      dtype=torch.long), persistent=False)
+        # slot of every cached row, a hash map since only `cache_size` of
+        # the table's rows can be cached
+        self.slot_of_row = {}
+        # last access (lru) or number of accesses (lfu), -1 if empty
+        self.register_buffer(
+            "slot_score", torch.full((self.cache_size,), -1,
+                                     dtype=torch.long), persistent=False)
+        # slots trained since they were loaded
+        self.register_buffer(
+            "dirty", torch.zeros(self.cache_size, dtype=torch.bool),
+            persistent=False)
+        self.clock = 0
+        self._index_slots()
+        self.reset_stats()
+
+    def _open_table(self, backing_file, cache_dir, init):
+        shape = (self.num_embeddings, self.embedding_dim)
+        if backing_file is not None and os.path.exists(backing_file):
+            table = np.load(backing_file, mmap_mode="r+")
+            if table.shape == shape and table.dtype == np.float32:
+                return table
+            del table
+        if backing_file is None:
+            fd, backing_file = tempfile.mkstemp(
+                suffix=".npy", prefix="envis_emb_", dir=cache_dir)
+            os.close(fd)
+            weakref.finalize(self, os.remove, backing_file)
+        table = np.lib.format.open_memmap(
+            backing_file, mode="w+", dtype=np.float32, shape=shape)
+        for start in range(0, self.num_embeddings, INIT_CHUNK_ROWS):
+            stop = min(start + INIT_CHUNK_ROWS, self.num_embeddings)
+            if init:
+                bound = np.sqrt(1 / self.num_embeddings)
+                table[start:stop] = np.random.uniform(
+                    low=-bound, high=bound,
+                    size=(stop - start, self.embedding_dim))
+            else:
+                table[start:stop] = torch.randn(
+                    stop - start, self.embedding_dim).numpy()
+        table.flush()
+        return table
+
+    def reset_stats(self):
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    @property
+    def hit_rate(self):
+        """
+        Fraction of the looked up indices found in the cache since the
+        last `reset_stats`.
+        """
+        return self.num_hits / max(self.num_lookups, 1)
+
+    @torch.no_grad()
+    def fetch(self, input, mark_dirty=False):
+        '''
+        Returns the cache slots of the rows `input`, loading the rows
+        missing from the cache first.
+        '''
+        rows, inverse, counts = torch.unique(
+            input, return_inverse=True, return_counts=True)
+        if len(rows) > self.cache_size:
+            raise ValueError(
+                "a batch looks up {0} rows, more than the cache size "
+                "{1}".format(len(rows), self.cache_size))
+        slots = self._find_slots(rows)
+        missing = slots < 0
+        self.num_lookups += input.numel()
+        self.num_hits += int(counts[~missing].sum())
+        if missing.any():
+            slots[missing] = self._load_rows(rows[missing], slots[~missing])
+
+        self.clock += 1
+        if self.policy == "lru":
+            self.slot_score[slots] = self.clock
+        else:
+            self.slot_score[slots] += counts
+        if mark_dirty:
+            self.dirty[slots] = True
+        return slots[inverse]
+
+    def _index_slots(self):
+        slots = torch.nonzero(self.row_of_slot >= 0).view(-1)
+        self.slot_of_row = dict(zip(
+            self.row_of_slot[slots].tolist(), slots.tolist()))
+
+    def _find_slots(self, rows):
+        # slots of `rows`, -1 for the rows not in the cache
+        slot_of_row = self.slot_of_row
+        return torch.tensor(
+            [slot_of_row.get(row, -1) for row in rows.tolist()],
+            dtype=torch.long, device=rows.device)
+
+    def _load_rows(self, rows, pinned):
+        score = self.slot_score.clone()
+        # the rows of the batch stay in the cache
+        score[pinned] = torch.iinfo(score.dtype).max
+        victims = torch.topk(score, len(rows), largest=False).indices
+
+        old_rows = self.row_of_slot[victims]
+        evicted = old_rows >= 0
+        self._write_back(victims[evicted & self.dirty[victims]])
+        for row in old_rows[evicted].tolist():
+            del self.slot_of_row[row]
+
+        self.row_of_slot[victims] = rows
+        self.slot_of_row.update(zip(rows.tolist(), victims.tolist()))
+        self.slot_score[victims] = 0
+        self.dirty[victims] = False
+        # the unique rows are sorted, so the file is read in order
+        self.weight[victims] = torch.from_numpy(
+            self.table[rows.cpu().numpy()]).to(self.weight.device)
+        return victims
+
+    def _write_back(self, slots):
+        if len(slots) == 0:
+            return
+        rows = self.row_of_slot[slots].cpu().numpy()
+        self.table[rows] = self.weight[slots].detach().cpu().numpy()
+        self.dirty[slots] = False
+
+    @torch.no_grad()
+    def flush(self):
+        """
+        Writes the trained rows of the cache back to the backing file.
+        """
+        self._write_back(torch.nonzero(self.dirty).view(-1))
+        self.table.flush()
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        # the cache slots map to different rows on every client, so the
+        # state is the whole table
+        self.flush()
+        destination[prefix + "table"] = torch.from_numpy(self.table)
+
+    @torch.no_grad()
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata,
+                              strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        key = prefix + "table"
+        if strict:
+            unexpected_keys.extend(
+                name for name in state_dict if name.startswith(prefix)
+                and name != key and "." not in name[len(prefix):])
+        if key not in state_dict:
+            missing_keys.append(key)
+            return
+        table = state_dict[key]
+        if tuple(table.shape) != self.table.shape:
+            error_msgs.append(
+                "size mismatch for {0}: copying a table of shape {1}, the "
+                "table of the module has shape {2}".format(
+                    key, tuple(table.shape), self.table.shape))
+            return
+        for start in range(0, self.num_embeddings, INIT_CHUNK_ROWS):
+            stop = min(start + INIT_CHUNK_ROWS, self.num_embeddings)
+            self.table[start:stop] = \
+                table[start:stop].detach().cpu().float().numpy()
+        self.table.flush()
+        # the cached rows are stale now
+        self.row_of_slot.fill_(-1)
+        self._index_slots()
+        self.slot_score.fill_(-1)
+        self.dirty.fill_(False)
+
+    def forward(self, input, offsets=None, per_sample_weights=None):
+        '''
+        Arguments
+        ---------
+        input: Tensor
+           indices into the table, with the layout of `EmbeddingBag`.
+        offsets: Tensor, optional
+           starting position of every bag in `input`.
+        per_sample_weights: Tensor, optional
+           weights of the indices, only supported for mode='sum'.
+
+        Returns
+        -------
+        (Tensor) The output tensor of shape (B, embedding_dim)
+        '''
+        slots = self.fetch(
+            input, mark_dirty=self.training and torch.is_grad_enabled())
+        return F.embedding_bag(
+            slots, self.weight, offsets, mode=self.mode,
+            sparse=self.sparse, per_sample_weights=per_sample_weights)
+
+    def extra_repr(self):
+        return ('{num_embeddings}, {embedding_dim}, cache_size={cache_size}'
+                ', policy={policy}, mode={mode}').format(**self.__dict__)
+
+
+@registry.load("embedding", "quant_emb")
+class QuantizedEmbeddingBag(nn.Module):
+    '''
+    Embedding bag for evaluation and inference with a compressed table.
+    With dtype "int8" every row is stored as uint8 codes with its own
+    float scale and bias (row = codes * scale + bias), with "fp16" as
+    half precision floats. Only the looked up rows are dequantized.
+
+    Trained `EmbeddingBag`s (and the tables of `CachedEmbeddingBag`s)
+    are converted with `from_float`, `from_state_dict` or, for a whole
+    model, `quantize_embeddings`.
+
+    Parameters
+    ----------
+    num_embeddings : int
+        size of the dictionary of embeddings.
+    embedding_dim : int
+        the size of each embedding vector.
+    dtype : str
+        "int8" (row-wise with scale and bias) or "fp16".
+    mode : str
+        "sum", "mean" or "max", the reduction of every bag.
+    '''
+
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 dtype="int8",
+                 mode="sum"):
+        super(QuantizedEmbeddingBag, self).__init__()
+        if dtype not in ("int8", "fp16"):
+            raise ValueError("unknown quantization " + str(dtype))
+        self.num_embeddings = int(num_embeddings)
+        self.embedding_dim = int(embedding_dim)
+        self.dtype = dtype
+        self.mode = mode
+        shape = (self.num_embeddings, self.embedding_dim)
+        if dtype == "int8":
+            self.register_buffer("weight", torch.zeros(
+                shape, dtype=torch.uint8))
+            self.register_buffer("scale", torch.ones(self.num_embeddings))
+            self.register_buffer("bias", torch.zeros(self.num_embeddings))
+        else:
+            self.register_buffer("weight", torch.zeros(
+                shape, dtype=torch.float16))
+
+    @torch.no_grad()
+    def quantize_(self, weight, start=0):
+        '''
+        Stores the float `weight` rows, starting at row `start`, in the
+        quantized format.
+        '''
+        weight = weight.detach().to(self.weight.device)
+        rows = slice(start, start + len(weight))
+        if self.dtype == "fp16":
+            self.weight[rows] = weight
+            return self
+        low = weight.min(dim=1).values
+        high = weight.max(dim=1).values
+        # constant rows get any non zero scale
+        scale = torch.where(high > low, (high - low) / 255, 1.)
+        self.weight[rows] = torch.round(
+            (weight - low[:, None]) / scale[:, None]).clamp_(0, 255)
+        self.scale[rows] = scale
+        self.bias[rows] = low
+        return self
+
+    def dequantize(self, indices=None):
+        '''
+        Returns the float rows `indices` (all rows by default).
+        '''
+        if indices is None:
+            indices = slice(None)
+        rows = self.weight[indices].float()
+        if self.dtype == "int8":
+            rows = torch.addcmul(
+                self.bias[indices, None], rows, self.scale[indices, None])
+        return rows
+
+    @classmethod
+    def from_float(cls, module, dtype="int8"):
+        '''
+        Quantizes a trained `nn.EmbeddingBag` or `CachedEmbeddingBag`.
+        '''
+        quantized = cls(module.num_embeddings, module.embedding_dim,
+                        dtype=dtype, mode=module.mode)
+        quantized.to(module.weight.device)
+        if not isinstance(module, CachedEmbeddingBag):
+            return quantized.quantize_(module.weight)
+        # the table of a cached bag is read from its file in chunks
+        module.flush()
+        for start in range(0, module.num_embeddings, INIT_CHUNK_ROWS):
+            quantized.quantize_(torch.from_numpy(
+                module.table[start:start + INIT_CHUNK_ROWS]), start)
+        return quantized
+
+    @classmethod
+    def from_state_dict(cls, state_dict, dtype="int8", mode="sum"):
+        '''
+        Quantizes the `weight` of an `nn.EmbeddingBag` state dict.
+        '''
+        weight = state_dict["weight"]
+        quantized = cls(*weight.shape, dtype=dtype, mode=mode)
+        return quantized.to(weight.device).quantize_(weight)
+
+    @torch.no_grad()
+    def forward(self, input, offsets=None, per_sample_weights=None):
+        '''
+        Arguments
+        ---------
+        input: Tensor
+           indices into the table, with the layout of `EmbeddingBag`.
+        offsets: Tensor, optional
+           starting position of every bag in `input`.
+        per_sample_weights: Tensor, optional
+           weights of the indices, only supported for mode='sum'.
+
+        Returns
+        -------
+        (Tensor) The output tensor of shape (B, embedding_dim)
+        '''
+        rows = self.dequantize(input.reshape(-1))
+        # the dequantized rows are the table of their own bags
+        positions = torch.arange(
+            input.numel(), device=rows.device).view(input.shape)
+        return F.embedding_bag(
+            positions, rows, offsets, mode=self.mode,
+            per_sample_weights=per_sample_weights)
+
+    def extra_repr(self):
+        return '{num_embeddings}, {embedding_dim}, dtype={dtype}, ' \
+            'mode={mode}'.format(**self.__dict__)
+
+
+def quantize_module(module, dtype="int8"):
+    '''
+    Returns the quantized copy of an embedding module, or `None` if
+    `module` is not one of the supported embedding bags.
+    '''
+    if isinstance(module, (nn.EmbeddingBag, CachedEmbeddingBag)):
+        return QuantizedEmbeddingBag.from_float(module, dtype)
+    if isinstance(module, FusedEmbeddingBag):
+        return QuantizedFusedEmbeddingBag.from_float(module, dtype)
+    if isinstance(module, HashedEmbeddingBag):
+        return QuantizedHashedEmbeddingBag.from_float(module, dtype)
+    return None
+
+
+def quantize_embeddings(model, dtype="int8"):
+    '''
+    Replaces every embedding bag of `model` supported by
+    `quantize_module` in place by its quantized copy.
+
+    Returns
+    -------
+    (list) The `(parent, name, module)` of every replaced embedding bag.
+    '''
+    replaced = []
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            quantized = quantize_module(child, dtype)
+            if quantized is not None:
+                replaced.append((parent, name, child))
+                setattr(parent, name, quantized)
+    if not replaced:
+        raise ValueError(
+            "the model has no embedding bag which can be quantized")
+    return replaced
+
+
+@contextmanager
+def quantized_embeddings(model, dtype="int8"):
+    '''
+    Runs `model` with quantized embedding bags inside the context, the
+    trained ones are put back on exit.
+    '''
+    replaced = quantize_embeddings(model, dtype)
+    try:
+        yield model
+    finally:
+        for parent, name, module in replaced:
+            setattr(parent, name, module)
+
+
+@registry.load("embedding", "hash_emb")
+class HashedEmbeddingBag(nn.Module):
+    '''
+    Embedding bag over a fixed number of buckets which hashes the raw
+    32-bit categorical ids online, so no dictionary of the ids is needed
+    and the memory is set by `num_buckets` instead of the vocabulary.
+
+    Every id is hashed by `num_hashes` functions of the universal
+    multiply-add-shift family. With `combine="sum"` all hashes look up
+    one shared table and their embeddings are summed, with "concat"
+    every hash has its own table of `embedding_dim / num_hashes`
+    dimensions and the embeddings are concatenated. With `double` the
+    hashes are derived from two base hashes as h1 + i * h2.
+
+    Parameters
+    ----------
+    num_embeddings : int
+        number of possible ids, only informative.
+    embedding_dim : int
+        the size of each output embedding vector.
+    num_buckets : int
+        number of rows of every table, below 2**31.
+    num_hashes : int
+        number of hash functions per id.
+    combine : str
+        "sum" or "concat", how the embeddings of the hashes are combined.
+    double : bool
+        derive the hashes from two base hashes (double hashing).
+    mode : str
+        "sum", "mean" or "max", the reduction of every bag.
+    sparse : bool
+        if True, the gradient of the weight is a sparse tensor.
+    seed : int
+        seed of the hash functions.
+    init : bool
+        initialize the tables uniformly in +-sqrt(1 / num_buckets) as in
+        `EmbeddingBag`, otherwise from a standard normal.
+    '''
+
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 num_buckets,
+                 num_hashes=2,
+                 combine="sum",
+                 double=False,
+                 mode="sum",
+                 sparse=False,
+                 seed=0,
+                 init=False):
+        super(HashedEmbeddingBag, self).__init__()
+        if combine not in ("sum", "concat"):
+            raise ValueError("unknown combine operation " + str(combine))
+        if combine == "concat" and embedding_dim % num_hashes != 0:
+            raise ValueError(
+                "embedding_dim must be a multiple of num_hashes to concat")
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.num_buckets = int(num_buckets)
+        self.num_hashes = num_hashes
+        self.combine = combine
+        self.double = double
+        self.mode = mode
+        self.sparse = sparse
+
+        # odd multipliers and offsets of the hash functions, two base
+        # hashes with double hashing
+        num_functions = 2 if double else num_hashes
+        rng = np.random.RandomState(seed)
+        params = rng.randint(
+            -2 ** 63, 2 ** 63 - 1, size=(2, num_functions), dtype=np.int64)
+        self.register_buffer("hash_a", torch.from_numpy(params[0] | 1))
+        self.register_buffer("hash_b", torch.from_numpy(params[1]))
+
+        if combine == "sum":
+            shape = (self.num_buckets, embedding_dim)
+        else:
+            # the tables of all hashes, one after the other
+            shape = (num_hashes * self.num_buckets,
+                     embedding_dim // num_hashes)
+        self.weight = Parameter(torch.empty(shape))
+        with torch.no_grad():
+            if init:
+                bound = np.sqrt(1 / self.num_buckets)
+                self.weight.uniform_(-bound, bound)
+            else:
+                nn.init.normal_(self.weight)
+
+    def hash(self, input):
+        '''
+        Returns the `(num_hashes,) + input.shape` buckets of the ids
+        `input`, which are read as unsigned 32-bit values.
+        '''
+        x = input.long() & 0xFFFFFFFF
+        shape = (-1,) + (1,) * x.dim()
+        # int64 arithmetic wraps around, i.e. is modulo 2**64, and the
+        # high 32 bits of a * x + b are the universal hash
+        h = (self.hash_a.view(shape) * x + self.hash_b.view(shape)) >> 32
+        buckets = ((h & 0xFFFFFFFF) * self.num_buckets) >> 32
+        if self.double:
+            steps = torch.arange(
+                self.num_hashes, device=x.device).view(shape)
+            # a non zero step, so the hashes of an id differ
+            step = 1 + buckets[1] % max(self.num_buckets - 1, 1)
+            buckets = (buckets[0] + steps * step) % self.num_buckets
+        return buckets
+
+    def forward(self, input, offsets=None, per_sample_weights=None):
+        '''
+        Arguments
+        ---------
+        input: Tensor
+           raw ids, with the layout of `EmbeddingBag`.
+        offsets: Tensor, optional
+           starting position of every bag in `input`.
+        per_sample_weights: Tensor, optional
+           weights of the indices, only supported for mode='sum'.
+
+        Returns
+        -------
+        (Tensor) The output tensor of shape (B, embedding_dim)
+        '''
+        buckets = self.hash(input)
+        embs = []
+        for k in range(self.num_hashes):
+            indices = buckets[k]
+            if self.combine == "concat":
+                indices = indices + k * self.num_buckets
+            embs.append(self.lookup(indices, offsets, per_sample_weights))
+        if self.combine == "concat":
+            return torch.cat(embs, dim=1)
+        return torch.stack(embs).sum(dim=0)
+
+    def lookup(self, indices, offsets, per_sample_weights):
+        return F.embedding_bag(
+            indices, self.weight, offsets, mode=self.mode,
+            sparse=self.sparse, per_sample_weights=per_sample_weights)
+
+    def extra_repr(self):
+        return ('{num_embeddings}, {embedding_dim}, '
+                'num_buckets={num_buckets}, num_hashes={num_hashes}, '
+                'combine={combine}, double={double}, mode={mode}'
+                ).format(**self.__dict__)
+
+
+class QuantizedFusedEmbeddingBag(nn.Module):
+    '''
+    `FusedEmbeddingBag` whose packed tables are a `QuantizedEmbeddingBag`,
+    for evaluation and inference. Converted with `from_float`.
+
+    Parameters
+    ----------
+    num_embeddings : list
+        number of rows of every table.
+    embedding_dim : int
+        the size of each embedding vector (the same for all tables).
+    dtype : str
+        "int8" (row-wise with scale and bias) or "fp16".
+    mode : str
+        "sum", "mean" or "max", the reduction of every bag.
+    '''
+
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 dtype="int8",
+                 mode="sum"):
+        super(QuantizedFusedEmbeddingBag, self).__init__()
+        rows = [int(n) for n in num_embeddings]
+        self.num_embeddings = rows
+        self.embedding_dim = embedding_dim
+        self.mode = mode
+        self.register_buffer(
+            "table_offsets", torch.tensor(np.cumsum([0] + rows[:-1])))
+        self.table = QuantizedEmbeddingBag(
+            sum(rows), embedding_dim, dtype=dtype, mode=mode)
+
+    @classmethod
+    def from_float(cls, module, dtype="int8"):
+        '''
+        Quantizes a trained `FusedEmbeddingBag`.
+        '''
+        quantized = cls(module.num_embeddings, module.embedding_dim,
+                        dtype=dtype, mode=module.mode)
+        quantized.to(module.weight.device).table.quantize_(module.weight)
+        return quantized
+
+    # the tables are fused like in the float bag, only the lookup differs
+    forward = torch.no_grad()(FusedEmbeddingBag.forward)
+
+    def lookup(self, indices, offsets, per_sample_weights):
+        return self.table(indices, offsets, per_sample_weights)
+
+    def extra_repr(self):
+        return '{num_embeddings}, {embedding_dim}, mode={mode}'.format(
+            **self.__dict__)
+
+
+class QuantizedHashedEmbeddingBag(nn.Module):
+    '''
+    `HashedEmbeddingBag` whose buckets are a `QuantizedEmbeddingBag`, for
+    evaluation and inference. Converted with `from_float`, which copies
+    the hash functions of the trained bag.
+
+    Parameters
+    ----------
+    num_embeddings : int
+        number of possible ids, only informative.
+    embedding_dim : int
+        the size of each output embedding vector.
+    num_buckets : int
+        number of rows of every table, below 2**31.
+    num_hashes : int
+        number of hash functions per id.
+    combine : str
+        "sum" or "concat", how the embeddings of the hashes are combined.
+    double : bool
+        derive the hashes from two base hashes (double hashing).
+    dtype : str
+        "int8" (row-wise with scale and bias) or "fp16".
+    mode : str
+        "sum", "mean" or "max", the reduction of every bag.
+    '''
+
+    def __init__(self,
+                 num_embeddings,
+                 embedding_dim,
+                 num_buckets,
+                 num_hashes=2,
+                 combine="sum",
+                 double=False,
+                 dtype="int8",
+                 mode="sum"):
+        super(QuantizedHashedEmbeddingBag, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.num_buckets = int(num_buckets)
+        self.num_hashes = num_hashes
+        self.combine = combine
+        self.double = double
+        self.mode = mode
+        num_functions = 2 if double else num_hashes
+        self.register_buffer(
+            "hash_a", torch.ones(num_functions, dtype=torch.long))
+        self.register_buffer(
+            "hash_b", torch.zeros(num_functions, dtype=torch.long))
+        if combine == "sum":
+            shape = (self.num_buckets, embedding_dim)
+        else:
+            shape = (num_hashes * self.num_buckets,
+                     embedding_dim // num_hashes)
+        self.table = QuantizedEmbeddingBag(*shape, dtype=dtype, mode=mode)
+
+    @classmethod
+    def from_float(cls, module, dtype="int8"):
+        '''
+        Quantizes a trained `HashedEmbeddingBag`.
+        '''
+        quantized = cls(module.num_embeddings, module.embedding_dim,
+                        module.num_buckets, num_hashes=module.num_hashes,
+                        combine=module.combine, double=module.double,
+                        dtype=dtype, mode=module.mode)
+        quantized.to(module.weight.device)
+        quantized.hash_a.copy_(module.hash_a)
+        quantized.hash_b.copy_(module.hash_b)
+        quantized.table.quantize_(module.weight)
+        return quantized
+
+    # the ids are hashed like in the float bag, only the lookup differs
+    hash = HashedEmbeddingBag.hash
+    forward = torch.no_grad()(HashedEmbeddingBag.forward)
+
+    def lookup(self, indices, offsets, per_sample_weights):
+        return self.table(indices, offsets, per_sample_weights)
+
+    def extra_repr(self):
+        return ('{num_embeddings}, {embedding_dim}, '
+                'num_buckets={num_buckets}, num_hashes={num_hashes}, '
+                'combine={combine}, double={double}, mode={mode}'
+                ).format(**self.__dict__)
@@ -123,6 +123,9 @@ class Trainer(BaseActor, ABC):
         self.local_sample_number = len(
             self.model_preproc.datasets('train'))
         self.reset_loaders()
+        # the worker swaps the new data into its existing loaders
+        self.worker.model_preproc = model_preproc
+        self.worker.reset_loaders()
 
     def run(self, func_name, *args, **kwargs):
         """
@@ -1,12 +1,16 @@
+import contextlib
 from typing import Dict
 
 import attr
 import numpy as np
 import torch
+from fedrec.modules.embeddings import (CachedEmbeddingBag,
+                                       quantized_embeddings)
 from fedrec.user_modules.envis_base_module import EnvisBase
 from fedrec.user_modules.envis_preprocessor import EnvisPreProcessor
 from fedrec.utilities import registry
 from fedrec.utilities import saver_utils as saver_mod
+from fedrec.utilities.loader_utils import LoaderManager, PrefetchLoader
 from sklearn import metrics
 from tqdm import tqdm
 from fedrec.utilities.logger import BaseLogger
@@ -37,7 +41,12 @@ class TrainConfig:
 
     num_workers = attr.ib(default=0)
     pin_memory = attr.ib(default=True)
+    # batches fetched (and moved to the GPU) ahead of the training step
+    # on a background thread, 0 disables prefetching
+    num_prefetch = attr.ib(default=2)
     log_gradients = attr.ib(default=False)
+    # evaluate with "int8" or "fp16" embedding tables, None keeps fp32
+    eval_quantization = attr.ib(default=None)
 
 
 class EnvisTrainer(EnvisBase):
@@ -70,6 +79,11 @@ class EnvisTrainer(EnvisBase):
                 self.model.cuda()
 
         self._data_loaders = {}
+        # the loaders are built with the current preprocessor, which is
+        # replaced when the trainer gets the data of another client
+        self.loader_manager = LoaderManager(
+            lambda data, **kwargs: self.model_preproc.data_loader(
+                data, **kwargs))
         self._scheduler = None
 
         with self.init_random:
@@ -81,6 +95,14 @@ class EnvisTrainer(EnvisBase):
     def reset_loaders(self):
         self._data_loaders = {}
 
+    def close(self):
+        """
+        Drops the data loaders, which shuts their worker processes down
+        and removes the swap files of the loader manager.
+        """
+        self.reset_loaders()
+        self.loader_manager.close()
+
     @staticmethod
     def _yield_batches_from_epochs(loader, start_epoch):
         current_epoch = start_epoch
@@ -112,12 +134,16 @@ class EnvisTrainer(EnvisBase):
     def data_loaders(self):
         if self._data_loaders:
             return self._data_loaders
-        # TODO : FIX if not client_id will load whole dataset
+        # a partitioned dataset only loads the shard of this client,
+        # otherwise the whole dataset is loaded
         self.model_preproc.load()
         # 3. Get training data somewhere
+        # loaders built in an earlier round keep their workers, only the
+        # datasets are swapped
         with self.data_random:
             train_data = self.model_preproc.dataset('train')
-            train_data_loader = self.model_preproc.data_loader(
+            train_data_loader = self.loader_manager.loader(
+                'train',
                 train_data,
                 batch_size=self.train_config.batch_size,
                 num_workers=self.train_config.num_workers,
@@ -126,7 +152,8 @@ class EnvisTrainer(EnvisBase):
                 shuffle=True,
                 drop_last=True)
 
-        train_eval_data_loader = self.model_preproc.data_loader(
+        train_eval_data_loader = self.loader_manager.loader(
+            'train_eval',
             train_data,
             pin_memory=self.train_config.pin_memory,
             num_workers=self.train_config.num_workers,
@@ -134,7 +161,8 @@ class EnvisTrainer(EnvisBase):
             batch_size=self.train_config.eval_batch_size)
 
         val_data = self.model_preproc.dataset('val')
-        val_data_loader = self.model_preproc.data_loader(
+        val_data_loader = self.loader_manager.loader(
+            'val',
             val_data,
             num_workers=self.train_config.num_workers,
             pin_memory=self.train_config.pin_memory,
@@ -145,6 +173,15 @@ class EnvisTrainer(EnvisBase):
             'train_eval': train_eval_data_loader,
             'val': val_data_loader
         }
+        if self.train_config.num_prefetch > 0:
+            self._data_loaders = {
+                name: PrefetchLoader(
+                    loader,
+                    num_prefetch=self.train_config.num_prefetch,
+                    pin_memory=self.train_config.pin_memory)
+                for name, loader in self._data_loaders.items()
+            }
+        return self._data_loaders
 
     @staticmethod
     def eval_model(
@@ -155,12 +192,19 @@ class EnvisTrainer(EnvisBase):
             num_eval_batches=-1,
             best_acc_test=None,
             best_auc_test=None,
-            step=-1):
+            step=-1,
+            quantization=None):
         scores = []
         targets = []
         model.eval()
         total_len = num_eval_batches if num_eval_batches > 0 else len(loader)
-        with torch.no_grad():
+        if quantization is not None:
+            # the embedding bags are swapped for quantized copies during
+            # the evaluation only
+            quantized = quantized_embeddings(model, quantization)
+        else:
+            quantized = contextlib.nullcontext()
+        with torch.no_grad(), quantized:
             t_loader = tqdm(enumerate(loader), unit="batch", total=total_len)
             for i, testBatch in t_loader:
                 # early exit if nbatches was set by the user and was exceeded
@@ -216,6 +260,15 @@ class EnvisTrainer(EnvisBase):
 
         return False, results
 
+    def log_cache_stats(self, step):
+        # hit rates of the embedding row caches since the last report
+        for name, module in self.model.named_modules():
+            if isinstance(module, CachedEmbeddingBag):
+                self.logger.add_scalar(
+                    'train/cache_hit_rate/' + name, module.hit_rate,
+                    global_step=step)
+                module.reset_stats()
+
     def store_state(self):
         assert self.model is not None
         return {
@@ -230,7 +283,8 @@ class EnvisTrainer(EnvisBase):
                 self.data_loaders['train_eval'],
                 eval_section='train_eval',
                 num_eval_batches=self.train_config.num_eval_batches,
-                logger=self.logger, step=-1)
+                logger=self.logger, step=-1,
+                quantization=self.train_config.eval_quantization)
 
         if self.train_config.eval_on_val:
             _, results['test_metrics'] = self.eval_model(
@@ -239,7 +293,8 @@ class EnvisTrainer(EnvisBase):
                 eval_section='test',
                 logger=self.logger,
                 num_eval_batches=self.train_config.num_eval_batches,
-                step=-1)
+                step=-1,
+                quantization=self.train_config.eval_quantization)
         return results
 
     def train(self, modeldir=None):
@@ -253,6 +308,7 @@ class EnvisTrainer(EnvisBase):
             total_train_len = len(self.data_loaders['train'])
         train_dl = self._yield_batches_from_epochs(
             self.data_loaders['train'], start_epoch=current_epoch)
+        quantization = self.train_config.eval_quantization
 
         # 4. Start training loop
         with self.data_random:
@@ -282,7 +338,8 @@ class EnvisTrainer(EnvisBase):
                             'train_eval',
                             self.logger,
                             self.train_config.num_eval_batches,
-                            step=last_step)
+                            step=last_step,
+                            quantization=quantization)
 
                     if self.train_config.eval_on_val:
                         if self.eval_model(
@@ -293,7 +350,8 @@ class EnvisTrainer(EnvisBase):
                                 self.train_config.num_eval_batches,
                                 best_acc_test=best_acc_test,
                             best_auc_test=best_auc_test,
-                                step=last_step)[1]:
+                                step=last_step,
+                                quantization=quantization)[1]:
                             self.saver.save(modeldir, last_step,
                                             current_epoch, is_best=True)
 
@@ -317,6 +375,7 @@ class EnvisTrainer(EnvisBase):
                         global_step=last_step)
                     if self.train_config.log_gradients:
                         self.logger.log_gradients(self.model, last_step)
+                    self.log_cache_stats(last_step)
 
                 last_step += 1
                 # Run saver
@@ -0,0 +1,306 @@
+import itertools
+import mmap
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+import torch
+
+# seconds a blocked producer waits before checking if it was stopped
+_PUT_TIMEOUT = 0.1
+
+
+class _End:
+    pass
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def pin_memory(args):
+    if isinstance(args, (list, tuple)):
+        return [pin_memory(arg) for arg in args]
+    elif isinstance(args, dict):
+        return {k: pin_memory(v) for k, v in args.items()}
+    elif isinstance(args, torch.Tensor):
+        return args if args.is_pinned() else args.pin_memory()
+    # anything else, e.g. sample ids or metadata, is passed through
+    return args
+
+
+def _to_device(args, device):
+    # like `map_to_cuda`, but leaves non-tensor leaves unchanged
+    if isinstance(args, (list, tuple)):
+        return [_to_device(arg, device) for arg in args]
+    elif isinstance(args, dict):
+        return {k: _to_device(v, device) for k, v in args.items()}
+    elif isinstance(args, torch.Tensor):
+        return args.cuda(device, non_blocking=True)
+    return args
+
+
+def _record_stream(args, stream):
+    # tell the caching allocator that `stream` uses the prefetched tensors
+    if isinstance(args, (list, tuple)):
+        for arg in args:
+            _record_stream(arg, stream)
+    elif isinstance(args, dict):
+        for arg in args.values():
+            _record_stream(arg, stream)
+    elif isinstance(args, torch.Tensor):
+        args.record_stream(stream)
+
+
+class PrefetchLoader:
+    """
+    Wraps a data loader and keeps up to `num_prefetch` batches ready on
+    a background thread. On GPU the batches are pinned and copied to
+    `device` with non blocking copies on a separate stream, so fetching,
+    collating and copying a batch overlaps with the computation on the
+    previous one. On CPU only the fetching is overlapped.
+
+    Arguments
+    ----------
+    loader: iterable
+        The wrapped loader, e.g. a `torch.utils.data.DataLoader`.
+    num_prefetch: int
+        Number of batches fetched ahead of the consumer.
+    device: torch.device, optional
+        Device the batches are moved to, the current CUDA device by
+        default. Batches stay on the CPU if CUDA is not available.
+    pin_memory: bool
+        Pin the batches before copying them to the device.
+    """
+
+    def __init__(self, loader, num_prefetch=2, device=None, pin_memory=True):
+        self.loader = loader
+        self.num_prefetch = num_prefetch
+        self.device = device
+        if device is None:
+            self.use_cuda = torch.cuda.is_available()
+        else:
+            self.use_cuda = torch.device(device).type == "cuda"
+        self.pin_memory = pin_memory and self.use_cuda
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        # the iterator is created and the first batch is fetched on the
+        # calling thread: the random draws of a loader (e.g. the worker
+        # seeds, or the seed of a sampler which only runs on the first
+        # fetch) then use the caller's random state and do not race
+        # with it
+        batch_iter = iter(self.loader)
+        try:
+            first = next(batch_iter)
+        except StopIteration:
+            return
+        batch_iter = itertools.chain([first], batch_iter)
+        thread = threading.Thread(
+            target=self._produce, args=(batch_iter, batches, stop, stream),
+            daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if isinstance(item, _End):
+                    return
+                if isinstance(item, _Failure):
+                    raise item.exc
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    _record_stream(batch, current)
+                yield batch
+        finally:
+            # unblock and wait for the producer if the consumer stopped
+            # early (or failed)
+            stop.set()
+            thread.join()
+
+    def _produce(self, batch_iter, batches, stop, stream):
+        try:
+            for batch in batch_iter:
+                event = None
+                if self.use_cuda:
+                    with torch.cuda.stream(stream):
+                        if self.pin_memory:
+                            batch = pin_memory(batch)
+                        batch = _to_device(batch, self.device)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                if not self._put(batches, (batch, event), stop):
+                    return
+            self._put(batches, _End(), stop)
+        except Exception as exc:
+            self._put(batches, _Failure(exc), stop)
+
+    @staticmethod
+    def _put(batches, item, stop):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def _open_memmap(filename, dtype, mode, offset, shape):
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset,
+                     shape=shape)
+
+
+class _MemmapPickler(pickle.Pickler):
+    """
+    Pickles memory mapped arrays (and contiguous views of them) as a
+    reference to their file region, which the unpickling process maps
+    again instead of receiving a copy of the data.
+    """
+
+    def reducer_override(self, obj):
+        if not isinstance(obj, np.memmap) or obj._mmap is None \
+                or obj.filename is None or obj.size == 0 \
+                or not obj.flags.c_contiguous:
+            return NotImplemented
+        # the map starts at the allocation granularity below the offset
+        # the array was opened with, views are located relative to it
+        start = obj.offset - obj.offset % mmap.ALLOCATIONGRANULARITY
+        base = np.frombuffer(obj._mmap, dtype=np.uint8)
+        offset = start + obj.__array_interface__["data"][0] \
+            - base.__array_interface__["data"][0]
+        mode = "r+" if obj.mode == "w+" else obj.mode
+        return _open_memmap, (
+            obj.filename, obj.dtype, mode, offset, obj.shape)
+
+
+class SwappableDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset whose underlying `dataset` can be swapped while
+    the (persistent) worker processes of its loader keep running. A swap
+    pickles the new dataset once to `swap_dir` and bumps a generation
+    counter in shared memory; every worker reloads the dataset the next
+    time it fetches a sample of the new generation. Memory mapped arrays
+    of the dataset are pickled as file references and mapped again by
+    the workers.
+
+    Datasets must only be swapped between epochs, while no iterator of
+    the loader is running.
+    """
+
+    def __init__(self, dataset, swap_dir):
+        self.dataset = dataset
+        self.swap_dir = swap_dir
+        self._shared_generation = torch.multiprocessing.Value("i", 0)
+        self._generation = 0
+
+    def _swap_file(self, generation):
+        return os.path.join(self.swap_dir, "{0}.pkl".format(generation))
+
+    def swap(self, dataset, num_workers):
+        generation = self._generation + 1
+        if num_workers > 0:
+            path = self._swap_file(generation)
+            with open(path + ".tmp", "wb") as f:
+                _MemmapPickler(
+                    f, protocol=pickle.HIGHEST_PROTOCOL).dump(dataset)
+            os.replace(path + ".tmp", path)
+        self.dataset = dataset
+        self._generation = generation
+        self._shared_generation.value = generation
+        # workers which did not fetch since the last swap skip straight
+        # to the newest dataset
+        previous = self._swap_file(generation - 1)
+        if os.path.exists(previous):
+            os.remove(previous)
+
+    def _sync(self):
+        generation = self._shared_generation.value
+        if generation != self._generation:
+            with open(self._swap_file(generation), "rb") as f:
+                self.dataset = pickle.load(f)
+            self._generation = generation
+
+    def __getitem__(self, index):
+        self._sync()
+        return self.dataset[index]
+
+    def __getitems__(self, indices):
+        self._sync()
+        if hasattr(self.dataset, "__getitems__"):
+            return self.dataset.__getitems__(indices)
+        return [self.dataset[index] for index in indices]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class LoaderManager:
+    """
+    Keeps the data loaders of a trainer, and with `persistent_workers`
+    their worker processes, alive across federated rounds. Asking for a
+    loader that already exists only swaps in the new client dataset, so
+    a round no longer starts a new set of workers.
+
+    Arguments
+    ----------
+    build_loader: callable
+        Builds a loader from a dataset and keyword arguments, e.g. the
+        `data_loader` of a preprocessor.
+    """
+
+    def __init__(self, build_loader):
+        self.build_loader = build_loader
+        self.loaders = {}
+        self.datasets = {}
+        self.swap_dir = tempfile.mkdtemp(prefix="envis_loaders_")
+        # removes the swap files if the manager is never closed
+        self._cleanup = weakref.finalize(
+            self, shutil.rmtree, self.swap_dir, ignore_errors=True)
+
+    def loader(self, name, dataset, **kwargs):
+        """
+        Returns the loader `name` over `dataset`. The loader is built on
+        the first call, later calls swap `dataset` into it. Iterable
+        datasets cannot be swapped, their loader is rebuilt instead.
+        """
+        swappable = self.datasets.get(name)
+        if swappable is not None and \
+                not isinstance(dataset, torch.utils.data.IterableDataset):
+            swappable.swap(dataset, kwargs.get("num_workers", 0))
+            return self.loaders[name]
+
+        self.close(name)
+        if isinstance(dataset, torch.utils.data.IterableDataset):
+            self.loaders[name] = self.build_loader(dataset, **kwargs)
+            return self.loaders[name]
+        swap_dir = os.path.join(self.swap_dir, name)
+        os.makedirs(swap_dir, exist_ok=True)
+        self.datasets[name] = SwappableDataset(dataset, swap_dir)
+        self.loaders[name] = self.build_loader(self.datasets[name], **kwargs)
+        return self.loaders[name]
+
+    def close(self, name=None):
+        """
+        Drops the loader `name` (all loaders by default). Its worker
+        processes shut down once the last reference to the loader is
+        gone. The swap files are removed with the last loader.
+        """
+        names = list(self.loaders) if name is None else [name]
+        for loader_name in names:
+            self.loaders.pop(loader_name, None)
+            self.datasets.pop(loader_name, None)
+        if not self.loaders:
+            shutil.rmtree(self.swap_dir, ignore_errors=True)
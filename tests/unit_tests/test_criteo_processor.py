@@ -0,0 +1,473 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from datasets.criteo.criteo_dataset import (ConcatColumns, CriteoBatchCache,
+                                            CriteoDataset,
+                                            CriteoStreamingDataset,
+                                            batched_data_loader,
+                                            collate_wrapper_criteo_length,
+                                            collate_wrapper_criteo_offset)
+from datasets.criteo import criteo_sharding, criteo_terabyte_processor
+from datasets.criteo.criteo_processor import CriteoDataProcessor
+from datasets.criteo.criteo_terabyte_processor import (
+    CriteoTerabyteProcessor, generate_synthetic_day_files)
+
+
+def write_raw_criteo(path, num_rows, seed=0):
+    """write a small raw criteo file with missing values
+    """
+    rng = np.random.RandomState(seed)
+    with open(path, "w") as f:
+        for _ in range(num_rows):
+            fields = [str(rng.randint(0, 2))]
+            fields += [
+                "" if rng.rand() < 0.2 else str(rng.randint(-2, 1000))
+                for _ in range(13)]
+            fields += [
+                "" if rng.rand() < 0.2
+                else "%08x" % rng.randint(0, 2 ** 32, dtype=np.uint64)
+                for _ in range(26)]
+            f.write("\t".join(fields) + "\n")
+
+
+def transform_line(line):
+    """reference line-by-line parser
+    """
+    line = [x if x not in ("", "\n") else "0"
+            for x in line.rstrip("\n").split("\t")]
+    return (np.int32(line[0]),
+            np.array(line[1:14], dtype=np.int32),
+            np.array([int(x, 16) for x in line[14:]],
+                     dtype=np.uint32).view(np.int32))
+
+
+@pytest.mark.parametrize("chunk_size", [7, 1000])
+def test_read_chunks_matches_line_parser(tmp_path, chunk_size):
+    """test the chunked parser against the line parser
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 50)
+    with open(datfile) as f:
+        expected = [transform_line(line) for line in f]
+
+    chunks = list(CriteoDataProcessor._read_chunks(datfile, chunk_size))
+    y = np.concatenate([c[0] for c in chunks])
+    X_int = np.concatenate([c[1] for c in chunks])
+    X_cat = np.concatenate([c[2] for c in chunks])
+
+    assert y.dtype == X_int.dtype == X_cat.dtype == np.int32
+    np.testing.assert_array_equal(y, [e[0] for e in expected])
+    np.testing.assert_array_equal(X_int, [e[1] for e in expected])
+    np.testing.assert_array_equal(X_cat, [e[2] for e in expected])
+
+
+def test_memory_mapped_output_matches_npz(tmp_path):
+    """test that the memory mapped columns hold the npz contents
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+
+    npz_proc = CriteoDataProcessor(datfile, "processed")
+    npz_proc.process_data()
+    mmap_proc = CriteoDataProcessor(datfile, "processed", memory_map=True)
+    mmap_proc.process_data()
+
+    X_int, X_cat, y, counts = mmap_proc.load_arrays()
+    assert isinstance(X_cat, np.memmap)
+    with np.load(str(tmp_path / "processed.npz")) as data:
+        np.testing.assert_array_equal(X_int, data["X_int"])
+        np.testing.assert_array_equal(X_cat, data["X_cat"])
+        np.testing.assert_array_equal(y, data["y"])
+        np.testing.assert_array_equal(counts, data["counts"])
+
+    mmap_proc.load()
+    assert len(mmap_proc.dataset("train")) + \
+        len(mmap_proc.dataset("val")) + \
+        len(mmap_proc.dataset("test")) == len(y)
+
+
+def test_splits_index_shared_arrays(tmp_path):
+    """test that the splits resolve rows through their index arrays
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    proc = CriteoDataProcessor(datfile, "processed", max_ind_range=50)
+    proc.process_data()
+    proc.load()
+
+    X_int, X_cat, y, _ = proc.load_arrays()
+    train = proc.dataset("train")
+    assert train.X_cat is proc.dataset("test").X_cat
+    rows = train.indices[[3, 0, 5]]
+
+    x_int, x_cat, target = train[[3, 0, 5]]
+    np.testing.assert_array_equal(x_int, X_int[rows])
+    np.testing.assert_array_equal(x_cat, X_cat[rows] % 50)
+    np.testing.assert_array_equal(target, y[rows])
+    np.testing.assert_array_equal(train[0][1], X_cat[rows[1]] % 50)
+
+
+@pytest.mark.parametrize("collate_fn", [collate_wrapper_criteo_length,
+                                        collate_wrapper_criteo_offset])
+def test_batched_loader_matches_per_sample_loader(collate_fn):
+    """test batch fetching against per sample fetching and collation
+    """
+    rng = np.random.RandomState(0)
+    data = CriteoDataset(
+        rng.randint(0, 100, size=(50, 13)).astype(np.int32),
+        rng.randint(0, 1000, size=(50, 26)).astype(np.int32),
+        rng.randint(0, 2, size=50).astype(np.int32),
+        max_ind_range=100,
+        indices=rng.permutation(50)[:40])
+    batched = batched_data_loader(data, batch_size=16, collate_fn=collate_fn)
+
+    assert len(batched) == 3
+    for k, (inputs, T) in enumerate(batched):
+        positions = range(16 * k, min(16 * (k + 1), len(data)))
+        ref_inputs, ref_T = collate_fn([data[i] for i in positions])
+        assert inputs[2].shape == (26, len(T))
+        assert torch.equal(T, ref_T)
+        for tensor, ref_tensor in zip(inputs, ref_inputs):
+            assert tensor.dtype == ref_tensor.dtype
+            assert torch.equal(tensor, ref_tensor)
+
+    # a plain loader still collates one sample per row
+    X_int, X_cat, y = next(iter(
+        torch.utils.data.DataLoader(data, batch_size=16)))
+    assert X_int.shape == (16, 13) and X_cat.shape == (16, 26)
+    assert torch.equal(y, torch.as_tensor(data.y[data.indices[:16]]))
+
+
+def test_feature_dictionaries_are_sorted_uniques(tmp_path):
+    """test the merged per day uniques against the raw data
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    CriteoDataProcessor(datfile, "processed",
+                        dataset_multiprocessing=True).process_data()
+
+    X_cat = np.concatenate([
+        c[2] for c in CriteoDataProcessor._read_chunks(datfile)])
+    with np.load(str(tmp_path / "train_fea_count.npz")) as data:
+        counts = data["counts"]
+    for j in range(26):
+        with np.load(str(tmp_path / "train_fea_dict_{0}.npz".format(j))) \
+                as data:
+            np.testing.assert_array_equal(
+                data["unique"], np.unique(X_cat[:, j]))
+        assert counts[j] == len(np.unique(X_cat[:, j]))
+
+
+def test_categorical_remapping(tmp_path):
+    """test that every feature is remapped into its dictionary
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    proc = CriteoDataProcessor(datfile, "processed")
+    proc.process_data()
+
+    raw = np.concatenate([
+        c[2] for c in CriteoDataProcessor._read_chunks(datfile)])
+    _, X_cat, _, counts = proc.load_arrays()
+    assert X_cat.dtype == np.int32
+    for j in range(26):
+        unique = np.unique(raw[:, j])
+        assert X_cat[:, j].max() == counts[j] - 1
+        np.testing.assert_array_equal(unique[X_cat[:, j]], raw[:, j])
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_hash_ids_keep_raw_ids(tmp_path, memory_map):
+    """test that hashed ids skip the dictionaries and keep the raw ids
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    proc = CriteoDataProcessor(datfile, "processed", memory_map=memory_map,
+                               hash_ids=True)
+    proc.process_data()
+
+    raw = np.concatenate([
+        c[2] for c in CriteoDataProcessor._read_chunks(datfile)])
+    _, X_cat, _, counts = proc.load_arrays()
+    np.testing.assert_array_equal(X_cat, raw)
+    assert not os.path.exists(str(tmp_path / "train_fea_dict_0.npz"))
+    assert not list(tmp_path.glob("*_unique.npz"))
+    proc.load_data_description()
+    assert list(proc.ln_emb) == [2 ** 32] * 26
+
+    proc.load()
+    data = proc.dataset("train")
+    _, X_cat, _ = data[np.arange(len(data))]
+    np.testing.assert_array_equal(X_cat, raw[data.indices])
+    assert sum(len(proc.dataset(split))
+               for split in ("train", "val", "test")) == 200
+
+
+@pytest.mark.parametrize("trailing_newline", [True, False])
+@pytest.mark.parametrize("multiprocessing", [True, False])
+def test_day_byte_ranges(tmp_path, monkeypatch, trailing_newline,
+                         multiprocessing):
+    """test that the day byte ranges cover the raw lines in order
+    """
+    monkeypatch.setattr(criteo_sharding, "BLOCK_SIZE", 64)
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 45)
+    if not trailing_newline:
+        with open(datfile, "rb+") as f:
+            f.truncate(f.seek(0, 2) - 1)
+
+    proc = CriteoDataProcessor(datfile, "processed",
+                               dataset_multiprocessing=multiprocessing)
+    total_count, total_per_file, day_offsets = proc.get_counts()
+    assert total_count == 45
+    assert total_per_file == [7, 7, 7, 6, 6, 6, 6]
+
+    full = list(CriteoDataProcessor._read_chunks(datfile))[0]
+    start = 0
+    for i in range(proc.days):
+        day = list(CriteoDataProcessor._read_chunks(
+            datfile, byte_range=(day_offsets[i], day_offsets[i + 1])))[0]
+        end = start + total_per_file[i]
+        for column, full_column in zip(day, full):
+            np.testing.assert_array_equal(column, full_column[start:end])
+        start = end
+
+
+def test_process_data_resumes_from_manifest(tmp_path, monkeypatch):
+    """test that only stages with changed inputs are rerun
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    CriteoDataProcessor(datfile, "processed").process_data()
+
+    parsed = []
+    process_one_file = CriteoDataProcessor._process_one_file
+
+    def record_parse(*args):
+        parsed.append(args[2])
+        return process_one_file(*args)
+    monkeypatch.setattr(
+        CriteoDataProcessor, "_process_one_file", staticmethod(record_parse))
+
+    # nothing changed
+    CriteoDataProcessor(datfile, "processed").process_data()
+    assert parsed == []
+
+    # a day output which differs from the recorded one is rebuilt
+    with open(str(tmp_path / "train_day_3.npz"), "ab") as f:
+        f.write(b"partial")
+    CriteoDataProcessor(datfile, "processed").process_data()
+    assert parsed == [3]
+
+    # a different sub-sampling rate invalidates every day
+    parsed.clear()
+    CriteoDataProcessor(
+        datfile, "processed", sub_sample_rate=0.5).process_data()
+    assert parsed == list(range(7))
+    assert not list(tmp_path.glob("*.tmp.*"))
+
+
+@pytest.mark.parametrize("max_ind_range", [0, 50])
+def test_terabyte_processor(tmp_path, monkeypatch, max_ind_range):
+    """test the per day terabyte columns against the raw day files
+    """
+    # the chunk uniques of a day are merged more than once
+    monkeypatch.setattr(criteo_terabyte_processor, "UNIQUE_MERGE_CHUNKS", 2)
+    datfile = str(tmp_path / "day")
+    generate_synthetic_day_files(datfile, days=3, rows_per_day=40)
+    proc = CriteoTerabyteProcessor(
+        datfile, "terabyte", days=3, max_ind_range=max_ind_range,
+        dataset_multiprocessing=True, chunk_size=16)
+    proc.process_data()
+
+    raw = [np.concatenate([c[2] for c in CriteoDataProcessor._read_chunks(
+        "{0}_{1}".format(datfile, day))]) for day in range(3)]
+    raw = np.concatenate(raw)
+    X_int, X_cat, y, counts = proc.load_arrays()
+    assert isinstance(X_cat, ConcatColumns)
+    X_int, X_cat, y = X_int[:], X_cat[:], y[:]
+    assert len(y) == 120 and X_int.min() >= 0
+    for j in range(26):
+        if max_ind_range > 0:
+            expected = raw[:, j].view(np.uint32) % max_ind_range
+        else:
+            expected = np.searchsorted(np.unique(raw[:, j]), raw[:, j])
+            assert counts[j] == len(np.unique(raw[:, j]))
+        np.testing.assert_array_equal(X_cat[:, j], expected)
+
+    proc.load()
+    assert proc.ln_emb.tolist() == counts.tolist()
+    test = proc.dataset("test")
+    assert len(proc.dataset("train")) == 80
+    assert len(test) + len(proc.dataset("val")) == 40
+    np.testing.assert_array_equal(test[[0, 3]][2], y[[80, 83]])
+
+
+@pytest.mark.parametrize("partition", ["iid", "dirichlet", "day"])
+def test_client_shards_partition_splits(tmp_path, partition):
+    """test that the client shards partition the rows of every split
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    proc = CriteoDataProcessor(
+        datfile, "processed", randomize="none", num_clients=4,
+        partition=partition)
+    proc.process_data()
+    assert len(list(tmp_path.glob("processed_client_*.npz"))) == 4
+
+    full = CriteoDataProcessor(datfile, "processed", randomize="none")
+    full.load()
+    shards = {split: [] for split in ("train", "val", "test")}
+    for client_id in range(4):
+        proc.load(client_id)
+        for split, data in shards.items():
+            data.append(proc.dataset(split))
+
+    # every row of a split belongs to exactly one client
+    for split, data in shards.items():
+        expected = full.dataset(split)
+        _, X_cat, y = expected[np.arange(len(expected))]
+        rows = [shard[np.arange(len(shard))] for shard in data]
+        shard_X_cat = np.concatenate([row[1] for row in rows])
+        shard_y = np.concatenate([row[2] for row in rows])
+        order, ref_order = np.lexsort(shard_X_cat.T), np.lexsort(X_cat.T)
+        np.testing.assert_array_equal(shard_X_cat[order], X_cat[ref_order])
+        np.testing.assert_array_equal(shard_y[order], y[ref_order])
+
+    proc.load(1)
+    assert len(proc.dataset("train").X_cat) == \
+        sum(len(proc.dataset(split)) for split in ("train", "val", "test"))
+    with pytest.raises(ValueError):
+        proc.load(4)
+
+
+def test_streaming_processor_partitions_clients(tmp_path):
+    """test that a streamed dataset is partitioned from its index splits
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    proc = CriteoDataProcessor(
+        datfile, "processed", memory_map=True, streaming=True,
+        num_clients=2)
+    proc.process_data()
+
+    full = CriteoDataProcessor(datfile, "processed", memory_map=True)
+    full.load()
+    for split in ("train", "val", "test"):
+        sizes = []
+        for client_id in range(2):
+            proc.load(client_id)
+            sizes.append(len(proc.dataset(split)))
+        assert sum(sizes) == len(full.dataset(split))
+
+    # without a client the whole dataset is still streamed
+    proc.load()
+    assert "shards" in proc.data_items["train"]
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_dataset_covers_split(tmp_path, num_workers):
+    """test that the shuffled stream yields every row of a split once
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 300)
+    proc = CriteoDataProcessor(
+        datfile, "processed", memory_map=True, streaming=True,
+        shuffle_buffer_size=32)
+    proc.process_data()
+    proc.load()
+    data = proc.dataset("train")
+    data.block_size = 10
+    assert isinstance(data, CriteoStreamingDataset)
+
+    X_int, X_cat, y, _ = proc.load_arrays()
+    rows = slice(0, data.shards[-1][1])
+    loader = proc.data_loader(data, batch_size=16, shuffle=True,
+                              num_workers=num_workers)
+    batches = list(loader)
+    assert all(len(T) == 16 for _, T in batches[:-2])
+    lS_i = torch.cat([inputs[2] for inputs, _ in batches], dim=1).numpy()
+    streamed, expected = lS_i.T, X_cat[rows]
+    assert not np.array_equal(streamed, expected)
+    np.testing.assert_array_equal(
+        streamed[np.lexsort(streamed.T)], expected[np.lexsort(expected.T)])
+
+    # without shuffling the rows are streamed in order
+    batches = list(proc.data_loader(data, batch_size=16))
+    assert len(batches) == len(data.batched(16))
+    T = torch.cat([T for _, T in batches]).view(-1).numpy()
+    np.testing.assert_array_equal(T, y[rows])
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_streaming_dataset_reshuffles_every_epoch(tmp_path, num_workers):
+    """test that every epoch streams the rows in a new order
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 300)
+    proc = CriteoDataProcessor(
+        datfile, "processed", memory_map=True, streaming=True,
+        shuffle_buffer_size=32)
+    proc.process_data()
+    proc.load()
+    data = proc.dataset("train")
+    data.block_size = 10
+
+    def make_loader():
+        return proc.data_loader(data, batch_size=16, shuffle=True,
+                                num_workers=num_workers,
+                                persistent_workers=num_workers > 0)
+
+    torch.manual_seed(0)
+    loader = make_loader()
+    epochs = [torch.cat([T for _, T in loader]).view(-1) for _ in range(2)]
+    assert not torch.equal(epochs[0], epochs[1])
+    assert torch.equal(epochs[0].sort().values, epochs[1].sort().values)
+
+    # the order follows the seed
+    torch.manual_seed(0)
+    loader = make_loader()
+    assert torch.equal(torch.cat([T for _, T in loader]).view(-1), epochs[0])
+
+
+def test_batch_cache_matches_collated_batches(tmp_path):
+    """test the cached batches against collating the split
+    """
+    datfile = str(tmp_path / "train.txt")
+    write_raw_criteo(datfile, 200)
+    proc = CriteoDataProcessor(datfile, "processed", max_ind_range=50,
+                               batch_cache_size=16)
+    proc.process_data()
+    proc.load()
+    cache = proc.dataset("val")
+    assert isinstance(cache, CriteoBatchCache)
+
+    proc.batch_cache_size = 0
+    data = proc.dataset("val")
+    expected = batched_data_loader(
+        data, batch_size=16, collate_fn=collate_wrapper_criteo_length)
+    assert len(cache) == len(expected)
+    for (inputs, T), (ref_inputs, ref_T) in zip(
+            proc.data_loader(cache, batch_size=16), expected):
+        assert torch.equal(T, ref_T)
+        for tensor, ref_tensor in zip(inputs, ref_inputs):
+            assert tensor.dtype == ref_tensor.dtype
+            assert torch.equal(tensor, ref_tensor)
+
+    # the cache is reused as long as the processed data is unchanged
+    mtime = os.path.getmtime(str(tmp_path / "processed_val_batches_T.npy"))
+    proc.batch_cache_size = 16
+    proc.dataset("val")
+    assert os.path.getmtime(
+        str(tmp_path / "processed_val_batches_T.npy")) == mtime
+    cache = proc.dataset("train")
+    shuffled = list(proc.data_loader(
+        cache, batch_size=16, shuffle=True, drop_last=True))
+    assert len(shuffled) == cache.num_full_batches > 0
+    assert all(len(T) == 16 for _, T in shuffled)
+
+    # the cache cannot change the batch size of a loader
+    with pytest.raises(ValueError):
+        proc.data_loader(cache, batch_size=32)
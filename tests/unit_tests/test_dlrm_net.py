@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from experiments.dlrm.net import DLRM_Net
+from fedrec.modules.embeddings import (FusedEmbeddingBag,
+                                       QuantizedFusedEmbeddingBag,
+                                       quantized_embeddings)
+
+
+def make_dlrm(ln_emb, embedding_types, m_spa=16, **kwargs):
+    preproc = SimpleNamespace(ln_emb=np.array(ln_emb), m_den=4)
+    return DLRM_Net(
+        preproc,
+        arch_feature_emb_size=m_spa,
+        arch_mlp_bot=[4, 8],
+        arch_mlp_top=[32, 1],
+        arch_interaction_op="dot",
+        embedding_types=embedding_types,
+        **kwargs)
+
+
+def make_batch(ln_emb, batch_size):
+    dense_x = torch.rand(batch_size, 4)
+    lS_o = torch.arange(batch_size).repeat(len(ln_emb), 1)
+    lS_i = torch.stack([torch.randint(0, n, (batch_size,)) for n in ln_emb])
+    return dense_x, lS_o, lS_i
+
+
+def test_md_embeddings_keep_interaction_dim():
+    """test the mixed-dimension tables shrink and project back to m_spa
+    """
+    torch.manual_seed(0)
+    ln_emb = [4, 100, 10000, 1000000]
+    base = make_dlrm(ln_emb, {"base": {"name": "torch_bag"}})
+    md = make_dlrm(ln_emb, {"md": {"alpha": 0.3, "round_dims": True}})
+
+    dims = [emb.embs.embedding_dim for emb in md.emb_l]
+    assert dims[0] == 16
+    assert dims == sorted(dims, reverse=True) and dims[-1] < 16
+    num_params = [sum(p.numel() for p in net.emb_l.parameters())
+                  for net in (base, md)]
+    assert num_params[1] * 4 < num_params[0]
+
+    out = md(*make_batch(ln_emb, 8))
+    assert out.shape == (8, 1)
+
+    # a budget gives every table at most m_spa dimensions
+    dims = DLRM_Net.md_dims(16, np.array(ln_emb), {"budget": 20000})
+    assert all(1 <= d <= 16 for d in dims)
+
+
+@pytest.mark.parametrize("itself", [False, True])
+def test_triu_interaction_matches_bmm(itself):
+    """test the triu dot interaction against the bmm gather
+    """
+    torch.manual_seed(0)
+    ln_emb = [10, 20, 30]
+    nets = [make_dlrm(ln_emb, {"base": {"name": "torch_bag"}}, m_spa=8,
+                      arch_interaction_itself=itself,
+                      arch_interaction_kernel=kernel)
+            for kernel in ("bmm", "triu")]
+    x = torch.rand(6, 8, requires_grad=True)
+    ly = [torch.rand(6, 8, requires_grad=True) for _ in ln_emb]
+
+    R = [net.interact_features(x, ly) for net in nets]
+    assert torch.allclose(R[0], R[1])
+    grads = [torch.autograd.grad(r.pow(2).sum(), [x] + ly) for r in R]
+    for expected, grad in zip(*grads):
+        assert torch.allclose(expected, grad)
+
+    # without autograd the buffers of the largest batch are reused
+    with torch.no_grad():
+        nets[1].interact_features(x, ly)
+        buffers = nets[1]._interaction_buffers
+        R = nets[1].interact_features(x[:4], [y[:4] for y in ly])
+        assert torch.allclose(R, nets[0].interact_features(
+            x[:4], [y[:4] for y in ly]))
+        assert nets[1]._interaction_buffers is buffers
+
+
+def test_fused_dlrm_evaluates_quantized():
+    """test that the fused tables of a DLRM are quantized for evaluation
+    """
+    torch.manual_seed(0)
+    ln_emb = [10, 20, 30]
+    net = make_dlrm(ln_emb, {"fused": {"name": "fused_bag"}})
+    net.eval()
+    batch = make_batch(ln_emb, 8)
+    with torch.no_grad():
+        expected = net(*batch)
+        with quantized_embeddings(net, "int8"):
+            assert not any(isinstance(m, FusedEmbeddingBag)
+                           for m in net.modules())
+            assert any(isinstance(m, QuantizedFusedEmbeddingBag)
+                       for m in net.modules())
+            out = net(*batch)
+        assert torch.allclose(out, expected, atol=5e-2)
+        assert torch.equal(net(*batch), expected)
+
+
+def test_raw_ids_need_hashed_embeddings():
+    """test that tables over the raw ids of hash_ids are rejected unless
+    they are hashed
+    """
+    ln_emb = [10, 2 ** 32]
+    for embedding_types in ({"base": {"name": "torch_bag"}},
+                            {"fused": {"name": "fused_bag"}}):
+        with pytest.raises(ValueError):
+            make_dlrm(ln_emb, embedding_types)
+
+    net = make_dlrm(ln_emb, {
+        "base": {"name": "torch_bag"},
+        "custom": {"name": "hash_emb", "num_buckets": 100},
+        "threshold": 1000})
+    dense_x, lS_o, _ = make_batch(ln_emb, 8)
+    lS_i = torch.randint(-2 ** 31, 2 ** 31 - 1, (2, 8))
+    lS_i[0] %= 10
+    assert net(dense_x, lS_o, lS_i).shape == (8, 1)
@@ -0,0 +1,246 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from fedrec.modules.embeddings import (CachedEmbeddingBag, FusedEmbeddingBag,
+                                       HashedEmbeddingBag, PrEmbeddingBag,
+                                       QREmbeddingBag,
+                                       QuantizedEmbeddingBag,
+                                       quantize_embeddings, quantize_module,
+                                       quantized_embeddings)
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_fused_embedding_bag_matches_tables(weighted):
+    """test the fused lookup against one embedding bag per table
+    """
+    torch.manual_seed(0)
+    rows = [5, 17, 3, 40]
+    fused = FusedEmbeddingBag(rows, 8, mode="sum", sparse=True, init=True)
+    tables = [fused.weight[offset:offset + n].detach().clone()
+              for offset, n in zip(fused.table_offsets.tolist(), rows)]
+
+    # every table gets 6 bags of varying length over 10 indices
+    lS_i = torch.stack([torch.randint(0, n, (10,)) for n in rows])
+    lS_o = torch.tensor([0, 1, 1, 4, 7, 9]).repeat(len(rows), 1)
+    weights = torch.rand(len(rows), 10) if weighted else None
+
+    ly = fused(lS_i, lS_o, per_sample_weights=weights)
+    ly_list = fused(list(lS_i), list(lS_o), per_sample_weights=None
+                    if weights is None else list(weights))
+    for t, table in enumerate(tables):
+        expected = F.embedding_bag(
+            lS_i[t], table, lS_o[t], mode="sum",
+            per_sample_weights=None if weights is None else weights[t])
+        assert torch.allclose(ly[t], expected, atol=1e-6)
+        assert torch.allclose(ly_list[t], expected, atol=1e-6)
+
+    sum(y.sum() for y in ly).backward()
+    assert fused.weight.grad.is_sparse
+
+
+@pytest.mark.parametrize("operation", ["concat", "add", "mult"])
+@pytest.mark.parametrize("num_collisions", [7, 8])
+def test_qr_embedding_bag_vectorized_matches_reference(
+        operation, num_collisions):
+    """test the vectorized quotient/remainder forward against the original
+    """
+    torch.manual_seed(0)
+    fast = QREmbeddingBag(
+        1000, 8, num_collisions, operation=operation, mode="sum")
+    reference = QREmbeddingBag(
+        1000, 8, num_collisions, operation=operation, mode="sum",
+        vectorized=False,
+        _weight=[fast.weight_q.detach().clone(),
+                 fast.weight_r.detach().clone()])
+
+    input = torch.randint(0, 1000, (12,))
+    offsets = torch.tensor([0, 3, 3, 8])
+    out = fast(input, offsets)
+    expected = reference(input, offsets)
+    assert torch.allclose(out, expected)
+
+    out.sum().backward()
+    expected.sum().backward()
+    assert torch.allclose(fast.weight_q.grad, reference.weight_q.grad)
+    assert torch.allclose(fast.weight_r.grad, reference.weight_r.grad)
+
+    # without a graph the index buffer is kept and reused
+    with torch.no_grad():
+        fast(input, offsets)
+        buffer = fast._index_buffer
+        assert torch.allclose(fast(input[:6], offsets[:2]),
+                              reference(input[:6], offsets[:2]))
+        assert fast._index_buffer is buffer
+
+
+@pytest.mark.parametrize("policy", ["lru", "lfu"])
+def test_cached_embedding_bag_matches_embedding_bag(tmp_path, policy):
+    """test training through the row cache against a full embedding bag
+    """
+    torch.manual_seed(0)
+    cached = CachedEmbeddingBag(
+        50, 4, cache_size=8, policy=policy, cache_dir=str(tmp_path))
+    full = torch.nn.EmbeddingBag.from_pretrained(
+        torch.from_numpy(np.array(cached.table)), freeze=False, mode="sum")
+    optimizers = [torch.optim.SGD(emb.parameters(), lr=0.1)
+                  for emb in (cached, full)]
+
+    offsets = torch.tensor([0, 2])
+    for step in range(20):
+        # a few hot rows and a cold one per batch
+        input = torch.tensor([step % 3, 3, 10 + step, step % 2])
+        for emb, optimizer in zip((cached, full), optimizers):
+            optimizer.zero_grad()
+            out = emb(input, offsets)
+            out.pow(2).sum().backward()
+            optimizer.step()
+            if emb is cached:
+                expected = out
+            else:
+                assert torch.allclose(out, expected, atol=1e-6)
+
+    # the evicted rows were written back, the cached ones are flushed
+    cached.flush()
+    assert np.allclose(cached.table, full.weight.detach().numpy(),
+                       atol=1e-6)
+    assert 0.5 < cached.hit_rate < 1.0
+    with pytest.raises(ValueError):
+        cached(torch.arange(9), torch.tensor([0]))
+
+
+def test_cached_embedding_bag_state_dict_holds_table(tmp_path):
+    """test that the state of the cached bag is its whole trained table
+    """
+    torch.manual_seed(0)
+    cached = CachedEmbeddingBag(50, 4, cache_size=4, cache_dir=str(tmp_path))
+    optimizer = torch.optim.SGD(cached.parameters(), lr=0.1)
+    for step in range(10):
+        optimizer.zero_grad()
+        cached(torch.tensor([step, step + 20]), torch.tensor([0])).sum() \
+            .backward()
+        optimizer.step()
+
+    state = {k: v.clone() for k, v in cached.state_dict().items()}
+    assert list(state) == ["table"]
+    assert state["table"].shape == (50, 4)
+    input, offsets = torch.tensor([1, 25, 40]), torch.tensor([0, 1])
+    expected = cached(input, offsets)
+
+    other = CachedEmbeddingBag(50, 4, cache_size=4, cache_dir=str(tmp_path))
+    other.load_state_dict(state)
+    assert torch.equal(other.state_dict()["table"], state["table"])
+    assert torch.allclose(other(input, offsets), expected)
+    with pytest.raises(RuntimeError):
+        other.load_state_dict({"weight": torch.zeros(4, 4)})
+
+
+@pytest.mark.parametrize("dtype,atol", [("int8", 2e-2), ("fp16", 1e-3)])
+def test_quantized_embedding_bag_matches_embedding_bag(dtype, atol):
+    """test the quantized lookup against the trained embedding bag
+    """
+    torch.manual_seed(0)
+    emb = torch.nn.EmbeddingBag(100, 16, mode="sum")
+    quantized = QuantizedEmbeddingBag.from_float(emb, dtype)
+    from_state = QuantizedEmbeddingBag.from_state_dict(
+        emb.state_dict(), dtype)
+
+    input = torch.randint(0, 100, (20,))
+    offsets = torch.tensor([0, 5, 5, 12])
+    weights = torch.rand(20)
+    for q in (quantized, from_state):
+        assert torch.allclose(q(input, offsets), emb(input, offsets),
+                              atol=4 * atol)
+        assert torch.allclose(
+            q(input, offsets, per_sample_weights=weights),
+            emb(input, offsets, per_sample_weights=weights), atol=4 * atol)
+        assert torch.allclose(q.dequantize(), emb.weight, atol=atol)
+    size = sum(t.numel() * t.element_size()
+               for t in quantized.state_dict().values())
+    assert size * 2 <= emb.weight.numel() * emb.weight.element_size()
+
+
+def test_quantized_embeddings_are_restored():
+    """test the quantized tables are only used inside the context
+    """
+    model = torch.nn.ModuleList([
+        torch.nn.EmbeddingBag(10, 4), PrEmbeddingBag(10, 2, base_dim=4)])
+    tables = [model[0], model[1].embs]
+    with quantized_embeddings(model, "int8"):
+        assert isinstance(model[0], QuantizedEmbeddingBag)
+        assert isinstance(model[1].embs, QuantizedEmbeddingBag)
+        assert model[1](torch.tensor([[1, 2]])).shape == (1, 4)
+    assert [model[0], model[1].embs] == tables
+
+
+@pytest.mark.parametrize("dtype,atol", [("int8", 5e-2), ("fp16", 1e-2)])
+@pytest.mark.parametrize("kind", ["fused", "cached", "hashed"])
+def test_quantize_module_matches_float(tmp_path, kind, dtype, atol):
+    """test the quantized copies of the other embedding bags
+    """
+    torch.manual_seed(0)
+    offsets = torch.tensor([0, 3])
+    if kind == "fused":
+        emb = FusedEmbeddingBag([20, 30], 8)
+        input = [torch.randint(0, 20, (5,)), torch.randint(0, 30, (5,))]
+        offsets = [offsets, offsets]
+    elif kind == "cached":
+        emb = CachedEmbeddingBag(50, 8, cache_size=8, cache_dir=str(tmp_path))
+        input = torch.randint(0, 50, (5,))
+    else:
+        emb = HashedEmbeddingBag(2 ** 32, 8, 50, combine="concat",
+                                 double=True)
+        input = torch.randint(-2 ** 31, 2 ** 31 - 1, (5,))
+
+    quantized = quantize_module(emb, dtype)
+    assert not any(p.requires_grad for p in quantized.parameters())
+    expected, out = emb(input, offsets), quantized(input, offsets)
+    if kind == "fused":
+        expected, out = torch.cat(expected), torch.cat(out)
+    assert torch.allclose(out, expected, atol=atol)
+
+    # models without a supported embedding bag are not quantized silently
+    assert quantize_module(QREmbeddingBag(10, 4, 3), dtype) is None
+    with pytest.raises(ValueError):
+        quantize_embeddings(torch.nn.ModuleList([QREmbeddingBag(10, 4, 3)]))
+
+
+@pytest.mark.parametrize("combine", ["sum", "concat"])
+@pytest.mark.parametrize("double", [False, True])
+def test_hashed_embedding_bag(combine, double):
+    """test the hashed lookup against lookups of the hashed buckets
+    """
+    torch.manual_seed(0)
+    emb = HashedEmbeddingBag(2 ** 32, 8, 50, num_hashes=4, combine=combine,
+                             double=double, sparse=True)
+    # raw 32-bit ids, stored as int32 by the preprocessing
+    input = torch.tensor([7, -1, 2 ** 31 - 1, -2 ** 31, 7, 123456])
+    offsets = torch.tensor([0, 2, 5])
+
+    buckets = emb.hash(input)
+    assert buckets.shape == (4, 6)
+    assert buckets.min() >= 0 and buckets.max() < 50
+    assert torch.equal(buckets[:, 0], buckets[:, 4])
+    # the same seed gives the same hash functions
+    assert torch.equal(buckets, HashedEmbeddingBag(
+        2 ** 32, 8, 50, num_hashes=4, combine=combine,
+        double=double).hash(input))
+    # uint32 ids hash like their int32 view
+    assert torch.equal(buckets[:, 1], emb.hash(torch.tensor([2 ** 32 - 1]))
+                       .view(-1))
+    if double:
+        assert all(len(set(b.tolist())) > 1 for b in buckets.t())
+
+    out = emb(input, offsets)
+    weight = emb.weight.detach()
+    if combine == "sum":
+        expected = sum(F.embedding_bag(b, weight, offsets, mode="sum")
+                       for b in buckets)
+    else:
+        expected = torch.cat([
+            F.embedding_bag(b + k * 50, weight, offsets, mode="sum")
+            for k, b in enumerate(buckets)], dim=1)
+    assert out.shape == (3, 8)
+    assert torch.allclose(out, expected, atol=1e-6)
+    out.sum().backward()
+    assert emb.weight.grad.is_sparse
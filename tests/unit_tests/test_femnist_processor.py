@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from datasets.femnist.femnist_dataset import FemnistDataset
+from datasets.femnist.femnist_processor import FemnistProcessor
+from PIL import Image
+
+
+def write_raw_femnist(data_dir, num_clients=5, seed=0):
+    """write small grayscale images and an unsorted client mapping
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(data_dir, "client_data_mapping"))
+    os.makedirs(os.path.join(data_dir, "img"))
+    rows = []
+    for client_id in range(num_clients):
+        for k in range(rng.randint(1, 6)):
+            sample_path = "img/{0}_{1}.png".format(client_id, k)
+            Image.fromarray(
+                rng.randint(0, 256, size=(8, 8)).astype(np.uint8)).save(
+                    os.path.join(data_dir, sample_path))
+            label_id = rng.randint(0, 62)
+            rows.append([client_id, sample_path, str(label_id), label_id])
+    df = pd.DataFrame(
+        rows, columns=["client_id", "sample_path", "label_name",
+                       "label_id"])
+    df = df.sample(frac=1, random_state=seed)
+    df.to_csv(os.path.join(data_dir, "client_data_mapping", "train.csv"),
+              index=False)
+    return df
+
+
+def test_image_cache_matches_decoded_images(tmp_path):
+    """test the cached client images against decoding the files
+    """
+    data_dir = str(tmp_path)
+    df = write_raw_femnist(data_dir)
+    proc = FemnistProcessor(data_dir, ["train"])
+    proc.process_data()
+
+    for client_id in range(5):
+        proc.load(client_id)
+        data = proc.dataset("train")
+        expected = df[df.client_id == client_id]
+        assert sorted(data.img_urls) == sorted(expected.sample_path)
+        reference = FemnistDataset(
+            data_dir, data.img_urls, data.targets,
+            normalize=((proc.normalize[0],), (proc.normalize[1],)))
+
+        batch = data.__getitems__(list(range(len(data))))
+        for i, (img, target) in enumerate(batch):
+            ref_img, ref_target = reference[i]
+            assert target == ref_target
+            assert torch.allclose(img, ref_img, atol=1e-6)
+            assert torch.equal(data[i][0], img)
+
+
+def test_index_file_matches_client_rows(tmp_path):
+    """test the run-length index against filtering every client
+    """
+    data_dir = str(tmp_path)
+    write_raw_femnist(data_dir, num_clients=20)
+    proc = FemnistProcessor(data_dir, ["train"])
+    proc.process_file("train")
+    # build the index from the processed file
+    proc.create_index_file("train")
+
+    df = pd.read_csv(
+        os.path.join(data_dir, "client_data_mapping", "train_processed.csv"),
+        index_col=0)
+    index = np.load(proc.index_file("train"))
+    assert len(index) == df.client_id.nunique()
+    for client_id, startindex, lastindex in index:
+        rows = df.index[df.client_id == client_id]
+        assert (startindex, lastindex) == (rows.min(), rows.max())
+
+
+def test_load_reads_client_slices_without_csv(tmp_path, monkeypatch):
+    """test that loading a client only slices the binary tables
+    """
+    data_dir = str(tmp_path)
+    df = write_raw_femnist(data_dir, num_clients=8)
+    FemnistProcessor(data_dir, ["train"]).process_data()
+
+    def no_csv(*args, **kwargs):
+        raise AssertionError("csv parsed while loading a client")
+    monkeypatch.setattr(pd, "read_csv", no_csv)
+
+    proc = FemnistProcessor(data_dir, ["train"])
+    for client_id in range(8):
+        proc.load(client_id)
+        expected = df[df.client_id == client_id].sort_values("sample_path")
+        order = np.argsort(proc.img_urls["train"])
+        np.testing.assert_array_equal(
+            proc.img_urls["train"][order], expected.sample_path)
+        np.testing.assert_array_equal(
+            proc.labels["train"][order], expected.label_id)
+        assert len(proc.images["train"]) == len(expected)
@@ -0,0 +1,115 @@
+import gc
+import os
+import pickle
+import threading
+
+import numpy as np
+import pytest
+import torch
+from fedrec.utilities.loader_utils import (LoaderManager, PrefetchLoader,
+                                           SwappableDataset, pin_memory)
+
+
+def test_prefetch_loader_keeps_order():
+    """test that the prefetched batches are the loader's batches in order
+    """
+    batches = [(torch.full((4,), i), torch.tensor([i])) for i in range(10)]
+    loader = PrefetchLoader(batches, num_prefetch=3, device="cpu")
+    assert len(loader) == 10
+    for _ in range(2):
+        for (x, t), (ref_x, ref_t) in zip(loader, batches):
+            assert torch.equal(x, ref_x) and torch.equal(t, ref_t)
+    assert len(list(loader)) == 10
+
+
+def test_prefetch_loader_stops_and_raises():
+    """test early exits and errors raised while fetching
+    """
+    def failing():
+        yield torch.zeros(1)
+        raise ValueError("bad batch")
+
+    with pytest.raises(ValueError):
+        list(PrefetchLoader(failing(), device="cpu"))
+
+    # leaving the loop early stops the producer
+    infinite = (torch.zeros(1) for _ in iter(int, 1))
+    for i, _ in enumerate(PrefetchLoader(infinite, num_prefetch=1)):
+        if i == 5:
+            break
+
+
+def test_prefetch_loader_draws_seeds_on_calling_thread():
+    """test that the random draws of the loader's sampler happen on the
+    consumer's thread
+    """
+    class Sampler(torch.utils.data.RandomSampler):
+        def __iter__(self):
+            self.thread = threading.current_thread()
+            yield from super().__iter__()
+
+    sampler = Sampler(range(100))
+    data = torch.utils.data.DataLoader(range(100), sampler=sampler)
+    torch.manual_seed(0)
+    expected = torch.cat(list(data))
+    torch.manual_seed(0)
+    assert torch.equal(
+        torch.cat(list(PrefetchLoader(data, device="cpu"))), expected)
+    assert sampler.thread is threading.current_thread()
+    assert list(PrefetchLoader([], device="cpu")) == []
+
+
+def test_pin_memory_passes_non_tensors():
+    """test that non-tensor leaves of a batch are left unchanged
+    """
+    batch = [1, "id", None, {"name": "x"}]
+    assert pin_memory(batch) == batch
+
+
+def test_loader_manager_swaps_datasets_into_workers():
+    """test that a new round reuses the workers with the new dataset
+    """
+    manager = LoaderManager(torch.utils.data.DataLoader)
+    first = [torch.tensor([i]) for i in range(6)]
+    loader = manager.loader('train', first, batch_size=2, num_workers=2,
+                            persistent_workers=True)
+    assert torch.equal(torch.cat(list(loader)).view(-1), torch.arange(6))
+    workers = [w.pid for w in loader._iterator._workers]
+
+    for round_idx in range(1, 3):
+        data = [torch.tensor([100 * round_idx + i]) for i in range(4)]
+        assert manager.loader('train', data, batch_size=2, num_workers=2,
+                              persistent_workers=True) is loader
+        assert len(loader) == 2
+        assert torch.equal(torch.cat(list(loader)).view(-1),
+                           100 * round_idx + torch.arange(4))
+        assert [w.pid for w in loader._iterator._workers] == workers
+    workers = loader._iterator._workers
+    manager.close()
+    assert not os.path.exists(manager.swap_dir)
+    del loader
+    gc.collect()
+    for worker in workers:
+        worker.join(timeout=10)
+        assert not worker.is_alive()
+
+
+def test_swap_maps_memmaps_again(tmp_path):
+    """test that a swapped dataset references its memmaps by file
+    """
+    path = str(tmp_path / "column.npy")
+    np.save(path, np.arange(1 << 16, dtype=np.int64).reshape(-1, 4))
+    column = np.load(path, mmap_mode="r")
+    data = {"column": column, "view": column[100:200],
+            "rows": column[[1, 5]], "indices": np.arange(3)}
+
+    swappable = SwappableDataset([], str(tmp_path))
+    swappable.swap(data, num_workers=1)
+    swap_file = swappable._swap_file(1)
+    assert os.path.getsize(swap_file) < column.nbytes // 100
+    with open(swap_file, "rb") as f:
+        loaded = pickle.load(f)
+    assert isinstance(loaded["column"], np.memmap)
+    assert isinstance(loaded["view"], np.memmap)
+    for name, value in data.items():
+        assert np.array_equal(loaded[name], value)
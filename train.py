@@ -144,7 +144,10 @@ def main():
         model_preproc=model_preproc,
         logger=logger)
 
-    trainer.train(modeldir=args.logdir)
+    try:
+        trainer.train(modeldir=args.logdir)
+    finally:
+        trainer.close()
 
 
 if __name__ == "__main__":